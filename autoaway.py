@@ -27,22 +27,30 @@ from __future__ import print_function
 
 import os
 import sys
-import platform
 import subprocess
 import socket
 import time
 import datetime
 import argparse
+import atexit
+import bisect
+import calendar
+import collections
+import contextlib
+import heapq
+import operator
 import random
-import hashlib
+import json
 import re
+import select
+import signal
+import stat
+import struct
 import threading
 
 if sys.version_info >= (3, 0):
-  import urllib.request as urllib2
   import queue as Queue
 else:
-  import urllib2
   import Queue
 
 class AutoAway(object):
@@ -50,16 +58,27 @@ class AutoAway(object):
                       grace_period=30, notify=None,
                       off_peak_start=None, off_peak_end=None,
                       occupied_sleep=15*60, check_every=None, vacant_sleep=15,
-                      verbose=False, reverse=True, randomise=True):
-
+                      verbose=False, reverse=True, randomise=True, concurrency=10,
+                      events=False, event_sleep=120, sweep_rate=100,
+                      dns_ttl=300, dns_negative_ttl=60, statefile=None,
+                      notify_timeout=60, notify_retries=3,
+                      confirm_window=15, confirm_probes=3, adaptive=False, max_backoff=8,
+                      off_peak=None, clock=None, leases=None, listen=False,
+                      name=None, shared=None, ipv6=None,
+                      neighbours=None, pinger=None, resolver=None,
+                      history=None, history_size=1024):
+
+    self.name = name
+    self.shared = shared
+    self.labels = {"site": name} if name else {}
     self.devices = devices
     self.use_arp = use_arp
     self.pings = int(pings)
     self.subnet = subnet
     self.grace_period = int(grace_period)
     self.notify = notify
-    self.off_peak_start = self.time_to_tuple(off_peak_start)
-    self.off_peak_end = self.time_to_tuple(off_peak_end)
+    self.dispatcher = NotificationDispatcher(notify, notify_timeout, notify_retries, self) if notify else None
+    self.clock = clock if clock else Clock()
     self.grace_period_secs = self.grace_period * 60
     self.occupied_sleep = int(occupied_sleep) if occupied_sleep else occupied_sleep
     self.check_every = int(check_every) if check_every else check_every
@@ -67,15 +86,40 @@ class AutoAway(object):
     self.verbose = verbose
     self.reverse = reverse
     self.randomise = randomise
+    self.concurrency = max(int(concurrency), 1)
+    self.events = events
+    self.event_sleep = int(event_sleep)
+    self.sweep_rate = max(int(sweep_rate), 1)
+
+    # The neighbour table (an object with dump(), as NeighbourTable), pinger
+    # and resolver may be given in place of the system ones, eg. by
+    # benchmark.py
+    if resolver:
+      self.resolver = resolver
+    elif shared and shared.resolver:
+      self.resolver = shared.resolver
+    else:
+      self.resolver = ResolverCache(ttl=dns_ttl, negative_ttl=dns_negative_ttl, clock=self.clock)
+    self.statefile = statefile
+    self.confirm_window = max(int(confirm_window), 0)
+    self.confirm_probes = max(int(confirm_probes), 1)
+    self.scheduler = None
 
-    self.static_list = [("", x) for x in self.devices if not self.isMAC(x)]
-    self.dynamic_list = [(x, "") for x in self.devices if self.isMAC(x)]
+    self.registry = DeviceRegistry(self.devices)
 
     self.debug("Monitoring %d device%s: [%s]" % (len(self.devices), "s"[len(self.devices)==1:], ", ".join(self.devices)))
     self.debug("Using ARP: %s, Reverse Lookup: %s" % (self.use_arp, self.reverse))
-    self.debug("Pings: %d, Grace Period: %d mins" % (self.pings, self.grace_period))
-    if self.off_peak_start and self.off_peak_end:
-      self.debug("Off Peak: %s -> %s" % (off_peak_start, off_peak_end))
+    self.debug("DNS cache TTL: %d secs, negative TTL: %d secs" % (self.resolver.ttl, self.resolver.negative_ttl))
+    self.debug("Pings: %d, Concurrency: %d, Grace Period: %d mins" % (self.pings, self.concurrency, self.grace_period))
+    self.debug("Confirmation: %d probe%s over %d secs" % (self.confirm_probes, "s"[self.confirm_probes==1:], self.confirm_window))
+
+    # Off-peak start/end is equivalent to a daily off-peak window
+    off_peak = list(off_peak or [])
+    if off_peak_start and off_peak_end:
+      off_peak.insert(0, "%s-%s" % (off_peak_start, off_peak_end))
+    self.offpeak = OffPeakSchedule(off_peak, self.clock) if off_peak else None
+    if self.offpeak:
+      self.debug("Off Peak: %s" % ", ".join(off_peak))
     else:
       self.debug("Off Peak: Not set")
     if self.check_every:
@@ -83,10 +127,31 @@ class AutoAway(object):
     else:
       self.debug("Sleep interval when occupied: %d secs" % self.occupied_sleep)
     self.debug("Sleep Interval when vacant:   %d secs" % self.vacant_sleep)
-
+    if adaptive:
+      self.scheduler = ProbeScheduler(self.registry.devices,
+                                      self.check_every * 60 if self.check_every else self.occupied_sleep,
+                                      max_backoff)
+      self.debug("Adaptive probing: Enabled (maximum backoff %d checks)" % self.scheduler.max_backoff)
+    if self.events:
+      self.debug("Sleep Interval when vacant with neighbour events: %d secs" % self.event_sleep)
+
+    # Prefer reading the kernel neighbour table directly over netlink, only
+    # falling back to forking "ip" or "arp" when netlink is unavailable.
     self.arp_type = "arp"
-    if sys.platform != "win32":
+    self.neighbours = neighbours
+    if neighbours:
+      self.arp_type = "netlink"
+    elif sys.platform.startswith("linux"):
       try:
+        neighbours = NeighbourTable()
+        neighbours.dump()
+        self.neighbours = neighbours
+        self.arp_type = "netlink"
+      except (OSError, socket.error, AttributeError, ValueError, struct.error) as e:
+        self.debug("Netlink neighbour table unavailable: %s" % e)
+    if sys.platform != "win32" and self.arp_type == "arp":
+      try:
+        metrics.count("autoaway_subprocesses_total", command="ip")
         response = subprocess.check_output(["ip", "neighbor", "list"],
                                            stderr=subprocess.STDOUT).decode("utf-8")
         self.arp_type = "ip"
@@ -94,7 +159,82 @@ class AutoAway(object):
         pass
     self.debug("ARP Cache type: %s" % self.arp_type)
 
+    # With ipv6 (an interface name, or "" for the default interface) IPv6
+    # neighbours are included in the ARP cache
+    self.ipv6 = ipv6
+    self.neighbours6 = None
+    if ipv6 is not None and self.arp_type == "netlink":
+      self.neighbours6 = NeighbourTable(socket.AF_INET6)
+    if ipv6 is not None:
+      self.debug("IPv6 neighbours: Enabled (interface %s)" % (ipv6 or get_default_interface()))
+
+    # Send ICMP echo requests in-process when possible, otherwise fork "ping"
+    self.pinger = pinger or (shared.pinger if shared else None)
+    if sys.platform != "win32" and not self.pinger:
+      try:
+        self.pinger = ICMPPinger()
+      except (OSError, socket.error) as e:
+        self.debug("ICMP sockets unavailable: %s" % e)
+    if not self.pinger:
+      self.pinger = SubprocessPinger(self.get_ping_stats)
+    self.debug("Ping type: %s" % self.pinger.type)
+    if shared:
+      (shared.pinger, shared.resolver) = (self.pinger, self.resolver)
+
+    # With --events, wake from Wait() as soon as the kernel reports that a
+    # monitored device has become reachable
+    self.wakeup = threading.Event()
+    self.wakeup_reason = None
+    self.pending_devices = None
+    self.watch_macs = set()
+    self.watch_ips = set()
+    self.monitor = None
+    if self.events:
+      try:
+        self.monitor = NeighbourMonitor(self.neighbour_event)
+        self.monitor.start()
+      except (OSError, socket.error, AttributeError) as e:
+        self.log("Neighbour events unavailable, polling instead: %s" % e)
+    self.debug("Neighbour events: %s" % ("Enabled" if self.monitor else "Disabled"))
+
+    # Passive sources of presence, which never communicate with the devices.
+    # Learn IP addresses from DHCP lease files, and treat a lease renewal by
+    # a monitored device as the device being seen. With --listen, a monitored
+    # device is seen whenever it sends an ARP or DHCP packet. Both are queued
+    # by background threads and applied on the next check.
+    self.passive_lock = threading.Lock()
+    self.passive_queue = []
+    self.lease_watchers = []
+    for filename in leases or []:
+      watcher = LeaseWatcher(LeaseFile(filename), self.passive_event)
+      self.lease_watchers.append(watcher)
+      self.debug("DHCP leases: %s (%s)" % (filename, watcher.type))
+
+    self.listener = None
+    if listen:
+      try:
+        self.listener = PacketListener(self.passive_event)
+        self.listener.start()
+      except (OSError, socket.error, AttributeError) as e:
+        self.log("Packet listener unavailable: %s" % e)
+    self.debug("Packet listener: %s" % (self.listener.type if self.listener else "Disabled"))
+
+    # Presence detectors, run cheapest and most productive first until one
+    # finds a device. Costs are the expected time taken until measured.
+    detectors = []
+    if self.lease_watchers or self.listener:
+      detectors.append(Detector("passive", 0.0001, self.passive_check))
+    if self.use_arp:
+      detectors.append(Detector("arp", 0.001 if self.neighbours else 0.02,
+                                lambda: self.arp_check(self.get_check_arp())))
+    detectors.append(Detector("ping", 1.0, self.detect_ping))
+    self.detectors = DetectorPipeline(detectors, self.clock)
+    self.check_arp = None
+    self.arp_table = NeighbourSnapshot()
+
     self.last_seen = 0
+    self.last_notseen = 0
+    self.last_check = 0
     self.first_seen = 0
     self.first_notseen = 0
     self.start_graceperiod = 0
@@ -102,10 +242,44 @@ class AutoAway(object):
     self.time_occupied = 0
     self.time_vacant = 0
 
-    if self.dynamic_list:
+    # Equivalents of first_seen, first_notseen and start_graceperiod on the
+    # boot time clock, from which periods are calculated. The wall clock times
+    # above are only used for reporting.
+    self.seen_at = 0
+    self.notseen_at = 0
+    self.grace_at = 0
+
+    self.check_schedule = CheckScheduler(self.clock)
+
+    # Record presence and occupancy changes in the history file, shared by
+    # all sites recording to the same file
+    self.history = None
+    if history:
+      if shared and history in shared.histories:
+        self.history = shared.histories[history]
+      else:
+        try:
+          self.history = HistoryWriter(history, int(history_size) * 1024, self.clock)
+          if shared: shared.histories[history] = self.history
+        except (IOError, OSError, ValueError) as e:
+          self.log("Unable to record history in %s: %s" % (history, e))
+    self.debug("History: %s" % (history if self.history else "Disabled"))
+
+    # Occupancy when the state file was saved, or None if not restored
+    self.restored_occupied = None
+    if self.statefile:
+      self.load_state()
+
+    for watcher in self.lease_watchers:
+      self.learn_mac_hosts(watcher.lease.read())
+      watcher.start()
+
+    if self.registry.macs:
       arp = self.get_arp_cache()
       self.learn_mac_hosts(arp)
-      if not [x for x in self.dynamic_list if x[1] != ""]:
+      if self.ipv6 is not None and self.registry.unresolved():
+        self.discover_ipv6()
+      if not [x for x in self.registry.macs if x.ip]:
         if not self.subnet:
           self.subnet = self.get_subnet_from_arp(arp)
         self.debug("* Local sub-domain appears to be: %s" % self.subnet)
@@ -116,38 +290,45 @@ class AutoAway(object):
     self.debug("=" * 50)
 
   def PropertyIsOccupied(self):
-    is_occupied = self.get_status()
+    with self.timer("check"):
+      if self.pending_devices is not None:
+        self.reload_devices()
 
-    check_start = int(time.time())
+      is_occupied = self.get_status()
 
-    # If transitioning from seen to not seen, check up to 3 more times
-    # to avoid false positives
-    if not is_occupied and self.DevicesSeen():
-      CHECK_MAX=3
-      for i in range(1, CHECK_MAX+1):
-        if is_occupied:
-          break
-        time.sleep(5)
-        self.debug("Potential occupancy transition - extra check %d of %d" % (i, CHECK_MAX))
-        is_occupied = self.get_status()
+      check_start = int(self.clock.time())
+      check_start_at = self.clock.boottime()
 
-    if is_occupied:
-      self.debug("Occupancy Check: %s (one or more devices within property)" % is_occupied)
-      self.set_status(True)
-    else:
-      now = int(time.time())
-      if self.start_graceperiod == 0:
-        self.start_graceperiod = check_start
-      gp_remaining = self.grace_period_secs - (now - self.start_graceperiod)
-      gp_msg = "elapsed" if gp_remaining <= 0 else self.secsToTime(gp_remaining, "%dm %02ds")
-      self.debug("Occupancy Check: %s (no devices within property, grace period remaining: %s)" % (is_occupied, gp_msg))
-      if gp_remaining <= 0:
-        self.set_status(False)
-
-    if self.first_notseen != 0:
-      return False
-    else:
-      return True
+      # If transitioning from seen to not seen, confirm with further probes
+      # to avoid false positives
+      if not is_occupied and self.DevicesSeen():
+        is_occupied = self.confirm_absence()
+
+      if is_occupied:
+        self.debug("Occupancy Check: %s (one or more devices within property)" % is_occupied)
+        self.set_status(True)
+      else:
+        if self.start_graceperiod == 0:
+          self.start_graceperiod = check_start
+          self.grace_at = check_start_at
+        gp_remaining = self.grace_period_secs - int(self.clock.boottime() - self.grace_at)
+        gp_msg = "elapsed" if gp_remaining <= 0 else self.secsToTime(gp_remaining, "%dm %02ds")
+        self.debug("Occupancy Check: %s (no devices within property, grace period remaining: %s)" % (is_occupied, gp_msg))
+        if gp_remaining <= 0:
+          self.set_status(False)
+
+      if self.statefile:
+        self.save_state()
+
+      self.last_check = self.clock.time()
+      if self.history:
+        self.history.check_flush()
+      metrics.count("autoaway_checks_total", **self.labels)
+      metrics.set("autoaway_occupied", 0 if self.first_notseen != 0 else 1, **self.labels)
+      if self.first_notseen != 0:
+        return False
+      else:
+        return True
 
   def PropertyIsVacant(self):
     return not self.PropertyIsOccupied()
@@ -171,171 +352,545 @@ class AutoAway(object):
     return datetime.datetime.fromtimestamp(self.first_notseen)
 
   def ExecuteNotification(self, isOccupied):
-    if self.notify:
-      if isOccupied:
-        value = "here"
-        period1 = "%d" % int(self.time_vacant)
-        period2 = self.GetVacantPeriod()
-      else:
-        value = "away"
-        period1 = "%d" % int(self.time_occupied)
-        period2 = self.GetOccupiedPeriod()
+    with self.timer("notify"):
+      if self.notify:
+        if isOccupied:
+          value = "here"
+          period1 = "%d" % int(self.time_vacant)
+          period2 = self.GetVacantPeriod()
+        else:
+          value = "away"
+          period1 = "%d" % int(self.time_occupied)
+          period2 = self.GetOccupiedPeriod()
 
-      self.debug("Calling notify [%s] with arg1 [%s], arg2 [%s], arg3 [%s]" % (self.notify, value, period1, period2))
+        self.debug("Queueing notify [%s] with arg1 [%s], arg2 [%s], arg3 [%s]" % (self.notify, value, period1, period2))
 
-      try:
-        response = subprocess.check_output([self.notify, value, period1, period2],
-                                           stderr=subprocess.STDOUT).decode("utf-8")
-        if response:
-          self.debug("** Start of response **")
-          self.debug("%s" % response[:-(len(os.linesep))])
-          self.debug("** End of response **")
-      except subprocess.CalledProcessError as e:
-        self.log("#### BEGIN EXCEPTION #####")
-        self.log(str(e))
-        self.log("Output from notify follows:\n%s" % e.output)
-        self.log("#### END EXCEPTION #####")
+        # In multi-site mode, the site name is the fourth argument
+        metrics.count("autoaway_notifications_total", state=value, **self.labels)
+        self.dispatcher.submit([value, period1, period2] + ([self.name] if self.name else []))
 
   def Wait(self):
+    with self.timer("wait"):
+      self.sleep(self.GetSleep())
+
+  # Seconds until the next check is due
+  def GetSleep(self):
     offpeak = False
 
     if self.DevicesSeen():
-      sleep_time = self.get_next_interval()
-
       # When the property is occupied during off peak hours, sleep for
       # longer to avoid unecessary device communication and battery drain.
-      if self.off_peak_start and self.off_peak_end:
-        t = datetime.datetime.now().timetuple()
-        hms = (t[3], t[4], t[5])
-        s = self.off_peak_start
-        e = self.off_peak_end
-        if e < s: e = (e[0]+24, e[1], e[2])
-        hms24 = (hms[0]+24, hms[1], hms[2]) if hms[0] < s[0] else hms
-
-        # If off peak is active, sleep until off peak ends
-        if s <= hms24 < e:
-          offpeak = True
-          sleep_time = ((e[0] - hms24[0])*60*60) + ((e[1] - hms24[1])*60) + (e[2] - hms24[2])
-        else:
-          # If off-peak kicks in before the next default occupancy check, only
-          # sleep long enough so that the last on-peak check occurs just as
-          # off-peak begins.
-          if hms[0] > s[0]: s = (s[0]+24, s[1], s[2])
-          secs_to_offpeak = ((s[0] - hms[0])*60*60) + ((s[1] - hms[1])*60) + (s[2] - hms[2])
-          if secs_to_offpeak < sleep_time: sleep_time = secs_to_offpeak
+      sleep_time = self.get_next_interval()
+      offpeak = self.offpeak is not None and self.offpeak.active(self.clock.time())
     else:
-      sleep_time = self.vacant_sleep
+      sleep_time = self.check_schedule.after(self.event_sleep if self.monitor else self.vacant_sleep)
 
     if self.verbose:
-      self.debug("Sleeping for %d seconds (%s)%s" %
-        (sleep_time, self.secsToTime(sleep_time, "%dh %02dm %02ds"),
+      self.debug("DNS cache: %s" % self.resolver.summary())
+      self.debug("Schedule: %s" % self.check_schedule.summary())
+      self.debug("Detectors: %s" % self.detectors.summary())
+      self.debug("Sleeping for %.1f seconds (%s), next check at %s%s" %
+        (sleep_time, self.secsToTime(int(round(sleep_time)), "%dh %02dm %02ds"),
+        datetime.datetime.fromtimestamp(self.clock.time() + sleep_time).strftime("%H:%M:%S"),
         " [Off peak is active]" if offpeak else ""))
 
-    time.sleep(sleep_time)
+    return sleep_time
+
+  # Sleep for up to secs seconds, returning early if woken by an event or
+  # on resume from suspend
+  def sleep(self, secs):
+    self.update_watch()
+    reason = self.check_schedule.wait(self.wakeup, secs)
+    if reason == "event":
+      self.debug("Woken early: %s" % self.wakeup_reason)
+    elif reason == "suspend":
+      self.log("Resumed after %s suspended, checking now" %
+        self.secsToTime(int(self.check_schedule.last_suspend), "%dh %02dm %02ds"))
+    self.wakeup.clear()
+    self.wakeup_reason = None
+
+  PASSIVE_TYPES = {"RENEWED": "DHCP lease renewal", "ARP": "ARP packet", "DHCP": "DHCP packet"}
+  PASSIVE_SOURCES = {"RENEWED": "lease", "ARP": "arp-packet", "DHCP": "dhcp-packet"}
+
+  # Called from a LeaseWatcher or PacketListener thread with a list of
+  # {"mac", "ip", "type"}, where type is "LEASED" for an existing lease,
+  # otherwise one of PASSIVE_TYPES and the device has just been seen. ip is
+  # empty when not known.
+  def passive_event(self, entries):
+    with self.passive_lock:
+      self.passive_queue.extend(entries)
+    if self.DevicesPresent(): return
+    for entry in entries:
+      if entry["type"] in self.PASSIVE_TYPES and (entry["mac"] in self.watch_macs or entry["ip"] in self.watch_ips):
+        self.wakeup_reason = "%s [%s] seen by %s" % (entry["ip"], entry["mac"], self.PASSIVE_TYPES[entry["type"]])
+        self.wakeup.set()
+        break
+
+  # Apply queued passive entries, returning True if a monitored device has
+  # been seen since the last check
+  def passive_check(self):
+    with self.timer("passive"):
+      with self.passive_lock:
+        (entries, self.passive_queue) = (self.passive_queue, [])
+      if not entries: return False
+      self.learn_mac_hosts([x for x in entries if x["ip"]])
+
+      for entry in [x for x in entries if x["type"] in self.PASSIVE_TYPES]:
+        found = self.registry.by_mac.get(entry["mac"])
+        if not found and entry["ip"] in self.registry.by_address:
+          found = self.registry.by_address[entry["ip"]][0]
+        if found:
+          found.last_seen = int(self.clock.time())
+          if self.scheduler:
+            self.scheduler.seen(found, self.clock.time())
+          self.debug("** Seen by %s: %s [%s]" % (self.PASSIVE_TYPES[entry["type"]], found.name, entry["ip"] or found.address))
+          self.record("seen", found, self.PASSIVE_SOURCES[entry["type"]])
+          return True
+      return False
+
+  # Addresses of the monitored devices, for matching neighbour events
+  def update_watch(self):
+    if not (self.monitor or self.lease_watchers or self.listener): return
+    self.watch_macs = set([x.mac for x in self.registry.macs])
+    ips = set()
+    for device in self.registry.monitored():
+      fqname, ipaddress = self.get_host_details(device.ip)
+      if ipaddress: ips.add(ipaddress)
+    self.watch_ips = ips
+    if self.listener:
+      self.listener.watch(self.watch_macs, self.watch_ips)
+
+  # Wake from Wait() and check now (called from another thread), with a
+  # replacement list of devices to be applied first if given
+  def request_check(self, reason, devices=None):
+    if devices is not None:
+      self.pending_devices = list(devices)
+    self.wakeup_reason = reason
+    self.wakeup.set()
+
+  # Replace the monitored devices with those requested, keeping the learned
+  # IP address and probe history of any device still monitored
+  def reload_devices(self):
+    (devices, self.pending_devices) = (self.pending_devices, None)
+    previous = dict([(x.name, x) for x in self.registry.devices])
+    self.devices = devices
+    self.registry = DeviceRegistry(devices)
+    for device in self.registry.devices:
+      old = previous.get(device.name)
+      if not old: continue
+      (device.last_seen, device.reliability, device.misses) = (old.last_seen, old.reliability, old.misses)
+      if device.mac and old.ip:
+        self.registry.learn(device, old.ip)
+    if self.scheduler:
+      self.scheduler = ProbeScheduler(self.registry.devices, self.scheduler.interval, self.scheduler.max_backoff)
+    self.arp_table = NeighbourSnapshot()
+    self.update_watch()
+    self.log("Monitoring %d device%s: [%s]" % (len(devices), "s"[len(devices)==1:], ", ".join(devices)))
+
+  # Occupancy, device and schedule state, from memory only
+  def control_status(self):
+    now = self.clock.time()
+    checked = self.last_check != 0
+    occupied = self.DevicesSeen() if checked else None
+    grace = None
+    if self.start_graceperiod != 0:
+      grace = max(self.grace_period_secs - int(self.clock.boottime() - self.grace_at), 0)
+    next_check = None
+    if self.check_schedule.deadline is not None:
+      next_check = max(self.check_schedule.deadline - self.clock.monotonic(), 0)
+
+    devices = []
+    for device in self.registry.devices:
+      devices.append({"name": device.name, "mac": device.mac or None, "ip": device.address or None,
+                      "last_seen": device.last_seen or None,
+                      "last_seen_secs": int(now - device.last_seen) if device.last_seen else None})
+
+    return {"site": self.name,
+            "occupied": occupied,
+            "present": self.DevicesPresent() if checked else None,
+            "since": (self.first_seen if occupied else self.first_notseen) or None,
+            "grace_remaining_secs": grace,
+            "next_check_secs": next_check,
+            "next_check": now + next_check if next_check is not None else None,
+            "last_check": self.last_check or None,
+            "off_peak": self.offpeak.active(now) if self.offpeak else False,
+            "devices": devices}
+
+  # True when occupied and not within the grace period
+  def DevicesPresent(self):
+    return self.DevicesSeen() and self.start_graceperiod == 0
+
+  # Called from the NeighbourMonitor thread. Only wake when no devices are
+  # currently being seen (vacant, or within the grace period).
+  def neighbour_event(self, nic):
+    if nic["type"] != "REACHABLE": return
+    if self.DevicesPresent(): return
+    if nic["mac"] in self.watch_macs or nic["ip"] in self.watch_ips:
+      self.wakeup_reason = "%s [%s] is reachable" % (nic["ip"], nic["mac"])
+      self.wakeup.set()
 
   def get_status(self):
-    # If checking ARP, or trying to resolve MAC addresses, then get the ARP cache
-    if self.use_arp or self.dynamic_list:
-      arp = self.get_arp_cache()
+    with self.timer("status"):
+      self.check_arp = None
+      found = self.detectors.run()
+      self.check_arp = None
+      return found is not None
+
+  # The ARP cache, loaded at most once per check. If we have MAC addresses,
+  # learn their IP address.
+  def get_check_arp(self):
+    if self.check_arp is None:
+      self.check_arp = self.update_arp_table()
+    return self.check_arp
+
+  # Apply the current ARP cache to the neighbour snapshot, learning MAC
+  # addresses only from the entries added or changed since the last update
+  # (plus any entries for MACs that have since been unlearned).
+  def update_arp_table(self, fresh=False):
+    table = self.arp_table
+    (added, removed, changed) = table.update(self.get_arp_cache(fresh))
+    if added or removed or changed:
+      self.debug("ARP cache: %d added, %d removed, %d changed (%d entries)" %
+                 (len(added), len(removed), len(changed), len(table)))
+    if self.registry.macs:
+      for device in self.registry.unresolved():
+        changed.extend([table.entry(x) for x in table.by_mac.get(device.mac, ())])
+      if added or changed:
+        self.learn_mac_hosts(added + changed)
+    return table
+
+  # MAC addresses must be resolved from the ARP cache before they can be pinged
+  def detect_ping(self):
+    if self.registry.macs:
+      self.get_check_arp()
+    return self.ping_check()
+
+  # Send confirm_probes bursts of probes spread evenly over confirm_window
+  # seconds, checking the ARP cache and pinging all devices (most recently
+  # seen first) in each burst, and stopping as soon as any device is found.
+  def confirm_absence(self):
+    with self.timer("confirm"):
+      start = self.clock.time()
+      interval = float(self.confirm_window) / self.confirm_probes
+      probes = 0
+      found = False
+
+      for burst in range(1, self.confirm_probes + 1):
+        self.debug("Potential occupancy transition - confirmation burst %d of %d" % (burst, self.confirm_probes))
+
+        if self.use_arp or self.registry.macs:
+          arp = self.update_arp_table(fresh=True)
+          if self.use_arp and self.arp_check(arp):
+            found = True
+            break
 
-      # If we have MAC addresses, learn their IP address
-      self.learn_mac_hosts(arp)
-    else:
-      arp = []
+        deadline = start + burst * interval
+        (winner, sent) = self.ping_targets(self.get_ping_targets(by_last_seen=True), 1,
+                                           timeout=max(deadline - self.clock.time(), 1.0), fresh=True)
+        probes += sent
+        if winner:
+          found = True
+          break
 
-    if self.use_arp and self.arp_check(arp):
-      return True
-    else:
-      return self.ping_check()
+        if deadline > self.clock.time():
+          self.clock.sleep(deadline - self.clock.time())
+
+      self.debug("Confirmation %s after %.2f secs, %d burst%s and %d ping%s" %
+        ("found a device" if found else "found no devices", self.clock.time() - start,
+         burst, "s"[burst==1:], probes, "s"[probes==1:]))
+
+      return found
 
   def set_status(self, isOccupied):
-    now = int(time.time())
+    now = int(self.clock.time())
+    now_at = self.clock.boottime()
 
     if isOccupied:
       self.last_seen = now
-      self.start_graceperiod = 0
+      self.start_graceperiod = self.grace_at = 0
 
       if self.first_seen == 0:
         self.first_seen = now
+        self.seen_at = now_at
 
       if self.first_notseen != 0:
-        self.time_vacant = self.first_seen - self.first_notseen
-        self.first_notseen = self.last_notseen = 0
+        self.time_vacant = int(self.seen_at - self.notseen_at)
+        self.first_notseen = self.last_notseen = self.notseen_at = 0
     else:
       self.last_notseen = now
 
       if self.first_notseen == 0:
         if self.start_graceperiod != 0:
           self.first_notseen = self.start_graceperiod
+          self.notseen_at = self.grace_at
         else:
           self.first_notseen = now
+          self.notseen_at = now_at
 
       if self.first_seen != 0:
-        self.time_occupied = self.first_notseen - self.first_seen
-        self.first_seen = self.last_seen = 0
+        self.time_occupied = int(self.notseen_at - self.seen_at)
+        self.first_seen = self.last_seen = self.seen_at = 0
+
+  # Restore learned IP addresses and occupancy timers from the state file.
+  # Learned IP addresses are verified against the ARP cache as usual, while
+  # timers are only restored if the state is no older than one occupied
+  # sleep interval or grace period, whichever is longer.
+  def load_state(self):
+    try:
+      with open(self.statefile, "r") as f:
+        state = json.load(f)
+      if not isinstance(state, dict): raise ValueError("not a JSON object")
+    except (IOError, OSError, ValueError) as e:
+      self.debug("Unable to load state file %s: %s" % (self.statefile, e))
+      return
+
+    for device in self.registry.macs:
+      ip = state.get("devices", {}).get(device.mac)
+      if ip and not device.ip:
+        self.registry.learn(device, ip)
+        self.debug("* Restored IP address: %s -> %s" % (device.mac, ip))
+
+    age = int(self.clock.time()) - state.get("saved", 0)
+    max_age = max(self.grace_period_secs, self.check_every * 60 if self.check_every else self.occupied_sleep)
+    if 0 <= age <= max_age:
+      for key in ["last_seen", "last_notseen", "first_seen", "first_notseen",
+                  "start_graceperiod", "time_occupied", "time_vacant"]:
+        setattr(self, key, int(state.get(key, 0)))
+      # The boot time clock doesn't survive a reboot, so rebase on the wall clock
+      offset = self.clock.boottime() - self.clock.time()
+      for (key, at) in [("first_seen", "seen_at"), ("first_notseen", "notseen_at"),
+                        ("start_graceperiod", "grace_at")]:
+        setattr(self, at, getattr(self, key) + offset if getattr(self, key) else 0)
+      self.restored_occupied = (self.first_notseen == 0)
+      self.debug("* Restored %s state from %s (saved %d secs ago)" %
+        ("occupied" if self.restored_occupied else "vacant", self.statefile, age))
+    else:
+      self.debug("* State file %s is too old (%d secs), not restoring occupancy" % (self.statefile, age))
+
+  # Write the state file atomically, by renaming a completed temporary file
+  def save_state(self):
+    state = {"saved": int(self.clock.time()),
+             "devices": dict([(x.mac, x.ip) for x in self.registry.macs if x.ip])}
+    for key in ["last_seen", "last_notseen", "first_seen", "first_notseen",
+                "start_graceperiod", "time_occupied", "time_vacant"]:
+      state[key] = getattr(self, key)
 
+    tmpfile = "%s.tmp" % self.statefile
+    try:
+      with open(tmpfile, "w") as f:
+        json.dump(state, f, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+      if sys.platform == "win32" and os.path.exists(self.statefile):
+        os.remove(self.statefile)
+      os.rename(tmpfile, self.statefile)
+    except (IOError, OSError) as e:
+      self.log("Unable to save state file %s: %s" % (self.statefile, e))
+
+  # Probe all devices concurrently (at most self.concurrency at a time) in
+  # priority order - random, or command line order with --norandom - and
+  # stop as soon as any one device replies.
   def ping_check(self):
     self.debug("Pinging remote hosts...")
+    if self.scheduler and self.DevicesPresent():
+      return self.scheduled_ping_check()
+    return self.ping_targets(self.get_ping_targets(), self.pings)[0] is not None
+
+  # With --adaptive while the property is occupied, only ping the devices due
+  # a probe according to the scheduler, pinging the most reliable device on
+  # its own first. When no device is due a probe (all were seen recently or
+  # are backed off) the devices are still present. Should no device that was
+  # pinged reply, the usual confirmation will still ping every device.
+  def scheduled_ping_check(self):
+    now = self.clock.time()
+
+    targets = []
+    for device in self.scheduler.due(now):
+      fqname, ipaddress = self.get_host_details(device.ip) if device.ip else (device.name, None)
+      if ipaddress:
+        targets.append((fqname, ipaddress, device))
+      else:
+        self.scheduler.reschedule(device, now)
+
+    if self.verbose:
+      for line in self.scheduler.describe(now):
+        self.debug("* Schedule: %s" % line)
+
+    if not targets:
+      self.debug("No devices due a probe, still present")
+      return True
 
-    dlist = [x for x in self.static_list + self.dynamic_list if x[1] != ""]
+    if targets[0][2].reliability >= ProbeScheduler.RELIABLE:
+      waves = [targets[:1], targets[1:]]
+    else:
+      waves = [targets]
+
+    found = None
+    for index, wave in enumerate(waves):
+      if index and found:
+        for (fqname, ipaddress, device) in wave:
+          self.scheduler.reschedule(device, now)
+        continue
+      found = self.ping_targets(wave, self.pings)[0]
+
+    return found is not None
+
+  # Return [(fqname, ipaddress, device)] in priority order, optionally
+  # ordered by the most recently seen device first
+  def get_ping_targets(self, by_last_seen=False):
+    dlist = self.registry.monitored()
     if self.randomise:
       dlist = random.sample(dlist, len(dlist))
+    if by_last_seen:
+      dlist = sorted(dlist, key=lambda x: x.last_seen, reverse=True)
 
-    for host in dlist:
-      mac = host[0]
-      ip = host[1]
-      fqname, ipaddress = self.get_host_details(ip)
+    targets = []
+    for device in dlist:
+      fqname, ipaddress = self.get_host_details(device.ip)
       if ipaddress:
-        try:
-          if sys.platform == "win32":
-            response = subprocess.check_output(["ping", "-n", "%d" % self.pings, "-w", "1000", ipaddress],
-                                               stderr=subprocess.STDOUT).decode("utf-8")
-          else:
-            response = subprocess.check_output(["ping", "-c","%d" % self.pings, "-W", "1", ipaddress],
-                                               stderr=subprocess.STDOUT).decode("utf-8")
-        except (subprocess.CalledProcessError) as e:
-          response = e.output
-
-        (sent, received, lost, errors, pctloss) = self.get_ping_stats(response)
-        self.debug("* Ping stats for %s: %d sent, %d received, %d lost (%d%% loss), %d errors" %
-          (fqname, sent, received, lost, pctloss, errors))
-
+        targets.append((fqname, ipaddress, device))
+      else:
+        self.debug("** Invalid Device: %s (no ip address)" % fqname)
+    return targets
+
+  # Returns (device that replied first or None, number of pings sent). In
+  # multi-site mode, hosts already pinged by another site this cycle are not
+  # pinged again unless fresh results are needed.
+  def ping_targets(self, targets, count, timeout=1.0, fresh=False):
+    with self.timer("ping"):
+      if not targets: return (None, 0)
+
+      check_start = self.clock.time()
+      ipaddresses = [x[1] for x in targets]
+      if self.shared:
+        (results, winner) = self.shared.ping_hosts(self.pinger, ipaddresses, count, timeout,
+                                                   self.concurrency, fresh)
+      else:
+        (results, winner) = self.pinger.ping_hosts(ipaddresses, count, timeout=timeout,
+                                                   first_reply=True, concurrency=self.concurrency)
+
+      found = None
+      for (fqname, ipaddress, device) in targets:
+        if ipaddress not in results or (results[ipaddress][0] == 0 and results[ipaddress][3] == 0):
+          if ipaddress in results:
+            self.debug("** Ping abandoned: %s [%s]" % (fqname, ipaddress))
+          if self.scheduler:
+            self.scheduler.reschedule(device, check_start)
+          continue
+        (sent, received, lost, errors, pctloss, rtts) = results[ipaddress]
+        if self.scheduler:
+          self.scheduler.record(device, received != 0, check_start, self.DevicesPresent())
+        self.debug("* Ping stats for %s: %d sent, %d received, %d lost (%d%% loss), %d errors%s" %
+          (fqname, sent, received, lost, pctloss, errors, self.rtt_summary(rtts)))
         if received != 0:
           self.debug("** Got Ping reply from: %s [%s]" % (fqname, ipaddress))
-          return True
+          self.record("seen", device, "ping")
+          if ipaddress == winner and not found:
+            found = device
+            device.last_seen = int(self.clock.time())
         else:
           self.debug("** No Ping reply from: %s [%s]" % (fqname, ipaddress))
-      else:
-        self.debug("** Invalid Device: %s (no ip address)" % fqname)
-    else:
-      return False
+          self.record("missed", device, "ping")
+
+      self.debug("* Probed %d of %d device(s) in %.3f secs" %
+        (len(results), len(targets), self.clock.time() - check_start))
 
+      return (found, sum([x[0] for x in results.values()]))
+
+  # Ping every host in subnet (CIDR notation, or the first three octets of
+  # a /24) to populate the ARP cache, stopping early once all MAC addresses
+  # have been resolved.
   def ping_subnet(self, subnet, maxthreads=20):
-    self.debug("Pinging subnet %s.x..." % subnet)
+    with self.timer("ping_subnet"):
+      try:
+        hosts = self.get_subnet_hosts(subnet)
+      except (ValueError, socket.error):
+        self.log("Invalid subnet: %s" % subnet)
+        return
 
-    work_queue = Queue.Queue()
+      self.debug("Pinging subnet %s (%d addresses)..." % (subnet, len(hosts)))
 
-    for host in range(1, 255):
-      ipaddress = "%s.%d" % (subnet, host)
-      work_queue.put(ipaddress)
-    MAX_SIZE = work_queue.qsize()
+      if getattr(self.pinger, "sweep", None):
+        self.sweep_subnet(hosts)
+        return
 
-    THREADS = []
-    for i in range(0, maxthreads):
-      t= MyPingThread(work_queue)
-      t.setDaemon(True)
-      THREADS.append(t)
+      work_queue = Queue.Queue()
 
-    # Start the threads...
-    for t in THREADS: t.start()
+      for ipaddress in hosts:
+        work_queue.put(ipaddress)
+      MAX_SIZE = work_queue.qsize()
 
-    try:
-      while not work_queue.empty():
-        time.sleep(4.0)
-        self.debug("Ping flood progress: %s.%d" % (subnet, MAX_SIZE - work_queue.qsize()))
-    except (KeyboardInterrupt, SystemExit):
-      stopped.set()
-      sys.exit(2)
+      THREADS = []
+      for i in range(0, maxthreads):
+        t= MyPingThread(work_queue)
+        t.setDaemon(True)
+        THREADS.append(t)
+
+      # Start the threads...
+      for t in THREADS: t.start()
+
+      try:
+        while not work_queue.empty():
+          time.sleep(4.0)
+          self.debug("Ping flood progress: %d of %d" % (MAX_SIZE - work_queue.qsize(), MAX_SIZE))
+          if self.learn_all_mac_hosts():
+            self.debug("Ping flood stopped early, all MAC addresses resolved")
+            while not work_queue.empty():
+              try:
+                work_queue.get_nowait()
+              except Queue.Empty:
+                pass
+      except (KeyboardInterrupt, SystemExit):
+        stopped.set()
+        sys.exit(2)
+
+  # Single-socket sweep at self.sweep_rate requests per second
+  def sweep_subnet(self, hosts):
+    state = {"last_progress": time.time(), "last_learn": time.time()}
+
+    def progress(sent, replies):
+      now = time.time()
+      if now - state["last_progress"] >= 2.0:
+        state["last_progress"] = now
+        self.debug("Ping sweep progress: %d of %d sent, %d replies" % (sent, len(hosts), replies))
+      if replies and now - state["last_learn"] >= 1.0:
+        state["last_learn"] = now
+        return self.learn_all_mac_hosts()
+      return False
+
+    (sent, replies, elapsed, complete) = self.pinger.sweep(hosts, self.sweep_rate, progress=progress)
+    if not complete: complete = self.learn_all_mac_hosts()
+
+    self.debug("Ping sweep %s in %.2f secs: %d of %d sent, %d replies" %
+      ("stopped early, all MAC addresses resolved" if complete else "finished",
+       elapsed, sent, len(hosts), replies))
+
+  # Learn IP addresses for any MACs, returning True once all are resolved
+  def learn_all_mac_hosts(self):
+    self.learn_mac_hosts(self.get_arp_cache(fresh=True))
+    return not self.registry.unresolved()
+
+  # Return the list of host addresses in subnet, eg. "192.168.1" (a /24),
+  # "192.168.0.0/22" or "10.0.0.0/20"
+  def get_subnet_hosts(self, subnet):
+    if "/" in subnet:
+      (network, prefix) = subnet.split("/")
+      prefix = int(prefix)
+    else:
+      (network, prefix) = (subnet, 24)
+
+    octets = network.split(".")
+    network = ".".join((octets + ["0", "0", "0", "0"])[:4])
+    if not 8 <= prefix <= 32: raise ValueError("prefix length %d out of range" % prefix)
+
+    mask = (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF
+    first = struct.unpack("!L", socket.inet_aton(network))[0] & mask
+    last = first | (~mask & 0xFFFFFFFF)
+    if prefix < 31:
+      first += 1
+      last -= 1
+
+    return [socket.inet_ntoa(struct.pack("!L", x)) for x in range(first, last + 1)]
 
   def get_ping_stats(self, response):
     re_match = None
@@ -368,13 +923,27 @@ class AutoAway(object):
 
     return(tuple(r))
 
-  def get_arp_cache(self):
+  def rtt_summary(self, rtts):
+    if not rtts: return ""
+    return ", rtt min/avg/max %.3f/%.3f/%.3f ms" % \
+      (min(rtts) * 1000, sum(rtts) * 1000 / len(rtts), max(rtts) * 1000)
+
+  # In multi-site mode all sites share one copy of the ARP cache per cycle,
+  # unless a fresh copy is needed (which then replaces the shared copy)
+  def get_arp_cache(self, fresh=False):
+    with self.timer("arp_load"):
+      if self.shared:
+        return self.shared.get_arp_cache(self.read_arp_cache, fresh)
+      return self.read_arp_cache()
+
+  def read_arp_cache(self):
     self.debug("Loading ARP Cache...")
 
     arp = []
 
     if sys.platform == "win32":
       try:
+        metrics.count("autoaway_subprocesses_total", command="arp")
         response = subprocess.check_output(["arp", "-a"],
                                            stderr=subprocess.STDOUT).decode("utf-8")
         pattern = re.compile(" *([0-9]*\.[0-9]*\.[0-9]*\.[0-9]*) *([^ ]*) *([^ ]*)")
@@ -386,24 +955,37 @@ class AutoAway(object):
       except (OSError, subprocess.CalledProcessError) as e:
         pass
     else:
-      if self.arp_type == "arp":
+      if self.arp_type == "netlink":
         try:
+          for nic in self.neighbours.dump():
+            if nic["type"] == "REACHABLE":
+              arp.append(nic)
+        except (OSError, socket.error, ValueError, struct.error) as e:
+          self.debug("Netlink neighbour dump failed, falling back to ip: %s" % e)
+          self.arp_type = "ip"
+          return self.read_arp_cache()
+      elif self.arp_type == "arp":
+        try:
+          metrics.count("autoaway_subprocesses_total", command="arp")
           response = subprocess.check_output(["arp", "-a"],
                                              stderr=subprocess.STDOUT).decode("utf-8")
           pattern = re.compile(".* \(([0-9]*\.[0-9]*\.[0-9]*\.[0-9]*)\) at (.*) on (.*)")
           for line in response.split("\n"):
             if line:
               match = re.match(pattern, line)
-              if match and self.isMAC(match.group(2)): # Got a MAC address...
-                arp.append({"mac": match.group(2).split(" ")[0], "ip": match.group(1), "type": match.group(3)})
+              mac = match.group(2).split(" ")[0] if match else None # eg. "aa:bb:cc:dd:ee:ff [ether]"
+              if mac and self.isMAC(mac): # Got a MAC address...
+                arp.append({"mac": mac, "ip": match.group(1), "type": match.group(3)})
         except (subprocess.CalledProcessError) as e:
           pass
       elif self.arp_type == "ip":
         try:
+          metrics.count("autoaway_subprocesses_total", command="ip")
           response = subprocess.check_output(["ip", "neighbor", "list"],
                                              stderr=subprocess.STDOUT).decode("utf-8")
           pattern = re.compile("^([0-9]*\.[0-9]*\.[0-9]*\.[0-9]*) .* .* (.*) (.*)$")
           for line in response.split("\n"):
+            line = line.strip() # iproute2 ends each line with a space
             if line:
               match = re.match(pattern, line)
               if match and self.isMAC(match.group(2)): # Got a MAC address...
@@ -412,45 +994,93 @@ class AutoAway(object):
         except (subprocess.CalledProcessError) as e:
           pass
 
+    if self.ipv6 is not None:
+      arp.extend(self.get_ipv6_neighbours())
+
     self.debug("* ARP Cache has %d entrie(s)" % len(arp))
 
     return arp
 
+  # IPv6 neighbours in any of states, in the same form as the ARP cache
+  def get_ipv6_neighbours(self, states=("REACHABLE",)):
+    neighbours = []
+    if self.neighbours6:
+      try:
+        neighbours = [x for x in self.neighbours6.dump() if x["type"] in states]
+      except (OSError, socket.error, ValueError, struct.error) as e:
+        self.debug("Netlink IPv6 neighbour dump failed: %s" % e)
+    elif self.arp_type == "ip":
+      try:
+        metrics.count("autoaway_subprocesses_total", command="ip")
+        response = subprocess.check_output(["ip", "-6", "neighbor", "list"],
+                                           stderr=subprocess.STDOUT).decode("utf-8")
+        for line in response.split("\n"):
+          fields = line.split()
+          if "dev" not in fields or "lladdr" not in fields: continue
+          (ip, dev, mac, state) = (fields[0], fields[fields.index("dev") + 1],
+                                   fields[fields.index("lladdr") + 1], fields[-1].upper())
+          if ip.lower().startswith("fe80:"): ip = "%s%%%s" % (ip, dev)
+          if state in states and isMAC(mac):
+            neighbours.append({"mac": mac.lower(), "ip": ip, "type": state})
+      except (OSError, subprocess.CalledProcessError) as e:
+        pass
+    return neighbours
+
+  # Send a single ICMPv6 echo request to all nodes (ff02::1) on the interface.
+  # Each responder resolves our address, leaving an entry for itself in the
+  # IPv6 neighbour table, from which the IPv6 addresses of any MAC addresses
+  # are learned - one packet instead of a ping flood of the IPv4 subnet.
+  def discover_ipv6(self):
+    interface = self.ipv6 or get_default_interface()
+    if not interface or not getattr(self.pinger, "discover", None) or not self.pinger.sock6:
+      self.debug("* IPv6 discovery unavailable (interface: %s, ping type: %s)" % (interface, self.pinger.type))
+      return
+
+    self.debug("* Sending ICMPv6 echo request to ff02::1%%%s" % interface)
+    try:
+      responders = self.pinger.discover("ff02::1%%%s" % interface, timeout=1.0)
+    except (OSError, socket.error, socket.gaierror) as e:
+      self.debug("* IPv6 discovery failed: %s" % e)
+      return
+    self.debug("* %d IPv6 node(s) responded" % len(responders))
+
+    self.learn_mac_hosts(self.get_ipv6_neighbours(("REACHABLE", "STALE", "DELAY", "PROBE")))
+
   def arp_check(self, arp):
-    if not arp: return False
-
-    for host in [x for x in self.static_list + self.dynamic_list if x[1] != ""]:
-      mac = host[0]
-      ip = host[1]
-      fqname, ipaddress = self.get_host_details(ip)
-      for nic in arp:
-        if ipaddress == nic["ip"]:
-          self.debug("** Found in ARP Cache: %s [%s]" % (fqname, ipaddress))
-          return True
-      else:
-        self.debug("** Not in ARP Cache: %s [%s]" % (fqname, ipaddress))
-    else:
+    with self.timer("arp_check"):
+      if not arp: return False
+
+      # Hostnames must be resolved before they can be matched against the ARP cache
+      self.registry.resolve(lambda ip: self.get_host_details(ip)[1])
+
+      found = self.registry.find_in_table(arp)
+      if found:
+        found.last_seen = int(self.clock.time())
+        if self.scheduler:
+          self.scheduler.seen(found, self.clock.time())
+        fqname, ipaddress = self.get_host_details(found.ip)
+        self.debug("** Found in ARP Cache: %s [%s]" % (fqname, ipaddress))
+        self.record("seen", found, "arp")
+        metrics.count("autoaway_arp_checks_total", result="hit", **self.labels)
+        return True
+
+      if self.verbose:
+        for device in self.registry.monitored():
+          fqname, ipaddress = self.get_host_details(device.ip)
+          self.debug("** Not in ARP Cache: %s [%s]" % (fqname, ipaddress))
+      metrics.count("autoaway_arp_checks_total", result="miss", **self.labels)
       return False
 
   def learn_mac_hosts(self, arp_list):
-    if not self.dynamic_list: return
-
-    for index, host in enumerate(self.dynamic_list):
-      mac = host[0]
-      ip = host[1]
-      for nic in arp_list:
-        # Learn new IP address for this MAC
-        if mac == nic["mac"]:
-          if ip != nic["ip"]:
-            self.dynamic_list[index] = (mac, nic["ip"])
-            fqname, ipaddress = self.get_host_details(nic["ip"])
-            self.debug("* New IP address learned: %s -> %s (%s)" % (mac, nic["ip"], fqname))
-          break
-        # Forget any learned IP addresses if now assigned to a different MAC
-        elif mac != nic["mac"] and ip == nic["ip"]:
-            self.dynamic_list[index] = (mac, "")
-            self.debug("* Old IP address unlearned: %s (%s re-allocated to %s)" % (mac, nic["ip"], nic["mac"]))
-            break
+    with self.timer("learn"):
+      if not self.registry.macs: return
+
+      for (device, nic, learned) in self.registry.learn_from_arp(arp_list):
+        if learned:
+          fqname, ipaddress = self.get_host_details(nic["ip"])
+          self.debug("* New IP address learned: %s -> %s (%s)" % (device.mac, nic["ip"], fqname))
+        else:
+          self.debug("* Old IP address unlearned: %s (%s re-allocated to %s)" % (device.mac, nic["ip"], nic["mac"]))
 
   def get_subnet_from_arp(self, arp):
     subnets = {}
@@ -465,30 +1095,48 @@ class AutoAway(object):
       return None
 
   def isMAC(self, possible_mac):
-    return possible_mac.count(":") == 5
+    return isMAC(possible_mac)
 
+  # Forward lookups are cached. The reverse lookup used for the fully
+  # qualified name is only ever answered from the cache, with misses being
+  # looked up in the background - until then the name is returned as given.
   def get_host_details(self, device):
-    try:
-      fqname = socket.getfqdn(device) if self.reverse else device
-      ipaddress = socket.gethostbyname(device)
-      return (fqname, ipaddress)
-    except (socket.gaierror, socket.error):
+    ipaddress = self.resolver.forward(device)
+    if not ipaddress:
       self.debug("Can't resolve hostname: %s" % device)
       return (device, None)
+    fqname = self.resolver.reverse(device) if self.reverse else device
+    return (fqname, ipaddress)
 
   # Return an interval that schedules the next sleep period
   # for either the default number of seconds (occupied_sleep)
-  # or calculates when the next check_every should occur (eg.
-  # every 5 minutes)
+  # after the current check was due, or calculates when the next
+  # check_every should occur (eg. every 5 minutes).
+  # If off peak is active, sleep until off peak ends. If off peak
+  # kicks in before the next check, only sleep long enough so that
+  # the last on-peak check occurs just as off peak begins.
   def get_next_interval(self):
+    now = self.clock.time()
+
     if self.check_every:
-      t = datetime.datetime.now().timetuple()
-      hms = (t[3], t[4], t[5])
-      next = (hms[0], hms[1] + self.check_every - (hms[1] % self.check_every), 0)
-      if next[1] >= 60: next = (next[0]+1, next[1] - 60, next[2])
-      return ((next[0] - hms[0])*60*60) + ((next[1] - hms[1])*60) + (next[2] - hms[2])
+      # Skip a boundary less than a second away, should the wall clock
+      # put us fractionally before the boundary just checked
+      period = self.check_every * 60
+      if self.check_schedule.elapsed() > period:
+        self.check_schedule.overran(self.check_schedule.elapsed() - period)
+      t = datetime.datetime.fromtimestamp(now + 1).replace(second=0, microsecond=0)
+      next = t + datetime.timedelta(minutes=self.check_every - (t.minute % self.check_every))
+      interval = time.mktime(next.timetuple()) - now
     else:
-      return self.occupied_sleep
+      interval = self.check_schedule.after(self.occupied_sleep)
+
+    if self.offpeak:
+      boundary = self.offpeak.next_transition(now)
+      if boundary is not None:
+        if self.offpeak.active(now) or boundary - now < interval:
+          interval = max(boundary - now, 0)
+
+    return interval
 
   def secsToTime(self, secs, format=None):
     (days, hours, mins, seconds) = (int(secs/86400), int(secs/3600) % 24, int(secs/60) % 60, secs % 60)
@@ -504,21 +1152,1049 @@ class AutoAway(object):
     else:
       return "%dd %02d:%02d:%02d" % (days, hours, mins, seconds)
 
-  def time_to_tuple(self, aTime):
-    if not aTime:
-      return None
-    else:
-      hour, min = aTime.split(":")
-      return (int(hour), int(min), 0)
+  # Record event in the history file, for device (a Device) or otherwise for
+  # the site
+  def record(self, event, device=None, source=""):
+    if self.history:
+      self.history.record(event, device.name if device else self.name, source)
+
+  # Time a phase of the monitoring loop, for metrics
+  def timer(self, phase):
+    return metrics.timer("autoaway_phase_seconds", phase=phase, **self.labels)
 
   def debug(self, msg):
     if self.verbose:
       self.log("[debug] %s" % msg)
 
   def log(self, msg):
-    sys.stdout.write("%s: %s\n" % (datetime.datetime.now(), msg))
+    if self.name: msg = "[%s] %s" % (self.name, msg)
+    sys.stdout.write("%s: %s\n" % (datetime.datetime.fromtimestamp(self.clock.time()), msg))
     sys.stdout.flush()
 
+# Source of the current time, replaceable for testing and simulation. time()
+# is the wall clock, used for reporting and off peak. monotonic() is
+# unaffected by changes to the system time, and boottime() is also unaffected
+# but includes time spent suspended (Linux only, otherwise the wall clock).
+# All waiting is done by sleep() and wait().
+class Clock(object):
+  def time(self):
+    return time.time()
+
+  def monotonic(self):
+    return time.monotonic() if hasattr(time, "monotonic") else time.time()
+
+  def boottime(self):
+    if hasattr(time, "CLOCK_BOOTTIME"):
+      return time.clock_gettime(time.CLOCK_BOOTTIME)
+    return time.time()
+
+  def sleep(self, secs):
+    time.sleep(secs)
+
+  # Wait up to secs seconds for event, returning True if it was set
+  def wait(self, event, secs):
+    return event.wait(secs)
+
+# Process-wide counters, gauges and latency histograms, identified by name
+# and labels, rendered in the Prometheus text exposition format. Recording
+# only holds the lock for a dictionary update, so it never blocks the
+# monitoring loop for longer than it takes MetricsServer to copy the values.
+class Metrics(object):
+  BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+
+  HELP = {
+    "autoaway_info":                  ("gauge", "Version of autoaway.py"),
+    "autoaway_phase_seconds":         ("histogram", "Time taken by each phase of the monitoring loop"),
+    "autoaway_checks_total":          ("counter", "Occupancy checks performed"),
+    "autoaway_occupied":              ("gauge", "1 if the property is occupied, 0 if vacant"),
+    "autoaway_notifications_total":   ("counter", "Notifications queued for the notify script"),
+    "autoaway_notify_runs_total":     ("counter", "Runs of the notify script"),
+    "autoaway_arp_checks_total":      ("counter", "ARP cache checks, by whether a monitored device was found"),
+    "autoaway_probes_sent_total":     ("counter", "ICMP echo requests sent"),
+    "autoaway_probe_replies_total":   ("counter", "ICMP echo replies received"),
+    "autoaway_dns_lookups_total":     ("counter", "DNS lookups performed (not answered from the cache)"),
+    "autoaway_dns_cache_hits_total":  ("counter", "DNS lookups answered from the cache"),
+    "autoaway_subprocesses_total":    ("counter", "Processes started"),
+    "autoaway_check_overruns_total":  ("counter", "Checks that took longer than the check interval"),
+    "autoaway_suspends_total":        ("counter", "Resumes from system suspend"),
+  }
+
+  def __init__(self, clock=None):
+    self.clock = clock if clock else Clock()
+    self.lock = threading.Lock()
+    self.values = {}
+
+  def key(self, name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+  def count(self, name, value=1, **labels):
+    key = self.key(name, labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + value
+
+  def set(self, name, value, **labels):
+    key = self.key(name, labels)
+    with self.lock:
+      self.values[key] = value
+
+  # Histograms are held as [count per bucket (the last being +Inf), sum, count]
+  def observe(self, name, value, **labels):
+    key = self.key(name, labels)
+    bucket = bisect.bisect_left(self.BUCKETS, value)
+    with self.lock:
+      histogram = self.values.get(key)
+      if histogram is None:
+        histogram = self.values[key] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+      histogram[0][bucket] += 1
+      histogram[1] += value
+      histogram[2] += 1
+
+  @contextlib.contextmanager
+  def timer(self, name, **labels):
+    start = self.clock.monotonic()
+    try:
+      yield
+    finally:
+      self.observe(name, self.clock.monotonic() - start, **labels)
+
+  def render(self):
+    with self.lock:
+      values = [(key, [list(value[0])] + value[1:] if isinstance(value, list) else value)
+                for (key, value) in self.values.items()]
+
+    lines = []
+    last = None
+    for ((name, labels), value) in sorted(values, key=lambda x: x[0]):
+      (kind, help) = self.HELP.get(name, ("untyped", name))
+      if name != last:
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, kind))
+        last = name
+      if kind == "histogram":
+        cumulative = 0
+        for (bound, count) in zip(self.BUCKETS + (None,), value[0]):
+          cumulative += count
+          le = "+Inf" if bound is None else "%g" % bound
+          lines.append("%s_bucket%s %d" % (name, self.format_labels(labels + (("le", le),)), cumulative))
+        lines.append("%s_sum%s %s" % (name, self.format_labels(labels), self.format_value(value[1])))
+        lines.append("%s_count%s %d" % (name, self.format_labels(labels), value[2]))
+      else:
+        lines.append("%s%s %s" % (name, self.format_labels(labels), self.format_value(value)))
+    return "\n".join(lines) + "\n"
+
+  def format_labels(self, labels):
+    if not labels: return ""
+    escape = lambda x: ("%s" % x).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{%s}" % ",".join(['%s="%s"' % (x, escape(y)) for (x, y) in labels])
+
+  def format_value(self, value):
+    if value == int(value): return "%d" % value
+    return repr(float(value))
+
+# Serve metrics over HTTP at /metrics from a background thread, so that a
+# slow or stuck client never delays the monitoring loop. address is
+# "[ADDRESS:]PORT", the address defaulting to 127.0.0.1.
+class MetricsServer(threading.Thread):
+  TIMEOUT = 10
+
+  def __init__(self, address, metrics):
+    threading.Thread.__init__(self)
+    self.daemon = True
+
+    try:
+      from http.server import HTTPServer, BaseHTTPRequestHandler
+    except ImportError:
+      from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+    (host, port) = self.parse(address)
+
+    class Server(HTTPServer):
+      address_family = socket.AF_INET6 if ":" in host else socket.AF_INET
+
+    class Handler(BaseHTTPRequestHandler):
+      timeout = self.TIMEOUT
+
+      def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+          self.send_error(404)
+          return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", "%d" % len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    self.server = Server((host, port), Handler)
+    self.address = self.server.server_address
+
+  # Returns (host, port) from "[ADDRESS:]PORT", raising ValueError if invalid
+  @classmethod
+  def parse(cls, address):
+    (host, sep, port) = address.rpartition(":")
+    host = host.strip("[]") or "127.0.0.1"
+    port = int(port)
+    if not 0 < port < 65536: raise ValueError("port %d out of range" % port)
+    return (host, port)
+
+  def run(self):
+    self.server.serve_forever()
+
+# Unix domain control socket, served from a background thread with a thread
+# per connection. Each request is a line containing a JSON object such as
+# {"command": "status"}, or just the command name, and is answered with a
+# line containing a JSON object. Commands:
+#
+#   status                 Occupancy, devices and schedule of each site, from
+#                          memory without probing anything
+#   check                  Check now, interrupting the sleep
+#   reload                 Replace the monitored devices and check now. The
+#                          devices are given as "devices", or re-read from the
+#                          --sites file when omitted
+#
+# "site" restricts a command to the named site in multi-site mode.
+class ControlServer(threading.Thread):
+  TIMEOUT = 60
+
+  def __init__(self, path, sites, read_devices=None):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.path = path
+    self.sites = sites
+    self.read_devices = read_devices
+
+    try:
+      import socketserver
+    except ImportError:
+      import SocketServer as socketserver
+
+    control = self
+
+    class Handler(socketserver.StreamRequestHandler):
+      timeout = self.TIMEOUT
+
+      def handle(self):
+        for line in iter(self.rfile.readline, b""):
+          line = line.decode("utf-8").strip()
+          if not line: continue
+          self.wfile.write((json.dumps(control.handle(line), sort_keys=True) + "\n").encode("utf-8"))
+          self.wfile.flush()
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+      daemon_threads = True
+
+      # Clients that disconnect or time out are of no interest
+      def handle_error(self, request, client_address):
+        pass
+
+    # Replace the socket left behind by a previous instance
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+      os.remove(path)
+    self.server = Server(path, Handler)
+
+  def run(self):
+    self.server.serve_forever()
+
+  def handle(self, line):
+    try:
+      request = json.loads(line) if line.startswith("{") else {"command": line}
+      command = request.get("command")
+      sites = self.sites
+      if request.get("site") is not None:
+        sites = [x for x in self.sites if x.name == request["site"]]
+        if not sites: raise ValueError("unknown site %s" % request["site"])
+
+      if command == "status":
+        status = [x.control_status() for x in sites]
+        occupied = [x["occupied"] for x in status]
+        return {"ok": True, "occupied": True if True in occupied else (None if None in occupied else False),
+                "sites": status}
+
+      elif command == "check":
+        for autoaway in sites:
+          autoaway.request_check("Check requested by control socket")
+        return {"ok": True}
+
+      elif command == "reload":
+        if "devices" in request:
+          devices = request["devices"]
+          if not isinstance(devices, list) or not devices or len(sites) != 1 or \
+             [x for x in devices if not isinstance(x, (type(""), type(u"")))]:
+            raise ValueError("devices must be a non-empty list of names, for a single site")
+          changes = {sites[0].name: devices}
+        elif self.read_devices:
+          changes = self.read_devices()
+        else:
+          raise ValueError("devices must be given")
+        for autoaway in sites:
+          if changes.get(autoaway.name):
+            autoaway.request_check("Devices reloaded by control socket", changes[autoaway.name])
+        return {"ok": True}
+
+      raise ValueError("unknown command %s" % command)
+    except (ValueError, TypeError, AttributeError, KeyError, IOError, OSError) as e:
+      return {"ok": False, "error": "%s" % e}
+
+# Off-peak windows, each specified as "[DAYS|YYYY-MM-DD] HH:MM-HH:MM" where
+# DAYS is a comma separated list of days or day ranges (eg. "mon-fri",
+# "sat,sun"), defaulting to every day. A window ending at or before its start
+# time ends on the following day. Windows for a specific date replace the
+# weekly windows starting on that date (eg. for holidays).
+#
+# The windows are compiled into a sorted list of start/end instants covering
+# the next HORIZON_DAYS, using local time so that DST changes are honoured,
+# allowing off-peak status and the next transition to be found by bisection.
+class OffPeakSchedule(object):
+  DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+  HORIZON_DAYS = 8
+
+  def __init__(self, specs, clock=None):
+    self.clock = clock if clock else Clock()
+    self.weekly = []
+    self.dates = {}
+    for spec in specs:
+      (day, days, window) = self.parse(spec)
+      if day:
+        self.dates.setdefault(day, []).append(window)
+      else:
+        self.weekly.append((days, window))
+    self.transitions = []
+    self.valid_from = self.valid_until = 0
+
+  # Returns (date or None, set of weekdays, ((start h, m), (end h, m)))
+  @classmethod
+  def parse(cls, spec):
+    fields = spec.lower().split()
+    if len(fields) == 1: fields.insert(0, "mon-sun")
+    if len(fields) != 2: raise ValueError("invalid off peak window: %s" % spec)
+
+    try:
+      (start, end) = [tuple([int(x) for x in t.split(":")]) for t in fields[1].split("-")]
+    except ValueError:
+      raise ValueError("invalid off peak times: %s" % fields[1])
+    for (h, m) in [start, end]:
+      if not (0 <= h <= 24 and 0 <= m < 60) or (h == 24 and m != 0):
+        raise ValueError("invalid off peak time: %02d:%02d" % (h, m))
+
+    if re.match("^[0-9]{4}-[0-9]{2}-[0-9]{2}$", fields[0]):
+      day = datetime.datetime.strptime(fields[0], "%Y-%m-%d").date()
+      return (day, set([day.weekday()]), (start, end))
+
+    days = set()
+    for item in fields[0].split(","):
+      ends = item.split("-")
+      if len(ends) > 2 or [x for x in ends if x not in cls.DAYS]:
+        raise ValueError("invalid off peak days: %s" % fields[0])
+      first = cls.DAYS.index(ends[0])
+      last = cls.DAYS.index(ends[-1])
+      days.update([(first + x) % 7 for x in range((last - first) % 7 + 1)])
+    return (None, days, (start, end))
+
+  def active(self, now):
+    self.compile(now)
+    return bisect.bisect_right(self.transitions, now) % 2 == 1
+
+  # Time of the next start or end of off peak after now, or None
+  def next_transition(self, now):
+    self.compile(now)
+    index = bisect.bisect_right(self.transitions, now)
+    return self.transitions[index] if index < len(self.transitions) else None
+
+  def compile(self, now):
+    if self.valid_from <= now < self.valid_until: return
+
+    first_day = datetime.date.fromtimestamp(now) - datetime.timedelta(days=1)
+    intervals = []
+    for n in range(0, self.HORIZON_DAYS + 2):
+      day = first_day + datetime.timedelta(days=n)
+      if day in self.dates:
+        windows = self.dates[day]
+      else:
+        windows = [w for (days, w) in self.weekly if day.weekday() in days]
+      for (start, end) in windows:
+        end_day = day if end > start else day + datetime.timedelta(days=1)
+        intervals.append((self.local(day, start), self.local(end_day, end)))
+
+    # Merge overlapping windows into a flat list of start, end, start, end...
+    self.transitions = []
+    for (start, end) in sorted(intervals):
+      if self.transitions and start <= self.transitions[-1]:
+        self.transitions[-1] = max(self.transitions[-1], end)
+      else:
+        self.transitions.extend([start, end])
+
+    self.valid_from = self.local(first_day + datetime.timedelta(days=1), (0, 0))
+    self.valid_until = self.local(first_day + datetime.timedelta(days=self.HORIZON_DAYS), (0, 0))
+
+  # Local time to seconds since the epoch, letting mktime determine DST
+  def local(self, day, hm):
+    (h, m) = hm
+    if h == 24:
+      day += datetime.timedelta(days=1)
+      h = 0
+    return time.mktime((day.year, day.month, day.day, h, m, 0, 0, 0, -1))
+
+# Deadlines for the next check are kept on the monotonic clock so that they
+# are unaffected by changes to the system time, and are measured from the
+# previous deadline so that the time spent checking doesn't push each check
+# later. Records how late each check starts (jitter), checks that ran past
+# the time the next check was due (overruns), and host suspends, detected by
+# the boot time clock advancing further than the monotonic clock.
+class CheckScheduler(object):
+  SLICE = 30.0
+  SUSPEND_THRESHOLD = 5.0
+
+  def __init__(self, clock):
+    self.clock = clock
+    self.deadline = None
+    self.checks = 0
+    self.early = 0
+    self.overruns = 0
+    self.suspends = 0
+    self.last_overrun = 0
+    self.last_suspend = 0
+    self.jitter = collections.deque(maxlen=1000)
+
+  # Seconds since the current check was due
+  def elapsed(self):
+    now = self.clock.monotonic()
+    if self.deadline is None: self.deadline = now
+    return now - self.deadline
+
+  # Seconds until period seconds after the current check was due, or zero
+  # if the check has overrun the period
+  def after(self, period):
+    remaining = period - self.elapsed()
+    if remaining < 0:
+      self.overran(-remaining)
+      return 0
+    return remaining
+
+  def overran(self, secs):
+    self.overruns += 1
+    self.last_overrun = secs
+    metrics.count("autoaway_check_overruns_total")
+
+  # Wait on event for interval seconds. Returns "event", "suspend" or None
+  # on schedule.
+  def wait(self, event, interval):
+    self.schedule(interval)
+    reason = self.sleep_until(event, self.deadline)
+    self.started(reason)
+    return reason
+
+  def schedule(self, interval):
+    self.deadline = self.clock.monotonic() + interval
+
+  # Wait on event until the monotonic deadline, in slices so that a suspend
+  # is noticed promptly on resume. Returns "event", "suspend" or None.
+  def sleep_until(self, event, deadline):
+    while True:
+      (mono, boot) = (self.clock.monotonic(), self.clock.boottime())
+      remaining = deadline - mono
+      if remaining <= 0: return None
+      if self.clock.wait(event, min(remaining, self.SLICE)):
+        return "event"
+      suspended = (self.clock.boottime() - boot) - (self.clock.monotonic() - mono)
+      if suspended > self.SUSPEND_THRESHOLD:
+        self.suspends += 1
+        self.last_suspend = suspended
+        metrics.count("autoaway_suspends_total")
+        return "suspend"
+
+  # Record the start of a check, either as scheduled or early for reason
+  def started(self, reason=None):
+    now = self.clock.monotonic()
+    self.checks += 1
+    if reason:
+      # Unscheduled, so the next check period starts now
+      self.early += 1
+      self.deadline = now
+    else:
+      self.jitter.append(now - self.deadline)
+
+  def summary(self):
+    if not self.jitter:
+      return "%d checks, %d unscheduled, %d overruns, %d suspends" % \
+        (self.checks, self.early, self.overruns, self.suspends)
+    jitter = sorted(self.jitter)
+    return "%d checks, %d unscheduled, jitter median/p95/max %.1f/%.1f/%.1f ms, %d overruns, %d suspends" % \
+      (self.checks, self.early, jitter[len(jitter) // 2] * 1000, jitter[int(len(jitter) * 0.95)] * 1000,
+       jitter[-1] * 1000, self.overruns, self.suspends)
+
+# A source of presence, run by DetectorPipeline. check() returns True when a
+# monitored device is present. Tracks the time taken and how often a device
+# is found, both overall and as moving averages for ordering.
+class Detector(object):
+  ALPHA = 0.2
+  MIN_HIT_RATE = 0.01
+
+  def __init__(self, name, cost, check):
+    self.name = name
+    self.check = check
+    self.latency = cost
+    self.hit_rate = 0.5
+    self.runs = 0
+    self.hits = 0
+    self.elapsed = 0.0
+
+  # Expected time taken per device found, lowest first
+  def score(self):
+    return self.latency / max(self.hit_rate, self.MIN_HIT_RATE)
+
+  def run(self, clock):
+    start = clock.monotonic()
+    found = bool(self.check())
+    elapsed = clock.monotonic() - start
+    # The declared cost is only a guess, so is replaced by the first measurement
+    self.latency = elapsed if self.runs == 0 else self.latency + self.ALPHA * (elapsed - self.latency)
+    self.runs += 1
+    self.hits += found
+    self.elapsed += elapsed
+    self.hit_rate += self.ALPHA * (found - self.hit_rate)
+    return found
+
+# Run detectors in order of expected time per device found, so that cheap,
+# productive detectors run first, stopping at the first to find a device.
+class DetectorPipeline(object):
+  def __init__(self, detectors, clock):
+    self.detectors = detectors
+    self.clock = clock
+
+  # Returns the detector that found a device, or None
+  def run(self):
+    for detector in sorted(self.detectors, key=lambda x: x.score()):
+      if detector.run(self.clock): return detector
+    return None
+
+  def summary(self):
+    return ", ".join(["%s %d/%d hits %.1f%% avg %.2f ms" %
+      (x.name, x.hits, x.runs, 100.0 * x.hits / x.runs if x.runs else 0,
+       1000 * x.elapsed / x.runs if x.runs else 0)
+      for x in sorted(self.detectors, key=lambda x: x.score())])
+
+# Shared by all sites in multi-site mode (--sites), so that each cycle of
+# checks reads the ARP cache once and pings each device at most once, however
+# many sites it belongs to. Sites also share the pinger and resolver cache.
+class SharedProbes(object):
+  def __init__(self):
+    self.pinger = None
+    self.resolver = None
+    self.histories = {}
+    self.new_cycle()
+    self.reads = 0
+    self.pinged = 0
+    self.reused = 0
+
+  def new_cycle(self):
+    self.arp = None
+    self.results = {}
+
+  def get_arp_cache(self, reader, fresh=False):
+    if self.arp is None or fresh:
+      self.arp = reader()
+      self.reads += 1
+    return self.arp
+
+  # As pinger.ping_hosts(first_reply=True), answering from the results of
+  # this cycle where possible. A host that has already replied this cycle is
+  # the winner without pinging anything.
+  def ping_hosts(self, pinger, ipaddresses, count, timeout, concurrency, fresh=False):
+    if fresh:
+      pending = ipaddresses
+    else:
+      for ipaddress in ipaddresses:
+        if ipaddress in self.results and self.results[ipaddress][1]:
+          self.reused += 1
+          return ({ipaddress: self.results[ipaddress]}, ipaddress)
+      pending = [x for x in ipaddresses if x not in self.results]
+
+    (results, winner) = pinger.ping_hosts(pending, count, timeout=timeout,
+                                          first_reply=True, concurrency=concurrency) if pending else ({}, None)
+    self.pinged += len(pending)
+    self.reused += len(ipaddresses) - len(pending)
+
+    # Keep all but abandoned results, which were never answered nor lost
+    for ipaddress in results:
+      if results[ipaddress][0] != 0 or results[ipaddress][3] != 0:
+        self.results[ipaddress] = results[ipaddress]
+
+    merged = dict([(x, self.results[x]) for x in ipaddresses if x in self.results])
+    merged.update(results)
+    return (merged, winner)
+
+  def summary(self):
+    return "%d ARP cache reads, %d hosts pinged, %d results shared" % (self.reads, self.pinged, self.reused)
+
+# A monitored device, as given on the command line. Devices monitored by MAC
+# address have an empty ip until one is learned from the ARP cache, while ip
+# is the hostname or IPv4 address of all other devices. address is the
+# resolved IPv4 address by which the device is indexed.
+class Device(object):
+  __slots__ = ("name", "mac", "ip", "address", "last_seen",
+               "reliability", "misses", "next_probe")
+
+  def __init__(self, name, mac="", ip=""):
+    self.name = name
+    self.mac = mac
+    self.ip = ip
+    self.address = None
+    self.last_seen = 0
+    self.reliability = 1.0
+    self.misses = 0
+    self.next_probe = 0
+
+  def __repr__(self):
+    return "Device(%s, mac=%s, ip=%s)" % (self.name, self.mac, self.ip)
+
+# Monitored devices, indexed by MAC and by IP address so that an ARP cache
+# snapshot can be applied in a single pass over the snapshot.
+class DeviceRegistry(object):
+  def __init__(self, devices):
+    self.devices = []
+    self.macs = []
+    self.by_mac = {}
+    self.by_address = {}
+    self._monitored = None
+
+    for name in devices:
+      if isMAC(name):
+        device = Device(name, mac=name.lower())
+        self.macs.append(device)
+        self.by_mac[device.mac] = device
+      else:
+        device = Device(name, ip=name)
+        if isIPv4(name) or isIPv6(name): self.set_address(device, name)
+      self.devices.append(device)
+
+  # Devices with a known hostname or IP address, in command line order
+  def monitored(self):
+    if self._monitored is None:
+      self._monitored = [x for x in self.devices if x.ip]
+    return self._monitored
+
+  # MAC devices without a learned IP address
+  def unresolved(self):
+    return [x for x in self.macs if not x.ip]
+
+  def set_address(self, device, address):
+    if device.address == address: return
+    if device.address:
+      others = self.by_address[device.address]
+      others.remove(device)
+      if not others: del self.by_address[device.address]
+    device.address = address
+    if address:
+      self.by_address.setdefault(address, []).append(device)
+
+  def learn(self, device, ip):
+    device.ip = ip
+    self.set_address(device, ip)
+    self._monitored = None
+
+  def unlearn(self, device):
+    device.ip = ""
+    self.set_address(device, None)
+    self._monitored = None
+
+  # Resolve hostnames using resolver(hostname) -> IPv4 address or None
+  def resolve(self, resolver):
+    for device in self.monitored():
+      if not device.mac and not isIPv4(device.ip) and not isIPv6(device.ip):
+        self.set_address(device, resolver(device.ip))
+
+  # Learn new IP addresses for monitored MACs, and forget any learned IP
+  # address now allocated to a different MAC. An IPv6 address is only learned
+  # by a device without an IPv4 address.
+  # Returns a list of (device, nic, learned) for each change made.
+  def learn_from_arp(self, arp):
+    changes = []
+    by_mac = self.by_mac
+    by_address = self.by_address
+    for nic in arp:
+      device = by_mac.get(nic["mac"])
+      if device and device.ip != nic["ip"] and not (":" in nic["ip"] and isIPv4(device.ip)):
+        self.learn(device, nic["ip"])
+        changes.append((device, nic, True))
+      others = by_address.get(nic["ip"])
+      if others:
+        for other in list(others):
+          if other.mac and other.mac != nic["mac"]:
+            self.unlearn(other)
+            changes.append((other, nic, False))
+    return changes
+
+  # Return the first monitored device present in the ARP cache, or None. A
+  # monitored MAC is also present when reachable by another address, such as
+  # an IPv6 address when its IPv4 address has been learned.
+  def find_in_arp(self, arp):
+    by_address = self.by_address
+    by_mac = self.by_mac
+    for nic in arp:
+      devices = by_address.get(nic["ip"])
+      if devices: return devices[0]
+      device = by_mac.get(nic["mac"])
+      if device and device.ip: return device
+    return None
+
+  # As find_in_arp, but against a NeighbourSnapshot, so the cost depends on
+  # the number of monitored devices rather than the size of the ARP cache.
+  def find_in_table(self, table):
+    by_ip = table.by_ip
+    by_mac = table.by_mac
+    for device in self.monitored():
+      if device.address in by_ip: return device
+      if device.mac and device.mac in by_mac: return device
+    return None
+
+# The ARP cache as of the previous check, indexed by IP and MAC address, so
+# that each new copy can be reduced to the entries added, removed or changed
+# since and registry updates cost in proportion to the churn in the ARP cache
+# rather than its size. Entries are compared by identity where possible, as
+# the netlink reader returns the same dict for a neighbour until it changes,
+# and otherwise (as for the arp and ip readers) by value.
+class NeighbourSnapshot(object):
+  key = staticmethod(operator.itemgetter("ip", "mac", "type"))
+  keys = staticmethod(getattr(dict, "viewkeys", dict.keys))
+
+  def __init__(self):
+    self.objects = {}
+    self.entries = set()
+    self.by_ip = {}
+    self.by_mac = {}
+    self.source = None
+
+  def __len__(self):
+    return len(self.by_ip)
+
+  def entry(self, ip):
+    (mac, type) = self.by_ip[ip]
+    return {"mac": mac, "ip": ip, "type": type}
+
+  # Replace the snapshot with arp (a list of ARP cache entries), and return
+  # the (added, removed, changed) entries. A changed entry has a new MAC
+  # address or state for the same IP address.
+  def update(self, arp):
+    if arp is self.source: return ([], [], [])
+    self.source = arp
+
+    # Holding the previous entries keeps their ids from being reused
+    current = dict(zip(map(id, arp), arp))
+    previous = self.objects
+    self.objects = current
+    if arp and id(arp[0]) in previous:
+      appeared = set(map(self.key, [current[x] for x in self.keys(current) - self.keys(previous)]))
+      vanished = set(map(self.key, [previous[x] for x in self.keys(previous) - self.keys(current)]))
+      (appeared, vanished) = (appeared - vanished, vanished - appeared)
+      self.entries -= vanished
+      self.entries |= appeared
+    else:
+      entries = set(map(self.key, arp))
+      (appeared, vanished) = (entries - self.entries, self.entries - entries)
+      self.entries = entries
+
+    by_ip = self.by_ip
+    by_mac = self.by_mac
+
+    gone = {}
+    for (ip, mac, type) in vanished:
+      gone[ip] = {"mac": mac, "ip": ip, "type": type}
+      by_ip.pop(ip, None)
+      self.unindex(ip, mac)
+
+    (added, changed) = ([], [])
+    for (ip, mac, type) in appeared:
+      nic = {"mac": mac, "ip": ip, "type": type}
+      if gone.pop(ip, None):
+        changed.append(nic)
+      else:
+        added.append(nic)
+      by_ip[ip] = (mac, type)
+      by_mac.setdefault(mac, set()).add(ip)
+
+    return (added, list(gone.values()), changed)
+
+  def unindex(self, ip, mac):
+    ips = self.by_mac.get(mac)
+    if ips is None: return
+    ips.discard(ip)
+    if not ips: del self.by_mac[mac]
+
+# Run the notify script in a background thread so that a slow or hung script
+# never blocks device monitoring. Only the most recent notification is kept
+# while waiting to run, so rapid here/away/here changes are coalesced into
+# the latest state (and dropped entirely if that state was the last one
+# delivered). Each run is killed after timeout seconds, and failed runs are
+# retried with exponential backoff unless superseded by a newer notification.
+class NotificationDispatcher(threading.Thread):
+  def __init__(self, notify, timeout=60, retries=3, logger=None):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.notify = notify
+    self.timeout = timeout
+    self.retries = retries
+    self.logger = logger
+
+    self.condition = threading.Condition()
+    self.pending = None
+    self.delivered = None
+    self.start()
+
+  def submit(self, args):
+    with self.condition:
+      if self.pending:
+        self.logger.debug("Coalescing notify [%s] into [%s]" % (self.pending[0], args[0]))
+      self.pending = args
+      self.condition.notify()
+
+  def run(self):
+    while not stopped.is_set():
+      with self.condition:
+        while self.pending is None:
+          self.condition.wait()
+        args = self.pending
+        self.pending = None
+
+      if args[0] == self.delivered:
+        self.logger.debug("Skipping notify [%s], already delivered" % args[0])
+        continue
+
+      for attempt in range(0, self.retries + 1):
+        if attempt:
+          backoff = 2 ** attempt
+          self.logger.log("Retrying notify [%s] in %d seconds (retry %d of %d)" % (args[0], backoff, attempt, self.retries))
+          with self.condition:
+            self.condition.wait(backoff)
+            if self.pending: break
+        with metrics.timer("autoaway_phase_seconds", phase="notify_script"):
+          delivered = self.execute(args)
+        metrics.count("autoaway_notify_runs_total", result="ok" if delivered else "failed")
+        if delivered:
+          self.delivered = args[0]
+          break
+
+  # Run the notify script, streaming its output to the log. Returns True on success.
+  def execute(self, args):
+    self.logger.debug("Calling notify [%s] with %s" %
+      (self.notify, ", ".join(["arg%d [%s]" % (i, x) for (i, x) in enumerate(args, 1)])))
+
+    metrics.count("autoaway_subprocesses_total", command="notify")
+
+    # Run in a new process group, so that any children are killed on timeout
+    try:
+      if sys.platform == "win32":
+        proc = subprocess.Popen([self.notify] + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+      else:
+        proc = subprocess.Popen([self.notify] + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                preexec_fn=os.setsid)
+    except OSError as e:
+      self.logger.log("Unable to execute notify [%s]: %s" % (self.notify, e))
+      return False
+
+    timer = threading.Timer(self.timeout, self.kill, [proc])
+    timer.start()
+    output = []
+    try:
+      for line in iter(proc.stdout.readline, b""):
+        line = line.decode("utf-8").rstrip("\r\n")
+        output.append(line)
+        self.logger.debug("** notify: %s" % line)
+      proc.wait()
+    finally:
+      timer.cancel()
+
+    if proc.returncode == 0: return True
+
+    self.logger.log("#### BEGIN EXCEPTION #####")
+    if proc.returncode < 0:
+      self.logger.log("Notify [%s] killed after %d seconds" % (self.notify, self.timeout))
+    else:
+      self.logger.log("Notify [%s] returned non-zero exit status %d" % (self.notify, proc.returncode))
+    self.logger.log("Output from notify follows:\n%s" % "\n".join(output))
+    self.logger.log("#### END EXCEPTION #####")
+    return False
+
+  def kill(self, proc):
+    try:
+      if sys.platform == "win32":
+        proc.kill()
+      else:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+      pass
+
+# Cache of hostname lookups with separate TTLs for successful (positive) and
+# failed (negative) lookups, evicting the least recently used entries once
+# maxsize is reached. Reverse lookups (socket.getfqdn) never block the caller,
+# and are performed by a background thread. The lookup functions may be
+# replaced, eg. by benchmark.py. Entries expire on the monotonic clock, so a
+# change to the system time neither expires nor pins them.
+class ResolverCache(object):
+  def __init__(self, ttl=300, negative_ttl=60, maxsize=256, lookup=None, reverse_lookup=None, clock=None):
+    self.clock = clock if clock else Clock()
+    self.ttl = int(ttl)
+    self.negative_ttl = int(negative_ttl)
+    self.maxsize = maxsize
+    self.lookup = lookup or socket.gethostbyname
+    self.reverse_lookup = reverse_lookup or socket.getfqdn
+    self.hits = self.misses = 0
+    self.reverse_hits = self.reverse_misses = 0
+
+    self.lock = threading.Lock()
+    self.forward_cache = collections.OrderedDict()
+    self.reverse_cache = collections.OrderedDict()
+    self.reverse_pending = set()
+    self.reverse_queue = Queue.Queue()
+    self.reverse_thread = None
+
+  # Return the IPv4 address of name, or None if it can't be resolved
+  def forward(self, name):
+    if isIPv4(name) or isIPv6(name): return name
+
+    with self.lock:
+      entry = self.get(self.forward_cache, name)
+    if entry:
+      self.hits += 1
+      metrics.count("autoaway_dns_cache_hits_total", kind="forward")
+      return entry[0]
+
+    self.misses += 1
+    try:
+      ipaddress = self.lookup(name)
+    except (socket.gaierror, socket.error):
+      ipaddress = None
+    metrics.count("autoaway_dns_lookups_total", kind="forward", result="ok" if ipaddress else "failed")
+
+    with self.lock:
+      self.put(self.forward_cache, name, ipaddress, self.ttl if ipaddress else self.negative_ttl)
+    return ipaddress
+
+  # Return the cached fully qualified name of name, or name itself when not
+  # yet known (in which case a background lookup is queued)
+  def reverse(self, name):
+    with self.lock:
+      entry = self.get(self.reverse_cache, name)
+      if entry:
+        self.reverse_hits += 1
+        metrics.count("autoaway_dns_cache_hits_total", kind="reverse")
+        return entry[0]
+      self.reverse_misses += 1
+      if name in self.reverse_pending: return name
+      self.reverse_pending.add(name)
+
+    if not self.reverse_thread:
+      self.reverse_thread = threading.Thread(target=self.reverse_worker)
+      self.reverse_thread.daemon = True
+      self.reverse_thread.start()
+    self.reverse_queue.put(name)
+    return name
+
+  def reverse_worker(self):
+    while not stopped.is_set():
+      name = self.reverse_queue.get()
+      try:
+        fqname = self.reverse_lookup(name)
+      except (socket.gaierror, socket.error):
+        fqname = None
+      except Exception as e:
+        printlog("Reverse lookup of %s failed: %s" % (name, e))
+        fqname = None
+      metrics.count("autoaway_dns_lookups_total", kind="reverse", result="ok" if fqname else "failed")
+      with self.lock:
+        self.put(self.reverse_cache, name, fqname or name, self.ttl if fqname else self.negative_ttl)
+        self.reverse_pending.discard(name)
+
+  # Caller must hold self.lock. Returns (value,) or None if absent or expired.
+  def get(self, cache, name):
+    entry = cache.pop(name, None)
+    if entry is None or entry[1] <= self.clock.monotonic(): return None
+    cache[name] = entry
+    return (entry[0],)
+
+  def put(self, cache, name, value, ttl):
+    cache.pop(name, None)
+    cache[name] = (value, self.clock.monotonic() + ttl)
+    while len(cache) > self.maxsize:
+      cache.popitem(last=False)
+
+  def summary(self):
+    return "%d hits, %d misses (reverse: %d hits, %d misses), %d entries" % \
+      (self.hits, self.misses, self.reverse_hits, self.reverse_misses,
+       len(self.forward_cache) + len(self.reverse_cache))
+
+# Per-device probe schedule for use while the property is occupied, when
+# only one device need reply. Each device's reply reliability is tracked as
+# an exponentially weighted average. Devices that fail to reply are backed
+# off for exponentially more checks (up to max_backoff checks), as are
+# devices just seen by a passive source such as the ARP cache. Next probe
+# times are held in a heap; stale entries are skipped when popped.
+class ProbeScheduler(object):
+  ALPHA    = 0.25
+  RELIABLE = 0.8
+
+  def __init__(self, devices, interval, max_backoff=8):
+    self.devices = devices
+    self.interval = interval
+    self.max_backoff = max(int(max_backoff), 1)
+    self.heap = []
+    self.counter = 0
+    for device in devices:
+      self.reschedule(device, 0)
+
+  def reschedule(self, device, when):
+    device.next_probe = when
+    self.counter += 1
+    heapq.heappush(self.heap, (when, self.counter, device))
+    if len(self.heap) > 4 * len(self.devices) + 16:
+      self.heap = [(x.next_probe, i, x) for (i, x) in enumerate(self.devices)]
+      heapq.heapify(self.heap)
+
+  # Remove and return the devices due a probe at now, most reliable and then
+  # most recently seen first. Every device returned must be rescheduled.
+  def due(self, now):
+    devices = []
+    while self.heap and self.heap[0][0] <= now:
+      (when, counter, device) = heapq.heappop(self.heap)
+      if when == device.next_probe and device not in devices:
+        devices.append(device)
+    return sorted(devices, key=lambda x: (x.reliability, x.last_seen), reverse=True)
+
+  # Record the result of a probe. Backoff is only applied while the property
+  # is occupied - otherwise every device remains due.
+  def record(self, device, replied, now, backoff):
+    device.reliability = (1 - self.ALPHA) * device.reliability + (self.ALPHA if replied else 0.0)
+    if replied:
+      device.misses = 0
+      device.last_seen = int(now)
+      self.reschedule(device, now)
+    else:
+      device.misses += 1
+      if backoff:
+        self.reschedule(device, now + self.backoff(device.misses))
+      else:
+        self.reschedule(device, now)
+
+  def seen(self, device, now):
+    device.misses = 0
+    self.reschedule(device, now + self.backoff(1))
+
+  # Delay until the next probe after the given number of misses, less half an
+  # interval so that a device due at the next check isn't missed due to jitter
+  def backoff(self, misses):
+    return self.interval * min(2 ** (misses - 1), self.max_backoff) - self.interval / 2.0
+
+  def describe(self, now):
+    lines = []
+    for device in sorted(self.devices, key=lambda x: x.next_probe):
+      wait = device.next_probe - now
+      lines.append("%s: reliability %.2f, %d %s, next probe %s" %
+        (device.name, device.reliability, device.misses, "miss" if device.misses == 1 else "misses",
+         "due" if wait <= 0 else "in %ds" % wait))
+    return lines
+
 # Simple ping thread so that an entire subnet can be sent ICMP requests
 # in a relatively short time using multiple threads, in order to populate
 # the ARP cache for MAC->IP resolution
@@ -530,6 +2206,7 @@ class MyPingThread(threading.Thread):
   def run(self):
     while not stopped.is_set() and not self.work_queue.empty():
       ipaddress = self.work_queue.get()
+      metrics.count("autoaway_subprocesses_total", command="ping")
       try:
         if sys.platform == "win32":
           response = subprocess.check_output(["ping", "-n", "2", "-w", "1000", ipaddress],
@@ -541,6 +2218,1208 @@ class MyPingThread(threading.Thread):
         pass
       self.work_queue.task_done()
 
+# Send ICMP echo requests and match replies in-process, rather than forking
+# "ping" and scraping its output. Uses an unprivileged ICMP datagram socket
+# where permitted (net.ipv4.ping_group_range), otherwise a raw socket.
+class ICMPPinger(object):
+  ICMP_ECHO_REPLY   = 0
+  ICMP_ECHO_REQUEST = 8
+  ICMP6_ECHO_REQUEST = 128
+  ICMP6_ECHO_REPLY  = 129
+  IPPROTO_ICMPV6    = getattr(socket, "IPPROTO_ICMPV6", 58)
+
+  ICMPHDR           = struct.Struct("!BBHHH")
+
+  def __init__(self):
+    try:
+      self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+      self.type = "icmp-dgram"
+    except (OSError, socket.error):
+      self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+      self.type = "icmp-raw"
+
+    # IPv6 addresses are pinged using an ICMPv6 socket of the same kind, when
+    # available. The kernel calculates ICMPv6 checksums, and never includes
+    # the IPv6 header in what is received.
+    self.sock6 = None
+    try:
+      kind = socket.SOCK_DGRAM if self.type == "icmp-dgram" else socket.SOCK_RAW
+      self.sock6 = socket.socket(socket.AF_INET6, kind, self.IPPROTO_ICMPV6)
+    except (OSError, socket.error, AttributeError):
+      pass
+
+    # The kernel rewrites the identifier of datagram sockets and only delivers
+    # our own replies, so the identifier only needs checking on raw sockets.
+    self.ident = os.getpid() & 0xFFFF
+    self.seq = random.randint(0, 0xFFFF)
+
+  def close(self):
+    self.sock.close()
+    if self.sock6: self.sock6.close()
+
+  def sockets(self):
+    return [self.sock, self.sock6] if self.sock6 else [self.sock]
+
+  def checksum(self, data):
+    data = bytearray(data)
+    if len(data) % 2: data.append(0)
+    total = sum(struct.unpack("!%dH" % (len(data) // 2), bytes(data)))
+    while total >> 16:
+      total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+  def next_seq(self):
+    self.seq = (self.seq + 1) & 0xFFFF
+    return self.seq
+
+  def send(self, ipaddress, seq):
+    payload = struct.pack("!d", time.time()) + b"autoaway.py"
+    if ":" in ipaddress:
+      if not self.sock6: raise socket.error("IPv6 ICMP socket unavailable")
+      header = self.ICMPHDR.pack(self.ICMP6_ECHO_REQUEST, 0, 0, self.ident, seq)
+      # Resolves the scope of link-local addresses, eg. fe80::1%eth0
+      addr = socket.getaddrinfo(ipaddress, 0, socket.AF_INET6)[0][4]
+      self.sock6.sendto(header + payload, addr)
+    else:
+      header = self.ICMPHDR.pack(self.ICMP_ECHO_REQUEST, 0, 0, self.ident, seq)
+      header = self.ICMPHDR.pack(self.ICMP_ECHO_REQUEST, 0, self.checksum(header + payload), self.ident, seq)
+      self.sock.sendto(header + payload, (ipaddress, 0))
+    metrics.count("autoaway_probes_sent_total")
+
+  # Read one packet from sock, returning (ipaddress, seq) if it is one of our
+  # echo replies, otherwise None. IPv6 addresses are returned without scope.
+  def receive(self, sock=None):
+    sock = sock or self.sock
+    (data, addr) = sock.recvfrom(2048)
+    offset = 0
+    if sock is self.sock6:
+      reply = self.ICMP6_ECHO_REPLY
+    else:
+      reply = self.ICMP_ECHO_REPLY
+      if self.type == "icmp-raw":
+        offset = (bytearray(data[:1])[0] & 0x0F) * 4
+    if len(data) < offset + self.ICMPHDR.size: return None
+    (icmp_type, code, csum, ident, seq) = self.ICMPHDR.unpack_from(data, offset)
+    if icmp_type != reply: return None
+    if self.type == "icmp-raw" and ident != self.ident: return None
+    return (addr[0].split("%")[0], seq)
+
+  # Send one echo request to a (multicast) address such as ff02::1%eth0 and
+  # return the addresses of all responders within timeout seconds
+  def discover(self, address, timeout=1.0):
+    seq = self.next_seq()
+    self.send(address, seq)
+    responders = set()
+    deadline = time.time() + timeout
+    while True:
+      remaining = deadline - time.time()
+      if remaining <= 0: break
+      for sock in select.select(self.sockets(), [], [], remaining)[0]:
+        try:
+          reply = self.receive(sock)
+        except (OSError, socket.error):
+          continue
+        if reply and reply[1] == seq:
+          responders.add(reply[0])
+          metrics.count("autoaway_probe_replies_total")
+    return responders
+
+  # Ping a single host count times, one request every interval seconds, and
+  # wait up to timeout seconds for the last reply.
+  # Returns (sent, received, lost, errors, pctloss, rtts) with rtts in seconds.
+  def ping(self, ipaddress, count=1, timeout=1.0, interval=0.2):
+    return self.ping_hosts([ipaddress], count, timeout, interval)[0][ipaddress]
+
+  # Ping several hosts in parallel from the one socket, starting at most
+  # concurrency hosts at a time in the order given. With first_reply, stop
+  # as soon as any host replies, abandoning the outstanding probes.
+  # Returns ({ipaddress: stats}, first host to reply or None); hosts that were
+  # never started are absent from the results.
+  def ping_hosts(self, ipaddresses, count=1, timeout=1.0, interval=0.2, first_reply=False, concurrency=None):
+    waiting = list(ipaddresses)
+    active = {}
+    results = {}
+    seqmap = {}
+    winner = None
+    concurrency = concurrency or len(waiting)
+
+    while waiting or active:
+      now = time.time()
+
+      while waiting and len(active) < concurrency:
+        ipaddress = waiting.pop(0)
+        if ipaddress not in active and ipaddress not in results:
+          active[ipaddress] = {"sent": 0, "errors": 0, "pending": {}, "rtts": [],
+                               "next_send": now, "deadline": now}
+
+      for ipaddress, probe in list(active.items()):
+        if probe["sent"] < count and now >= probe["next_send"]:
+          seq = self.next_seq()
+          try:
+            self.send(ipaddress, seq)
+            probe["pending"][seq] = now
+            seqmap[seq] = ipaddress
+          except (OSError, socket.error):
+            probe["errors"] += 1
+          probe["sent"] += 1
+          probe["next_send"] = now + interval
+          probe["deadline"] = now + timeout
+
+        if probe["sent"] == count and (not probe["pending"] or now >= probe["deadline"]):
+          results[ipaddress] = self.stats(active.pop(ipaddress), timeout)
+
+      if (winner and first_reply) or not active: continue
+
+      wait = min([p["next_send"] if p["sent"] < count else p["deadline"] for p in active.values()]) - now
+      readable = select.select(self.sockets(), [], [], max(wait, 0))[0]
+      if not readable: continue
+
+      try:
+        reply = self.receive(readable[0])
+      except (OSError, socket.error):
+        continue
+      if not reply: continue
+
+      (replied, seq) = reply
+      ipaddress = seqmap.get(seq)
+      probe = active.get(ipaddress) if ipaddress and ipaddress.split("%")[0] == replied else None
+      if probe and seq in probe["pending"]:
+        probe["rtts"].append(time.time() - probe["pending"].pop(seq))
+        metrics.count("autoaway_probe_replies_total")
+        if winner is None: winner = ipaddress
+        if first_reply: break
+
+    for ipaddress, probe in active.items():
+      results[ipaddress] = self.stats(probe, timeout)
+
+    return (results, winner)
+
+  # Send one echo request to each host at rate requests per second and count
+  # the replies, waiting up to timeout seconds after the last request. After
+  # each packet progress(sent, replies) is called, and the sweep stops early
+  # should it return True.
+  # Returns (sent, replies, elapsed, stopped early)
+  def sweep(self, ipaddresses, rate=100, timeout=1.0, progress=None):
+    outstanding = {}
+    sent = replies = 0
+    start = next_send = time.time()
+    interval = 1.0 / rate
+
+    while True:
+      now = time.time()
+      while sent < len(ipaddresses) and now >= next_send:
+        seq = self.next_seq()
+        try:
+          self.send(ipaddresses[sent], seq)
+          outstanding[seq] = ipaddresses[sent]
+        except (OSError, socket.error):
+          pass
+        sent += 1
+        next_send += interval
+
+      if sent == len(ipaddresses) and (not outstanding or now >= next_send - interval + timeout): break
+
+      if progress and progress(sent, replies):
+        return (sent, replies, time.time() - start, True)
+
+      wait = next_send - now if sent < len(ipaddresses) else next_send - interval + timeout - now
+      if not select.select([self.sock], [], [], min(max(wait, 0), 0.25))[0]: continue
+
+      try:
+        reply = self.receive()
+      except (OSError, socket.error):
+        continue
+      if reply and outstanding.get(reply[1]) == reply[0]:
+        del outstanding[reply[1]]
+        replies += 1
+        metrics.count("autoaway_probe_replies_total")
+
+    return (sent, replies, time.time() - start, False)
+
+  # Requests abandoned before their timeout expired are not counted as sent
+  def stats(self, probe, timeout):
+    now = time.time()
+    sent = probe["sent"] - len([x for x in probe["pending"].values() if now < x + timeout])
+    received = len(probe["rtts"])
+    lost = sent - received
+    pctloss = int(100 * (1 - (float(received) / float(sent)))) if sent else 0
+    return (sent, received, lost, probe["errors"], pctloss, probe["rtts"])
+
+# Fallback for ping_hosts() when ICMP sockets are unavailable: run one "ping"
+# process per host from a bounded pool of threads, killing any outstanding
+# processes once the first reply arrives (when first_reply is requested).
+class SubprocessPinger(object):
+  def __init__(self, parse):
+    self.parse = parse
+    self.type = "ping"
+
+  def command(self, ipaddress, count, timeout=1.0):
+    if sys.platform == "win32":
+      return ["ping", "-n", "%d" % count, "-w", "%d" % int(timeout * 1000), ipaddress]
+    else:
+      return ["ping", "-c", "%d" % count, "-W", "%d" % max(int(timeout), 1), ipaddress]
+
+  def ping_hosts(self, ipaddresses, count=1, timeout=1.0, first_reply=False, concurrency=None):
+    work_queue = Queue.Queue()
+    for ipaddress in ipaddresses:
+      work_queue.put(ipaddress)
+
+    lock = threading.Lock()
+    finished = threading.Event()
+    processes = {}
+    results = {}
+    winner = []
+
+    def worker():
+      while not finished.is_set():
+        try:
+          ipaddress = work_queue.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          metrics.count("autoaway_subprocesses_total", command="ping")
+          proc = subprocess.Popen(self.command(ipaddress, count, timeout),
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError:
+          results[ipaddress] = (0, 0, 0, 1, 0, [])
+          continue
+        with lock:
+          processes[ipaddress] = proc
+        if finished.is_set(): proc.kill()
+        response = proc.communicate()[0].decode("utf-8")
+        with lock:
+          del processes[ipaddress]
+          results[ipaddress] = self.parse(response) + ([],)
+          metrics.count("autoaway_probes_sent_total", results[ipaddress][0])
+          metrics.count("autoaway_probe_replies_total", results[ipaddress][1])
+          if results[ipaddress][1] != 0 and not winner:
+            winner.append(ipaddress)
+            if first_reply:
+              finished.set()
+              for other in processes.values():
+                try:
+                  other.kill()
+                except OSError:
+                  pass
+
+    threads = [threading.Thread(target=worker) for i in range(min(concurrency or len(ipaddresses), len(ipaddresses)))]
+    for t in threads:
+      t.daemon = True
+      t.start()
+    for t in threads: t.join()
+
+    return (results, winner[0] if winner else None)
+
+# Listen for rtnetlink neighbour notifications (RTNLGRP_NEIGH) and pass each
+# new or changed neighbour entry to callback.
+class NeighbourMonitor(threading.Thread):
+  RTMGRP_NEIGH = 0x4
+
+  def __init__(self, callback):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.callback = callback
+    self.table = NeighbourTable()
+    self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 0)
+    self.sock.bind((0, self.RTMGRP_NEIGH))
+
+  def run(self):
+    while not stopped.is_set():
+      try:
+        data = self.sock.recv(65536)
+        for nic in self.table.parse(data)[1]:
+          self.callback(nic)
+      except (OSError, socket.error, ValueError, struct.error):
+        time.sleep(1)
+
+# Read the Linux kernel neighbour (ARP) table in-process using an rtnetlink
+# RTM_GETNEIGH dump, avoiding a fork/exec of "ip neighbor list" per check.
+# Each dump returns the same dict as the previous dump for any neighbour whose
+# address and state are unchanged, without parsing it again.
+class NeighbourTable(object):
+  NLMSG_ERROR   = 2
+  NLMSG_DONE    = 3
+  RTM_NEWNEIGH  = 28
+  RTM_GETNEIGH  = 30
+  NLM_F_REQUEST = 0x001
+  NLM_F_DUMP    = 0x300
+
+  NDA_DST       = 1
+  NDA_LLADDR    = 2
+  NDA_IDENTITY  = (NDA_DST, NDA_LLADDR)
+
+  NLMSGHDR      = struct.Struct("=LHHLL")
+  NDMSG         = struct.Struct("=BxxxiHBB")
+  RTATTR        = struct.Struct("=HH")
+
+  NUD_STATES    = {0x01: "INCOMPLETE", 0x02: "REACHABLE", 0x04: "STALE", 0x08: "DELAY",
+                   0x10: "PROBE", 0x20: "FAILED", 0x40: "NOARP", 0x80: "PERMANENT"}
+
+  def __init__(self, family=socket.AF_INET):
+    self.family = family
+    self.seq = 0
+    self.parsed = {}
+    self.parsing = None
+
+  # Return a list of {"mac", "ip", "type"} dicts, where type is the NUD state
+  # name as reported by "ip neighbor list" (eg. REACHABLE, STALE).
+  def dump(self):
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 0)
+    try:
+      sock.bind((0, 0))
+      self.seq += 1
+      request = self.NLMSGHDR.pack(self.NLMSGHDR.size + self.NDMSG.size, self.RTM_GETNEIGH,
+                                   self.NLM_F_REQUEST | self.NLM_F_DUMP, self.seq, 0) + \
+                self.NDMSG.pack(self.family, 0, 0, 0, 0)
+      sock.sendto(request, (0, 0))
+
+      neighbours = []
+      self.parsing = {}
+      while True:
+        data = sock.recv(65536)
+        if not data: break
+        done, entries = self.parse(data)
+        neighbours.extend(entries)
+        if done: break
+      self.parsed = self.parsing
+      return neighbours
+    finally:
+      self.parsing = None
+      sock.close()
+
+  # Parse a buffer of netlink messages, returning (done, entries)
+  def parse(self, data):
+    entries = []
+    offset = 0
+    while offset + self.NLMSGHDR.size <= len(data):
+      (msg_len, msg_type, flags, seq, pid) = self.NLMSGHDR.unpack_from(data, offset)
+      if msg_len < self.NLMSGHDR.size: break
+      if msg_type == self.NLMSG_DONE:
+        return (True, entries)
+      elif msg_type == self.NLMSG_ERROR:
+        (errno,) = struct.unpack_from("=i", data, offset + self.NLMSGHDR.size)
+        if errno != 0:
+          raise OSError(-errno, os.strerror(-errno))
+        return (True, entries)
+      elif msg_type == self.RTM_NEWNEIGH:
+        if self.parsing is None:
+          entry = self.parse_neighbour(data, offset + self.NLMSGHDR.size, offset + msg_len)
+        else:
+          key = self.identity(data, offset + self.NLMSGHDR.size, offset + msg_len)
+          entry = self.parsed.get(key, False)
+          if entry is False:
+            entry = self.parse_neighbour(data, offset + self.NLMSGHDR.size, offset + msg_len)
+          self.parsing[key] = entry
+        if entry: entries.append(entry)
+      offset += (msg_len + 3) & ~3
+    return (False, entries)
+
+  # The ndmsg header (including the NUD state) and the address attributes of
+  # a neighbour message, which the kernel puts ahead of the NDA_PROBES and
+  # NDA_CACHEINFO counters that change with every dump
+  def identity(self, data, offset, end):
+    pos = offset + self.NDMSG.size
+    while pos + self.RTATTR.size <= end:
+      (rta_len, rta_type) = self.RTATTR.unpack_from(data, pos)
+      if rta_len < self.RTATTR.size or rta_type not in self.NDA_IDENTITY: break
+      pos += (rta_len + 3) & ~3
+    return data[offset:pos]
+
+  def parse_neighbour(self, data, offset, end):
+    (family, ifindex, state, flags, ntype) = self.NDMSG.unpack_from(data, offset)
+    offset += self.NDMSG.size
+
+    ip = mac = None
+    while offset + self.RTATTR.size <= end:
+      (rta_len, rta_type) = self.RTATTR.unpack_from(data, offset)
+      if rta_len < self.RTATTR.size: break
+      value = data[offset + self.RTATTR.size:offset + rta_len]
+      if rta_type == self.NDA_DST:
+        ip = socket.inet_ntop(family, value)
+      elif rta_type == self.NDA_LLADDR and len(value) == 6:
+        mac = ":".join(["%02x" % b for b in bytearray(value)])
+      offset += (rta_len + 3) & ~3
+
+    if not ip or not mac: return None
+
+    # Link-local IPv6 addresses are only usable with the interface as scope
+    if family == socket.AF_INET6 and ip.lower().startswith("fe80:"):
+      ip = "%s%%%s" % (ip, self.interface_name(ifindex))
+
+    return {"mac": mac, "ip": ip, "type": self.NUD_STATES.get(state, "NONE"), "ifindex": ifindex}
+
+  def interface_name(self, ifindex):
+    try:
+      return socket.if_indextoname(ifindex)
+    except (AttributeError, OSError, socket.error):
+      return "%d" % ifindex
+
+# Active DHCP leases read from a dnsmasq or ISC dhcpd lease file, returned as
+# {"mac", "ip", "type"} dicts in the same form as the ARP cache, where type is
+# "LEASED" for leases already present when first read and "RENEWED" for any
+# new or renewed lease seen since (the device has just spoken to the DHCP
+# server). dnsmasq rewrites its small lease file in place, so it is re-read in
+# full and compared with the previous leases. dhcpd appends to its lease file
+# as a journal (periodically replacing it), so only the lease declarations
+# appended since the last read are parsed.
+class LeaseFile(object):
+  def __init__(self, filename):
+    self.filename = filename
+    self.format = None
+    self.leases = {}
+    self.loaded = False
+    self.inode = None
+    self.offset = 0
+    self.partial = ""
+
+  def read(self, now=None):
+    now = now if now is not None else time.time()
+    try:
+      st = os.stat(self.filename)
+      with open(self.filename, "rb") as f:
+        if self.format == "dhcpd" and st.st_ino == self.inode and st.st_size >= self.offset:
+          f.seek(self.offset)
+        else:
+          self.offset = 0
+          self.partial = ""
+        data = f.read()
+    except (IOError, OSError):
+      return []
+
+    # The offset is in bytes, while hostnames may be in any encoding
+    self.inode = st.st_ino
+    self.offset += len(data)
+    data = data.decode("utf-8", "replace")
+    if self.format is None:
+      self.format = "dhcpd" if re.search(r"^\s*lease\s", data, re.MULTILINE) else "dnsmasq"
+
+    if self.format == "dnsmasq":
+      leases = self.parse_dnsmasq(data, now)
+    else:
+      leases = self.parse_dhcpd(data, now)
+
+    changes = []
+    for mac in leases:
+      (ip, stamp) = leases[mac]
+      previous = self.leases.get(mac)
+      if previous != (ip, stamp):
+        renewed = self.loaded and (previous is None or previous[0] != ip or previous[1] < stamp)
+        changes.append({"mac": mac, "ip": ip, "type": "RENEWED" if renewed else "LEASED"})
+        self.leases[mac] = (ip, stamp)
+    self.loaded = True
+    return changes
+
+  # "<expiry> <mac> <ip> <hostname> <client-id>", where expiry 0 is infinite
+  def parse_dnsmasq(self, data, now):
+    leases = {}
+    for line in data.splitlines():
+      fields = line.split()
+      if len(fields) < 3 or not isMAC(fields[1]) or not isIPv4(fields[2]): continue
+      try:
+        expiry = int(fields[0])
+      except ValueError:
+        continue
+      if expiry == 0 or expiry > now:
+        leases[fields[1].lower()] = (fields[2], expiry)
+    return leases
+
+  # "lease <ip> { starts <wday> <yyyy/mm/dd hh:mm:ss>; ends ...; binding state
+  # active; hardware ethernet <mac>; ... }", with times in UTC
+  def parse_dhcpd(self, data, now):
+    data = self.partial + data
+    end = data.rfind("}")
+    self.partial = data[end + 1:]
+
+    leases = {}
+    for (ip, body) in re.findall(r"lease\s+([0-9.]+)\s*\{([^}]*)\}", data[:end + 1]):
+      mac = re.search(r"hardware\s+ethernet\s+([0-9a-fA-F:]+)\s*;", body)
+      state = re.search(r"(?<!next )binding\s+state\s+(\w+)\s*;", body)
+      if not mac or (state and state.group(1) != "active"): continue
+      ends = re.search(r"ends\s+(?:\d\s+(\d+/\d+/\d+\s+\d+:\d+:\d+)|never)\s*;", body)
+      if ends and ends.group(1) and self.dhcpd_time(ends.group(1)) <= now: continue
+      starts = re.search(r"starts\s+\d\s+(\d+/\d+/\d+\s+\d+:\d+:\d+)\s*;", body)
+      leases[mac.group(1).lower()] = (ip, self.dhcpd_time(starts.group(1)) if starts else 0)
+    return leases
+
+  def dhcpd_time(self, value):
+    return calendar.timegm(time.strptime(value, "%Y/%m/%d %H:%M:%S"))
+
+# Minimal inotify(7) binding using ctypes (Linux only)
+class Inotify(object):
+  IN_MODIFY      = 0x00000002
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_TO    = 0x00000080
+  IN_CREATE      = 0x00000100
+
+  EVENT          = struct.Struct("=iIII")
+
+  def __init__(self):
+    import ctypes
+    import ctypes.util
+    self.ctypes = ctypes
+    self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    self.fd = self.libc.inotify_init()
+    if self.fd < 0: self.error()
+
+  def error(self):
+    errno = self.ctypes.get_errno()
+    raise OSError(errno, os.strerror(errno))
+
+  def add_watch(self, path, mask):
+    if not isinstance(path, bytes): path = path.encode(sys.getfilesystemencoding())
+    wd = self.libc.inotify_add_watch(self.fd, path, mask)
+    if wd < 0: self.error()
+    return wd
+
+  # Block until events are available, returning a list of (wd, mask, name)
+  def read(self):
+    data = os.read(self.fd, 65536)
+    events = []
+    offset = 0
+    while offset + self.EVENT.size <= len(data):
+      (wd, mask, cookie, length) = self.EVENT.unpack_from(data, offset)
+      offset += self.EVENT.size
+      name = data[offset:offset + length].rstrip(b"\0").decode(sys.getfilesystemencoding(), "replace")
+      offset += length
+      events.append((wd, mask, name))
+    return events
+
+  def pending(self, timeout):
+    return bool(select.select([self.fd], [], [], timeout)[0])
+
+# Re-read a lease file whenever it changes, calling callback(leases) with any
+# new or renewed leases. The directory is watched with inotify, as lease files
+# are often replaced by renaming, falling back to polling with stat.
+class LeaseWatcher(threading.Thread):
+  POLL_INTERVAL = 5.0
+  SETTLE = 0.2
+
+  def __init__(self, lease, callback):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.lease = lease
+    self.callback = callback
+    self.inotify = None
+    try:
+      self.inotify = Inotify()
+      self.inotify.add_watch(os.path.dirname(os.path.abspath(lease.filename)),
+                             Inotify.IN_MODIFY | Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_CREATE)
+    except (OSError, AttributeError):
+      self.inotify = None
+    self.type = "inotify" if self.inotify else "polling"
+
+  def run(self):
+    name = os.path.basename(self.lease.filename)
+    last = self.stat()
+    while not stopped.is_set():
+      try:
+        if self.inotify:
+          if name not in [x[2] for x in self.inotify.read()]: continue
+          # Wait for the writer to finish, collecting any further events
+          while self.inotify.pending(self.SETTLE):
+            self.inotify.read()
+        else:
+          time.sleep(self.POLL_INTERVAL)
+          current = self.stat()
+          if current == last: continue
+          last = current
+
+        leases = self.lease.read()
+        if leases: self.callback(leases)
+      except (OSError, IOError, ValueError, select.error):
+        time.sleep(1)
+
+  def stat(self):
+    try:
+      st = os.stat(self.lease.filename)
+      return (st.st_ino, st.st_size, st.st_mtime)
+    except OSError:
+      return None
+
+# Decode the sender of an ARP packet, or the client of a DHCP (BOOTP) request,
+# from an Ethernet frame held in a bytearray. Only the few header bytes needed
+# are read, and no copies are made until a frame is known to be of interest.
+# Returns (kind, mac, ip) with mac and ip as packed bytes, or None.
+class PacketDecoder(object):
+  ETH_P_IP    = 0x0800
+  ETH_P_ARP   = 0x0806
+  ETH_P_8021Q = 0x8100
+  DHCP_MAGIC  = b"\x63\x82\x53\x63"
+  DHCP_REQUESTED_IP = 50
+
+  def decode(self, buf, length):
+    if length < 42: return None
+    offset = 14
+    ethertype = (buf[12] << 8) | buf[13]
+    if ethertype == self.ETH_P_8021Q:
+      ethertype = (buf[16] << 8) | buf[17]
+      offset = 18
+
+    # ARP sender hardware and protocol address
+    if ethertype == self.ETH_P_ARP:
+      if length < offset + 18: return None
+      return ("ARP", bytes(buf[offset + 8:offset + 14]), bytes(buf[offset + 14:offset + 18]))
+
+    # UDP to port 67 (DHCP server), first fragment only, of a BOOTREQUEST:
+    # client hardware address (chaddr) and client IP address (ciaddr), or
+    # the requested IP address when the client has none yet
+    if ethertype == self.ETH_P_IP:
+      if buf[offset + 9] != 17 or (buf[offset + 6] & 0x1F) or buf[offset + 7]: return None
+      udp = offset + (buf[offset] & 0x0F) * 4
+      bootp = udp + 8
+      if length < bootp + 34 or buf[udp + 2] != 0 or buf[udp + 3] != 67 or buf[bootp] != 1: return None
+      ip = bytes(buf[bootp + 12:bootp + 16])
+      if ip == b"\0\0\0\0":
+        ip = self.requested_ip(buf, bootp + 240, length) or ip
+      return ("DHCP", bytes(buf[bootp + 28:bootp + 34]), ip)
+
+    return None
+
+  # Find the requested IP address option in the DHCP options starting at
+  # offset, after the magic cookie, or None
+  def requested_ip(self, buf, offset, length):
+    if length < offset or buf[offset - 4:offset] != self.DHCP_MAGIC: return None
+    while offset + 1 < length:
+      option = buf[offset]
+      if option == 255: return None
+      if option == 0:
+        offset += 1
+        continue
+      size = buf[offset + 1]
+      if option == self.DHCP_REQUESTED_IP and size == 4 and offset + 6 <= length:
+        return bytes(buf[offset + 2:offset + 6])
+      offset += 2 + size
+    return None
+
+# Listen for ARP and DHCP packets on all interfaces using an AF_PACKET socket
+# (Linux only, requires root or CAP_NET_RAW), calling callback([entry]) when a
+# monitored MAC or IP address is the sender. A classic BPF filter passes only
+# ARP and DHCP request frames, truncated to SNAPLEN bytes, to user space so
+# other traffic costs nothing. When the filter can't be attached, only ARP is
+# received. Each frame is received into the same preallocated buffer.
+class PacketListener(threading.Thread):
+  ETH_P_ALL = 0x0003
+  SO_ATTACH_FILTER = 26
+  SNAPLEN = 512
+  HOLDOFF = 10.0
+
+  # arp or (udp dst port 67 and not a later fragment)
+  FILTER = [(0x28, 0, 0, 12),        # ldh [12]
+            (0x15, 8, 0, 0x0806),    # jeq #ETH_P_ARP, accept
+            (0x15, 0, 8, 0x0800),    # jeq #ETH_P_IP, next, drop
+            (0x30, 0, 0, 23),        # ldb [23]
+            (0x15, 0, 6, 17),        # jeq #IPPROTO_UDP, next, drop
+            (0x28, 0, 0, 20),        # ldh [20]
+            (0x45, 4, 0, 0x1FFF),    # jset #0x1fff, drop
+            (0xb1, 0, 0, 14),        # ldxb 4*([14]&0xf)
+            (0x48, 0, 0, 16),        # ldh [x + 16]
+            (0x15, 0, 1, 67),        # jeq #67, accept, drop
+            (0x06, 0, 0, SNAPLEN),   # accept: ret #SNAPLEN
+            (0x06, 0, 0, 0)]         # drop: ret #0
+
+  def __init__(self, callback):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.callback = callback
+    self.decoder = PacketDecoder()
+    self.buf = bytearray(self.SNAPLEN)
+    self.watch_macs = set()
+    self.watch_ips = set()
+    self.reported = {}
+    self.packets = 0
+
+    try:
+      self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(self.ETH_P_ALL))
+      self.attach_filter()
+      self.type = "arp+dhcp"
+    except (OSError, socket.error, AttributeError, ImportError):
+      self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(PacketDecoder.ETH_P_ARP))
+      self.type = "arp"
+
+  def attach_filter(self):
+    import ctypes
+    program = b"".join([struct.pack("=HBBI", *x) for x in self.FILTER])
+    self.program = ctypes.create_string_buffer(program)
+    fprog = struct.pack("HL", len(self.FILTER), ctypes.addressof(self.program))
+    self.sock.setsockopt(socket.SOL_SOCKET, self.SO_ATTACH_FILTER, fprog)
+
+  # Set the MAC and IP addresses to report, replacing any previous set
+  def watch(self, macs, ips):
+    self.watch_macs = set([bytes(bytearray([int(x, 16) for x in mac.split(":")])) for mac in macs])
+    self.watch_ips = set([socket.inet_aton(ip) for ip in ips if isIPv4(ip)])
+
+  def run(self):
+    buf = self.buf
+    decode = self.decoder.decode
+    while not stopped.is_set():
+      try:
+        length = self.sock.recv_into(buf)
+      except (OSError, socket.error):
+        time.sleep(1)
+        continue
+      self.packets += 1
+      result = decode(buf, length)
+      if result is None: continue
+      (kind, mac, ip) = result
+      if mac not in self.watch_macs and ip not in self.watch_ips: continue
+
+      # Only report each sender once every HOLDOFF seconds
+      now = time.time()
+      if now - self.reported.get(mac, 0) < self.HOLDOFF: continue
+      self.reported[mac] = now
+
+      self.callback([{"mac": ":".join(["%02x" % x for x in bytearray(mac)]),
+                      "ip": socket.inet_ntoa(ip) if ip != b"\0\0\0\0" else "",
+                      "type": kind}])
+
+# History of device presence and occupancy changes, kept as fixed-size binary
+# records of (time, name, event, source) after a 16 byte header. name indexes
+# the list of device and site names held as JSON in FILENAME.names, or is
+# NO_NAME for events of the whole process and of a single site. Records are
+# in time order, so the records in a time range are found by bisecting the
+# memory-mapped file without reading anything outside the range.
+class HistoryFile(object):
+  MAGIC = b"AAHIST\x00\x01"
+  HEADER = struct.Struct("<8sH6x")
+  RECORD = struct.Struct("<dHBB")
+  NO_NAME = 0xFFFF
+
+  EVENTS = ["start", "seen", "missed", "occupied", "vacant", "grace", "returned"]
+  SOURCES = ["", "ping", "arp", "lease", "arp-packet", "dhcp-packet"]
+  (START, SEEN, MISSED, OCCUPIED, VACANT, GRACE, RETURNED) = range(len(EVENTS))
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.names_file = "%s.names" % filename
+    self.names = self.read_names()
+    self.file = None
+    self.map = None
+    self.count = 0
+
+  def __enter__(self):
+    return self.open()
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __len__(self):
+    return self.count
+
+  def read_names(self):
+    try:
+      with open(self.names_file, "r") as f:
+        return json.load(f)
+    except (IOError, OSError, ValueError):
+      return []
+
+  # Write the names atomically, by renaming a completed temporary file
+  def write_names(self, names):
+    tmpfile = "%s.tmp" % self.names_file
+    with open(tmpfile, "w") as f:
+      json.dump(names, f)
+      f.flush()
+      os.fsync(f.fileno())
+    if sys.platform == "win32" and os.path.exists(self.names_file):
+      os.remove(self.names_file)
+    os.rename(tmpfile, self.names_file)
+    self.names = list(names)
+
+  def name(self, index):
+    if index == self.NO_NAME: return None
+    return self.names[index] if index < len(self.names) else "#%d" % index
+
+  def check_header(self, header):
+    if len(header) != self.HEADER.size or self.HEADER.unpack(header) != (self.MAGIC, self.RECORD.size):
+      raise ValueError("%s is not a history file" % self.filename)
+
+  # Create the file, or check an existing file and drop any partial record
+  # left by an interrupted write. Returns the time of the last record.
+  def prepare(self):
+    if not os.path.exists(self.filename) or os.path.getsize(self.filename) == 0:
+      with open(self.filename, "wb") as f:
+        f.write(self.HEADER.pack(self.MAGIC, self.RECORD.size))
+      return 0
+
+    with open(self.filename, "r+b") as f:
+      self.check_header(f.read(self.HEADER.size))
+      size = os.fstat(f.fileno()).st_size
+      end = size - (size - self.HEADER.size) % self.RECORD.size
+      if end != size:
+        f.truncate(end)
+      if end == self.HEADER.size: return 0
+      f.seek(end - self.RECORD.size)
+      return self.RECORD.unpack(f.read(self.RECORD.size))[0]
+
+  # Map the file for reading
+  def open(self):
+    self.file = open(self.filename, "rb")
+    self.check_header(self.file.read(self.HEADER.size))
+    size = os.fstat(self.file.fileno()).st_size
+    self.count = (size - self.HEADER.size) // self.RECORD.size
+    if self.count:
+      import mmap
+      self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    return self
+
+  def close(self):
+    if self.map: self.map.close()
+    if self.file: self.file.close()
+    (self.map, self.file, self.count) = (None, None, 0)
+
+  # The record at index, as (time, name, event, source)
+  def record(self, index):
+    return self.RECORD.unpack_from(self.map, self.HEADER.size + index * self.RECORD.size)
+
+  # Index of the first record at or after when
+  def find(self, when):
+    (lo, hi) = (0, self.count)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.record(mid)[0] < when:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  # Records from index start up to (not including) end
+  def records(self, start=0, end=None):
+    end = self.count if end is None else min(end, self.count)
+    if start >= end: return []
+    data = self.map[self.HEADER.size + start * self.RECORD.size:self.HEADER.size + end * self.RECORD.size]
+    if hasattr(self.RECORD, "iter_unpack"):
+      return self.RECORD.iter_unpack(data)
+    return [self.RECORD.unpack_from(data, x) for x in range(0, len(data), self.RECORD.size)]
+
+  # Records from since up to (not including) until
+  def between(self, since, until):
+    return self.records(self.find(since), self.find(until))
+
+  # Drop redundant records: a device seen again within gap seconds of the
+  # previous record kept when its next record is also a sighting within gap
+  # seconds of that, and a device missed again without being seen in between.
+  # Presence intervals are unchanged for any gap of at least this gap.
+  def thin(self, records, gap):
+    following = [None] * len(records)
+    after = {}
+    for index in range(len(records) - 1, -1, -1):
+      (when, name, event, source) = records[index]
+      if event == self.START:
+        after = {}
+      elif event in (self.SEEN, self.MISSED):
+        following[index] = after.get(name)
+        after[name] = records[index]
+
+    kept = []
+    last = {}
+    for (index, record) in enumerate(records):
+      (when, name, event, source) = record
+      if event == self.START:
+        last = {}
+      elif event in (self.SEEN, self.MISSED):
+        previous = last.get(name)
+        if previous and previous[2] == event:
+          if event == self.MISSED: continue
+          next = following[index]
+          if next and next[2] == self.SEEN and next[0] - previous[0] <= gap: continue
+        last[name] = record
+      kept.append(record)
+    return kept
+
+  # Rewrite the file without redundant records (see thin), records before
+  # since and, keeping the most recent, more than max_records records.
+  # Returns the number of records (before, after).
+  def compact(self, gap, since=None, max_records=None):
+    with self:
+      records = list(self.records())
+    before = len(records)
+
+    records = self.thin(records, gap)
+    if since is not None:
+      records = [x for x in records if x[0] >= since]
+    if max_records is not None and len(records) > max_records:
+      records = records[len(records) - max_records:]
+
+    tmpfile = "%s.tmp" % self.filename
+    with open(tmpfile, "wb") as f:
+      f.write(self.HEADER.pack(self.MAGIC, self.RECORD.size))
+      f.write(b"".join([self.RECORD.pack(*x) for x in records]))
+      f.flush()
+      os.fsync(f.fileno())
+    if sys.platform == "win32":
+      os.remove(self.filename)
+    os.rename(tmpfile, self.filename)
+    return (before, len(records))
+
+# Buffered appends to a HistoryFile, written in one go when an occupancy
+# change is recorded, once BUFFER_RECORDS have accumulated or when the oldest
+# is FLUSH_SECS old, to keep writes to an SD card to a minimum. A device being
+# missed is only recorded when it wasn't already missed. The file is opened
+# for each write, so it can be compacted from the command line while in use.
+#
+# Once the file grows beyond max_size bytes it is compacted, and should it
+# still be over three quarters of max_size the oldest records are dropped to
+# bring it down to half.
+class HistoryWriter(object):
+  BUFFER_RECORDS = 256
+  FLUSH_SECS = 300
+  COMPACT_GAP = 900
+  FLUSH_EVENTS = (HistoryFile.START, HistoryFile.OCCUPIED, HistoryFile.VACANT)
+
+  def __init__(self, filename, max_size=1024*1024, clock=None, log=None):
+    self.history = HistoryFile(filename)
+    self.max_size = max_size
+    self.clock = clock if clock else Clock()
+    self.log = log if log else printlog
+    self.lock = threading.Lock()
+    self.buffer = []
+    self.buffered_at = 0
+    self.missed = set()
+    self.index = dict([(x, i) for (i, x) in enumerate(self.history.names)])
+    self.last_time = self.history.prepare()
+    atexit.register(self.flush)
+    self.record("start")
+
+  # Record event for name (a device or site name, or None), found by source
+  def record(self, event, name=None, source=""):
+    event = HistoryFile.EVENTS.index(event)
+    with self.lock:
+      index = self.name_index(name)
+      if event == HistoryFile.MISSED:
+        if index in self.missed: return
+        self.missed.add(index)
+      elif event == HistoryFile.SEEN:
+        self.missed.discard(index)
+
+      # Keep records in time order, should the wall clock go backwards
+      now = max(self.clock.time(), self.last_time)
+      self.last_time = now
+      if not self.buffer: self.buffered_at = now
+      self.buffer.append(HistoryFile.RECORD.pack(now, index, event, HistoryFile.SOURCES.index(source)))
+      due = event in self.FLUSH_EVENTS or len(self.buffer) >= self.BUFFER_RECORDS
+    if due: self.flush()
+
+  # Write the buffered records if the oldest has waited long enough
+  def check_flush(self):
+    if self.buffer and self.clock.time() - self.buffered_at >= self.FLUSH_SECS:
+      self.flush()
+
+  def flush(self):
+    with self.lock:
+      (buffer, self.buffer) = (self.buffer, [])
+      if not buffer: return
+      try:
+        with open(self.history.filename, "ab") as f:
+          f.write(b"".join(buffer))
+        if os.path.getsize(self.history.filename) > self.max_size:
+          self.rotate()
+      except (IOError, OSError, ValueError) as e:
+        self.log("Unable to write history file %s: %s" % (self.history.filename, e))
+
+  def rotate(self):
+    (before, after) = self.history.compact(self.COMPACT_GAP)
+    size = HistoryFile.HEADER.size + after * HistoryFile.RECORD.size
+    if size > self.max_size * 3 // 4:
+      keep = (self.max_size // 2 - HistoryFile.HEADER.size) // HistoryFile.RECORD.size
+      after = self.history.compact(self.COMPACT_GAP, max_records=keep)[1]
+    self.log("Compacted history file %s from %d to %d records" % (self.history.filename, before, after))
+
+  # Index of name in the names file, adding it if new
+  def name_index(self, name):
+    if name is None: return HistoryFile.NO_NAME
+    if name not in self.index:
+      self.history.write_names(self.history.names + [name])
+      self.index[name] = len(self.history.names) - 1
+    return self.index[name]
+
+# Reports on a HistoryFile from since until until (times in seconds):
+#
+#   timeline    When each device was present, from when it was seen until it
+#               was last seen before being missed by a probe, not being seen
+#               for gap seconds or autoaway.py restarting
+#   occupancy   Occupied and vacant periods of the property (or each site),
+#               with the time spent occupied
+#   dropouts    For each device, the number and length of absences between
+#               periods of presence, and the sources by which it was seen
+#
+# Reports can be limited to the devices named in devices.
+class HistoryReport(object):
+  REPORTS = ["timeline", "occupancy", "dropouts"]
+
+  def __init__(self, history, since, until, gap=3600, devices=None, clock=None):
+    self.history = history
+    self.since = since
+    self.until = until
+    self.gap = gap
+    self.devices = devices
+    self.clock = clock if clock else Clock()
+
+  def run(self, report):
+    return getattr(self, report)()
+
+  # Presence intervals of each device, by name, as a list of
+  # [first seen, last seen, ended by ("missed", "gap", "restart" or None if
+  # still present), {source: sightings}]. Looking back gap seconds finds any
+  # device already present at the start of the range.
+  def presence(self):
+    (SEEN, MISSED, START) = (HistoryFile.SEEN, HistoryFile.MISSED, HistoryFile.START)
+    names = None
+    if self.devices:
+      names = set([i for (i, x) in enumerate(self.history.names) if x in self.devices])
+
+    intervals = {}
+    current = {}
+    for (when, name, event, source) in self.history.between(self.since - self.gap, self.until):
+      if event == START:
+        for interval in current.values():
+          interval[2] = "restart"
+        current = {}
+      elif event == SEEN or event == MISSED:
+        if names is not None and name not in names: continue
+        interval = current.get(name)
+        if interval and (event == MISSED or when - interval[1] > self.gap):
+          interval[2] = "missed" if event == MISSED else "gap"
+          del current[name]
+          interval = None
+        if event == SEEN:
+          if not interval:
+            interval = current[name] = [when, when, None, {}]
+            intervals.setdefault(name, []).append(interval)
+          interval[1] = when
+          label = HistoryFile.SOURCES[source] or "other"
+          interval[3][label] = interval[3].get(label, 0) + 1
+
+    result = {}
+    for (name, found) in intervals.items():
+      for interval in found:
+        if interval[2] is None and self.until - interval[1] > self.gap:
+          interval[2] = "gap"
+      found = [x for x in found if x[1] >= self.since]
+      for interval in found:
+        interval[0] = max(interval[0], self.since)
+      if found:
+        result[self.history.name(name)] = found
+    return result
+
+  # Occupancy intervals of each site (None for a single site) as a list of
+  # [start, end, occupied], plus the number of grace periods that ended with
+  # a device returning. The current intervals end at until or now, if sooner.
+  def periods(self, now=None):
+    now = now if now is not None else self.clock.time()
+    (START, OCCUPIED, VACANT, RETURNED) = (HistoryFile.START, HistoryFile.OCCUPIED,
+                                           HistoryFile.VACANT, HistoryFile.RETURNED)
+
+    # Occupancy at the start of the range, from the last change since the
+    # most recent restart before it
+    start = self.history.find(self.since)
+    state = {}
+    for index in range(start - 1, -1, -1):
+      (when, name, event, source) = self.history.record(index)
+      if event == START: break
+      if event in (OCCUPIED, VACANT) and name not in state:
+        state[name] = event == OCCUPIED
+
+    intervals = {}
+    returns = {}
+    current = dict([(x, [self.since, self.since, state[x]]) for x in state])
+    for x in current:
+      intervals[x] = [current[x]]
+    last = self.since
+    for (when, name, event, source) in self.history.records(start, self.history.find(self.until)):
+      if event == START:
+        for interval in current.values():
+          interval[1] = last
+        current = {}
+      elif event in (OCCUPIED, VACANT):
+        interval = current.get(name)
+        if interval and interval[2] == (event == OCCUPIED): continue
+        if interval: interval[1] = when
+        interval = current[name] = [when, when, event == OCCUPIED]
+        intervals.setdefault(name, []).append(interval)
+      elif event == RETURNED:
+        returns[name] = returns.get(name, 0) + 1
+      last = when
+    for interval in current.values():
+      interval[1] = max(min(self.until, now), last)
+
+    return dict([(self.history.name(x), (intervals[x], returns.get(x, 0))) for x in intervals])
+
+  def timeline(self):
+    lines = []
+    for (name, intervals) in sorted(self.presence().items()):
+      for (start, end, ended, sources) in intervals:
+        lines.append("%s: %s - %s  %s  seen by %s%s" %
+          (name, self.format_time(start), self.format_time(end), format_duration(end - start),
+           self.format_sources(sources), " (%s)" % ended if ended else ""))
+    return lines
+
+  def occupancy(self):
+    lines = []
+    for (name, (intervals, returns)) in sorted(self.periods().items(), key=lambda x: x[0] or ""):
+      label = name or "property"
+      total = {True: 0, False: 0}
+      for (start, end, occupied) in intervals:
+        total[occupied] += end - start
+        lines.append("%s: %-8s %s - %s  %s" % (label, "occupied" if occupied else "vacant",
+          self.format_time(start), self.format_time(end), format_duration(end - start)))
+      known = total[True] + total[False]
+      lines.append("%s: occupied %s (%.1f%%), vacant %s, in %d period%s; %d grace period%s ended by a return" %
+        (label, format_duration(total[True]), 100.0 * total[True] / known if known else 0,
+         format_duration(total[False]), len(intervals), "s"[len(intervals)==1:], returns, "s"[returns==1:]))
+    return lines
+
+  def dropouts(self):
+    lines = []
+    for (name, intervals) in sorted(self.presence().items()):
+      absences = [(y[0] - x[1]) for (x, y) in zip(intervals, intervals[1:]) if x[2] in ("missed", "gap")]
+      present = sum([x[1] - x[0] for x in intervals])
+      sources = {}
+      for interval in intervals:
+        for (source, count) in interval[3].items():
+          sources[source] = sources.get(source, 0) + count
+      line = "%s: present %s in %d period%s, %d absence%s" % (name, format_duration(present),
+        len(intervals), "s"[len(intervals)==1:], len(absences), "s"[len(absences)==1:])
+      if absences:
+        absences.sort()
+        line += " (%d under %s), median %s, max %s" % (len([x for x in absences if x < self.gap]),
+          format_duration(self.gap), format_duration(absences[len(absences) // 2]), format_duration(absences[-1]))
+      lines.append("%s; seen by %s" % (line, self.format_sources(sources)))
+    return lines
+
+  def format_time(self, when):
+    return datetime.datetime.fromtimestamp(when).strftime("%Y-%m-%d %H:%M:%S")
+
+  def format_sources(self, sources):
+    return ", ".join(["%s %d" % (x, sources[x]) for x in sorted(sources, key=sources.get, reverse=True)])
+
+#===================
+
+def isMAC(possible_mac):
+  return re.match("^([0-9a-fA-F]{1,2}:){5}[0-9a-fA-F]{1,2}$", possible_mac) is not None
+
+def isIPv4(possible_ip):
+  return re.match("^[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+$", possible_ip) is not None
+
+# An IPv6 address, optionally with a scope (eg. fe80::1%eth0)
+def isIPv6(possible_ip):
+  if ":" not in possible_ip or isMAC(possible_ip): return False
+  try:
+    socket.inet_pton(socket.AF_INET6, possible_ip.split("%")[0])
+    return True
+  except (socket.error, ValueError, AttributeError):
+    return False
+
+# Name of the interface with the default IPv4 route (Linux only), or None
+def get_default_interface():
+  try:
+    with open("/proc/net/route", "r") as f:
+      for line in f.readlines()[1:]:
+        fields = line.split()
+        if len(fields) > 1 and fields[1] == "00000000":
+          return fields[0]
+  except (IOError, OSError):
+    pass
+  return None
+
 #===================
 
 def checkVersion(args):
@@ -561,10 +3440,10 @@ def checkVersion(args):
     url = GITHUB.replace("//raw.","//").replace("/master","/blob/master")
     printout("Full changelog: %s/CHANGELOG.md" % url)
 
-def downloadLatestVersion(args, autoupdate=False):
+def downloadLatestVersion(args, autoupdate=False, latest=None):
   global GITHUB, VERSION
 
-  (remoteVersion, remoteHash) = get_latest_version()
+  (remoteVersion, remoteHash) = latest if latest else get_latest_version()
 
   if autoupdate and (not remoteVersion or remoteVersion <= VERSION):
     return False
@@ -577,8 +3456,11 @@ def downloadLatestVersion(args, autoupdate=False):
     printerr("Current version is already up to date - no update required.")
     return
 
+  import hashlib
+  urllib2 = get_urllib()
+
   try:
-    response = urllib2.urlopen("%s/%s" % (GITHUB, "autoaway.py"))
+    response = urllib2.urlopen("%s/%s" % (GITHUB, "autoaway.py"), timeout=30)
     data = response.read()
   except Exception as e:
     if autoupdate: return False
@@ -619,6 +3501,8 @@ def downloadLatestVersion(args, autoupdate=False):
 def get_latest_version():
   global GITHUB, ANALYTICS, VERSION
 
+  import platform
+
   # Need user agent etc. for analytics
   BITS = "64" if platform.architecture()[0] == "64bit" else "32"
   ARCH = "ARM" if platform.machine().lower().startswith("arm") else "x86"
@@ -644,21 +3528,22 @@ def get_latest_version():
   if remoteVersion == None or remoteHash == None:
     (remoteVersion, remoteHash) = get_latest_version_ex("%s/%s" % (GITHUB, "VERSION"))
 
+  if remoteVersion and remoteHash:
+    write_version_cache(remoteVersion, remoteHash)
+
   return (remoteVersion, remoteHash)
 
 def get_latest_version_ex(url, headers=None, checkerror=True):
-  GLOBAL_TIMEOUT = socket.getdefaulttimeout()
+  urllib2 = get_urllib()
   ITEMS = (None, None)
 
   try:
-    socket.setdefaulttimeout(5.0)
-
     if headers:
       opener = urllib2.build_opener()
       opener.addheaders = headers
-      response = opener.open(url)
+      response = opener.open(url, timeout=5.0)
     else:
-      response = urllib2.urlopen(url)
+      response = urllib2.urlopen(url, timeout=5.0)
 
     if sys.version_info >= (3, 0):
       data = response.read().decode("utf-8")
@@ -674,29 +3559,92 @@ def get_latest_version_ex(url, headers=None, checkerror=True):
   except Exception as e:
     if checkerror: printerr("Exception in get_latest_version_ex(): url [%s], text [%s]" % (url, e))
 
-  socket.setdefaulttimeout(GLOBAL_TIMEOUT)
   return ITEMS
 
+# urllib is only needed when checking for or downloading a new version,
+# so don't import it unless required
+def get_urllib():
+  if sys.version_info >= (3, 0):
+    import urllib.request as urllib2
+  else:
+    import urllib2
+  return urllib2
+
 #
-# Download new version if available, then replace current
-# process - os.execl() doesn't return.
+# The result of the last version check is cached for VERSION_CACHE_EXPIRY
+# seconds, so that most startups need not wait on the network.
 #
-# Do nothing if newer version not available.
+def get_version_cache_file():
+  return os.path.join(os.path.expanduser("~"), ".autoaway.version")
+
+def read_version_cache():
+  try:
+    with open(get_version_cache_file(), "r") as f:
+      (checked, remoteVersion, remoteHash) = f.read().split()
+    if 0 <= time.time() - int(checked) < VERSION_CACHE_EXPIRY:
+      return (remoteVersion, remoteHash)
+  except (IOError, OSError, ValueError):
+    pass
+  return None
+
+def write_version_cache(remoteVersion, remoteHash):
+  try:
+    with open(get_version_cache_file(), "w") as f:
+      f.write("%d %s %s\n" % (int(time.time()), remoteVersion, remoteHash))
+  except (IOError, OSError):
+    pass
+
+# Refresh the cached version in the background. Any new version will be
+# applied by autoUpdate() the next time the script is started.
+def refreshVersionCache():
+  (remoteVersion, remoteHash) = get_latest_version()
+  if remoteVersion and remoteVersion > VERSION:
+    printlog("NOTICE - A new version (v%s) of this script is available, and will be applied on restart." % remoteVersion)
+
+#
+# Download new version if available, and have restartIfUpdated()
+# replace the current process once the check in progress has finished.
+#
+# Do nothing if newer version not available. If the cached version
+# has expired, refresh it instead. Either way this is done in the
+# background, so startup never waits for the network.
 #
 def autoUpdate(args):
-  if downloadLatestVersion(args, autoupdate=True):
-    argv = sys.argv
-    argv.append("--nocheck")
-    os.execl(sys.executable, sys.executable, *argv)
+  t = threading.Thread(target=backgroundUpdate, args=(args,))
+  t.daemon = True
+  t.start()
+
+def backgroundUpdate(args):
+  latest = read_version_cache()
+  if not latest:
+    refreshVersionCache()
+  elif downloadLatestVersion(args, autoupdate=True, latest=latest):
+    updated.set()
+
+# Called between checks: once autoUpdate() has replaced this file, write any
+# buffered history (os.execl() skips exit handlers) and restart with the new
+# version - os.execl() doesn't return.
+def restartIfUpdated(sites):
+  if not updated.is_set(): return
+
+  printlog("Restarting to apply update")
+  for autoaway in sites:
+    if autoaway.history: autoaway.history.flush()
+  sys.stdout.flush()
+
+  argv = sys.argv
+  argv.append("--nocheck")
+  os.execl(sys.executable, sys.executable, *argv)
 
 #===================
 
 def init():
-  global GITHUB, ANALYTICS, VERSION, VERBOSE
+  global GITHUB, ANALYTICS, VERSION, VERBOSE, VERSION_CACHE_EXPIRY
 
   GITHUB = "https://raw.github.com/MilhouseVH/autoaway.py/master/"
   ANALYTICS = "http://goo.gl/ZTe1mN"
   VERSION = "0.1.0"
+  VERSION_CACHE_EXPIRY = 24*60*60
 
   parser = argparse.ArgumentParser(description="Manage auto-away status based on presence of mobile devices",
                     formatter_class=lambda prog: argparse.HelpFormatter(prog,max_help_position=25,width=90))
@@ -704,9 +3652,19 @@ def init():
   parser.add_argument("-d", "--devices", metavar="DEVICE", nargs="+", \
                       help="List of devices to be monitored (hostnames, IPv4 address or colon-delimited MAC)")
 
+  parser.add_argument("--sites", metavar="FILENAME", \
+                      help="Monitor several sites from one process, configured in FILENAME (JSON) - see README. \
+                            Sites checked at the same time share one copy of the ARP cache, and devices listed by \
+                            more than one site are pinged once.")
+
   parser.add_argument("-g", "--grace", metavar="MINUTES", type=int, default=15, \
                       help="Grace period after last device seen, in minutes")
 
+  parser.add_argument("-op", "--offpeak", metavar="WINDOW", action="append", \
+                      help="Additional off peak window, may be repeated. Specified as \"[DAYS] HH:MM-HH:MM\" where \
+                            DAYS is a list of days or day ranges (eg. \"mon-fri 23:00-07:00\", \
+                            \"sat,sun 01:00-09:00\"), or as \"YYYY-MM-DD HH:MM-HH:MM\" to replace the \
+                            windows for a specific date (eg. a holiday).")
   parser.add_argument("-ops", "--offpeakstart", metavar="HH:MM", \
                       help="Off peak period start, eg. 01:00. Use 24-hour notation for HH:MM")
   parser.add_argument("-ope", "--offpeakend", metavar="HH:MM", \
@@ -724,26 +3682,85 @@ def init():
   parser.add_argument("-vs", "--vacant-sleep", metavar="SECONDS", type=int, default=15, \
                       help="Sleep interval to be used when property is vacant. Default is 15 seconds.")
 
+  parser.add_argument("-e", "--events", action="store_true", \
+                      help="Linux only: wake immediately when the kernel neighbour table reports a monitored \
+                            device as reachable, rather than waiting for the next vacant check")
+  parser.add_argument("-es", "--event-sleep", metavar="SECONDS", type=int, default=120, \
+                      help="Sleep interval to be used when property is vacant and --events is enabled. \
+                            Default is 120 seconds.")
+
   parser.add_argument("-n", "--notify", metavar="FILENAME", \
                       help="Execute FILENAME when change of occupancy occurs - passed \
                       \"here\" or \"away\" as arg1, here/away period in seconds as arg2 and \
                       here/away period in \"d h:m:s\" format as arg3")
 
+  parser.add_argument("-l", "--leases", metavar="FILENAME", action="append", \
+                      help="DHCP lease file to watch (dnsmasq or ISC dhcpd, eg. /var/lib/misc/dnsmasq.leases), \
+                            may be repeated. IP addresses of MAC addresses are learned from the leases, and a \
+                            device renewing its lease is treated as present")
+  parser.add_argument("--listen", action="store_true", \
+                      help="Linux only, requires root: listen for ARP and DHCP packets, treating a monitored device \
+                            as present whenever it sends one")
+  parser.add_argument("--statefile", metavar="FILENAME", \
+                      help="Save learned IP addresses and occupancy state to FILENAME after each check, \
+                            and restore them on startup")
+  parser.add_argument("--control", metavar="PATH", \
+                      help="Unix only: accept status queries and commands (check now, reload devices) as \
+                            JSON lines on a Unix domain socket at PATH - see README")
+  parser.add_argument("--metrics", metavar="[ADDRESS:]PORT", \
+                      help="Serve counters and phase timings in Prometheus text format at \
+                            http://ADDRESS:PORT/metrics. ADDRESS defaults to 127.0.0.1.")
+  parser.add_argument("--history", metavar="FILENAME", \
+                      help="Record when each device is seen or missed and each change of occupancy in FILENAME, \
+                            as compact binary records - see README")
+  parser.add_argument("--history-size", metavar="KB", type=int, default=1024, \
+                      help="Compact the --history file when it grows beyond KB kilobytes, dropping the oldest \
+                            records if necessary - default: 1024")
+
+  parser.add_argument("--notify-timeout", metavar="SECONDS", type=int, default=60, \
+                      help="Kill the --notify script if it runs for longer than SECONDS - default: 60")
+  parser.add_argument("--notify-retries", metavar="RETRIES", type=int, default=3, \
+                      help="Number of times to retry a failed --notify script, with increasing delay - default: 3")
+
+  parser.add_argument("-6", "--ipv6", metavar="INTERFACE", nargs="?", const="", \
+                      help="Include IPv6 neighbours when checking the ARP cache, and ping IPv6 addresses. \
+                            Unresolved MAC addresses are found with a single ICMPv6 echo request to all nodes \
+                            on INTERFACE (default: the interface of the default route) before any ping flood.")
   parser.add_argument("-s", "--subnet", metavar="SUBNET", \
                       help="If only MAC addresses are specified, ping flood the subnet to resolve IP addresses. \
-                            Default is to extract subnet from ARP cache, but this option will override (eg. 192.168.1)")
+                            Default is to extract subnet from ARP cache, but this option will override \
+                            (eg. 192.168.1, or in CIDR notation eg. 192.168.0.0/22)")
+  parser.add_argument("-sr", "--sweep-rate", metavar="PPS", type=int, default=100, \
+                      help="Number of ping requests per second when ping flooding the subnet - default: 100")
 
   parser.add_argument("-p", "--pings", type=int, choices=range(1, 6), default=1, \
                       help="Number of ping requests - default: 1. Increase if poor WiFi reception \
                             leads to false postive \"away\" detection.")
+  parser.add_argument("-cw", "--confirm-window", metavar="SECONDS", type=int, default=15, \
+                      help="When devices are no longer seen, spend up to SECONDS confirming that all devices \
+                            really have gone - default: 15")
+  parser.add_argument("-cp", "--confirm-probes", metavar="PROBES", type=int, default=3, \
+                      help="Number of bursts of probes sent within the --confirm-window - default: 3")
+  parser.add_argument("--adaptive", action="store_true", \
+                      help="While the property is occupied, ping the most reliable device first and \
+                            back off pinging devices that fail to reply or have just been seen in the ARP cache")
+  parser.add_argument("--max-backoff", metavar="CHECKS", type=int, default=8, \
+                      help="Maximum number of checks for which --adaptive will skip pinging a device - default: 8")
+  parser.add_argument("-c", "--concurrency", metavar="DEVICES", type=int, default=10, \
+                      help="Maximum number of devices to ping at the same time - default: 10. Checks finish \
+                            as soon as any device replies. Use 1 to ping devices one at a time.")
   parser.add_argument("--noarp", action="store_true", \
                       help="Do not try to find devices in ARP cache. ARP cache will still be used \
                             to resolve MAC addresses to IP, if MAC addresses are to be monitored.")
   parser.add_argument("--noreverse", action="store_true", \
                       help="No reverse lookup on device names")
+  parser.add_argument("--dns-ttl", metavar="SECONDS", type=int, default=300, \
+                      help="Cache hostname lookups for SECONDS - default: 300")
+  parser.add_argument("--dns-negative-ttl", metavar="SECONDS", type=int, default=60, \
+                      help="Cache failed hostname lookups for SECONDS - default: 60")
   parser.add_argument("--norandom", action="store_true", \
                       help="Do not randomise order in which devices are communicated with - \
-                            use strict left-to-right order devices appear on command line")
+                            give priority to devices in the left-to-right order they appear on command line")
 
   group = parser.add_mutually_exclusive_group()
   group.add_argument("--nocheck", action="store_true", \
@@ -757,6 +3774,22 @@ def init():
   group.add_argument("--fupdate", action="store_true", \
                       help="Force update to latest version (irrespective of current version)")
 
+  group = parser.add_argument_group('History reports')
+  group.add_argument("--report", choices=HistoryReport.REPORTS, \
+                      help="Report on the --history file and exit: when each device was present (timeline), \
+                            occupied and vacant periods (occupancy), or absences of each device (dropouts). \
+                            Limit the report to some devices with --devices.")
+  group.add_argument("--compact", action="store_true", \
+                      help="Remove redundant records from the --history file and exit, also removing any \
+                            records before --from")
+  group.add_argument("--from", dest="since", metavar="WHEN", \
+                      help="Start of the report, as YYYY-MM-DD [HH:MM[:SS]] or a time ago (eg. 30d, 12h, 90m). \
+                            Default is the start of the history.")
+  group.add_argument("--to", dest="until", metavar="WHEN", \
+                      help="End of the report, as --from. Default is now.")
+  group.add_argument("--gap", metavar="SECONDS", type=int, default=3600, \
+                      help="Treat a device not seen for SECONDS as absent - default: 3600")
+
   parser.add_argument("-v", "--verbose", action="store_true", \
                       help="Display diagnostic output")
 
@@ -773,16 +3806,97 @@ def init():
       downloadLatestVersion(args)
     sys.exit(1)
 
-  if args.notify and not os.path.exists(args.notify):
-    parser.error("--notify file %s does not exist!" % args.notify)
+  if args.report or args.compact:
+    history_report(parser, args)
+    sys.exit(0)
+
+  check_args(parser, args)
 
-  if args.devices == None:
+  if args.metrics:
+    try:
+      MetricsServer.parse(args.metrics)
+    except ValueError as e:
+      parser.error("--metrics %s is not valid: %s" % (args.metrics, e))
+
+  if args.sites:
+    args.sites_file = args.sites
+    args.sites = read_sites(parser, args)
+  elif args.devices == None:
     parser.error("argument -d/--devices is required")
 
   if not args.nocheck: autoUpdate(args)
 
   return args
 
+# Validate options that name files or need parsing, for the command line or
+# a site in the --sites file
+def check_args(parser, args, site=None):
+  where = " (site %s)" % site if site else ""
+
+  for window in args.offpeak or []:
+    try:
+      OffPeakSchedule.parse(window)
+    except ValueError as e:
+      parser.error("--offpeak %s%s" % (e, where))
+
+  for filename in args.leases or []:
+    if not os.path.exists(filename):
+      parser.error("--leases file %s does not exist%s!" % (filename, where))
+
+  if args.notify and not os.path.exists(args.notify):
+    parser.error("--notify file %s does not exist%s!" % (args.notify, where))
+
+# Read the --sites file, returning arguments for each site: the command line
+# arguments overridden by the site's settings. The file contains
+# {"sites": [{"name": "flat1", "devices": [...], ...}, ...]} where the
+# optional settings are named as the options in SITE_OPTIONS.
+SITE_OPTIONS = ["devices", "grace", "notify", "offpeak", "offpeakstart", "offpeakend",
+                "check_every", "occupied_sleep", "vacant_sleep", "statefile", "leases", "history"]
+
+def read_sites(parser, args):
+  try:
+    with open(args.sites, "r") as f:
+      config = json.load(f)
+    sites = config["sites"]
+  except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+    parser.error("--sites file %s is not valid: %s" % (args.sites, e))
+
+  result = []
+  names = set()
+  statefiles = set()
+  for site in sites:
+    name = site.get("name")
+    if not name or name in names:
+      parser.error("--sites file %s: every site needs a unique name" % args.sites)
+    names.add(name)
+    unknown = [x for x in site if x != "name" and x not in SITE_OPTIONS]
+    if unknown:
+      parser.error("--sites file %s: unknown setting(s) for site %s: %s" % (args.sites, name, ", ".join(unknown)))
+    if not site.get("devices"):
+      parser.error("--sites file %s: site %s has no devices" % (args.sites, name))
+
+    site_args = argparse.Namespace(**vars(args))
+    for key in SITE_OPTIONS:
+      if key in site: setattr(site_args, key, site[key])
+    if "occupied_sleep" in site and "check_every" not in site:
+      site_args.check_every = None
+    site_args.name = name
+
+    # Each site needs its own state file, so a --statefile given on the
+    # command line is named for each site that doesn't set one (eg.
+    # state.json becomes state.flat1.json)
+    if args.statefile and "statefile" not in site:
+      (root, ext) = os.path.splitext(args.statefile)
+      site_args.statefile = "%s.%s%s" % (root, name, ext)
+    if site_args.statefile:
+      if site_args.statefile in statefiles:
+        parser.error("--sites file %s: site %s has the same statefile as another site" % (args.sites, name))
+      statefiles.add(site_args.statefile)
+
+    check_args(parser, site_args, name)
+    result.append(site_args)
+  return result
+
 def printout(msg, newLine=True):
   sys.stdout.write(msg)
   if newLine: sys.stdout.write("\n")
@@ -797,50 +3911,205 @@ def printlog(msg):
   sys.stdout.write("%s: %s\n" % (datetime.datetime.now(), msg))
   sys.stdout.flush()
 
+# Seconds as "d hh:mm:ss"
+def format_duration(secs):
+  secs = int(secs)
+  return "%dd %02d:%02d:%02d" % (secs // 86400, secs // 3600 % 24, secs // 60 % 60, secs % 60)
+
+# Time in seconds from "YYYY-MM-DD [HH:MM[:SS]]" (local time) or a time ago,
+# eg. "30d", "12h", "90m", "45s" or "2w", raising ValueError if invalid
+def parse_when(value, now):
+  match = re.match("^(\d+)([wdhms])$", value.strip())
+  if match:
+    return now - int(match.group(1)) * {"w": 604800, "d": 86400, "h": 3600, "m": 60, "s": 1}[match.group(2)]
+  for format in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+    try:
+      return time.mktime(datetime.datetime.strptime(value.strip(), format).timetuple())
+    except ValueError:
+      pass
+  raise ValueError("%s is not a valid time" % value)
+
+# Print a report on, or compact, the --history file
+def history_report(parser, args):
+  if not args.history:
+    parser.error("--history is required with --report and --compact")
+  now = time.time()
+  try:
+    since = parse_when(args.since, now) if args.since else None
+    until = parse_when(args.until, now) if args.until else now
+  except ValueError as e:
+    parser.error("%s" % e)
+
+  history = HistoryFile(args.history)
+  try:
+    if args.compact:
+      (before, after) = history.compact(HistoryWriter.COMPACT_GAP, since=since)
+      printout("Compacted %s from %d to %d records (%d bytes)" %
+        (args.history, before, after, os.path.getsize(args.history)))
+    if args.report:
+      with history:
+        report = HistoryReport(history, since if since is not None else 0, until, args.gap, args.devices)
+        for line in report.run(args.report):
+          printout(line)
+  except (IOError, OSError, ValueError) as e:
+    printerr("Unable to read history file %s: %s" % (args.history, e))
+    sys.exit(2)
+
 def OccupancyChange(autoaway, isOccupied):
+  autoaway.record("occupied" if isOccupied else "vacant")
   if isOccupied:
-    printlog("Property is occupied - vacant for %s (from %s - %s)" %
+    autoaway.log("Property is occupied - vacant for %s (from %s - %s)" %
       (autoaway.GetVacantPeriod(), autoaway.GetVacantStart(), autoaway.GetVacantEnd()))
   else:
-    printlog("Property is vacant - occupied for %s (from %s - %s)" %
+    autoaway.log("Property is vacant - occupied for %s (from %s - %s)" %
       (autoaway.GetOccupiedPeriod(), autoaway.GetOccupiedStart(), autoaway.GetOccupiedEnd()))
 
   autoaway.ExecuteNotification(isOccupied)
 
+# Initial occupancy check, returning (occupied, seen)
+def StartupCheck(autoaway):
+  occupied = autoaway.PropertyIsOccupied()
+
+  autoaway.log("Startup status: %s" % ("Occupied" if occupied else "Vacant"))
+  autoaway.record("occupied" if occupied else "vacant")
+
+  # Occupancy changed while we weren't running
+  if autoaway.restored_occupied is not None and autoaway.restored_occupied != occupied:
+    OccupancyChange(autoaway, occupied)
+
+  return (occupied, autoaway.DevicesSeen())
+
+# Check occupancy, reporting any change since the previous (occupied, seen)
+# and returning the new (occupied, seen)
+def OccupancyCheck(autoaway, previous):
+  (prev_occupied, prev_seen) = previous
+
+  now_occupied = autoaway.PropertyIsOccupied()
+  now_seen = autoaway.DevicesSeen()
+
+  if prev_occupied and now_occupied:
+    if prev_seen and not now_seen:
+      autoaway.log("No device(s) present, property vacated? %d minute grace period commencing..." % autoaway.grace_period)
+      autoaway.record("grace")
+    elif not prev_seen and now_seen:
+      autoaway.log("Device(s) now present - property re-occupied during grace period")
+      autoaway.record("returned")
+
+  if now_occupied != prev_occupied:
+    OccupancyChange(autoaway, now_occupied)
+
+  return (now_occupied, now_seen)
+
+def CreateAutoAway(args, shared=None):
+  return AutoAway(args.devices, not args.noarp, args.pings, args.subnet, args.grace,
+                  args.notify, args.offpeakstart, args.offpeakend,
+                  args.occupied_sleep, args.check_every, args.vacant_sleep,
+                  verbose=args.verbose, reverse=not args.noreverse,
+                  randomise=not args.norandom, concurrency=args.concurrency,
+                  events=args.events, event_sleep=args.event_sleep, sweep_rate=args.sweep_rate,
+                  dns_ttl=args.dns_ttl, dns_negative_ttl=args.dns_negative_ttl,
+                  statefile=args.statefile,
+                  notify_timeout=args.notify_timeout, notify_retries=args.notify_retries,
+                  confirm_window=args.confirm_window, confirm_probes=args.confirm_probes,
+                  adaptive=args.adaptive, max_backoff=args.max_backoff,
+                  off_peak=args.offpeak, leases=args.leases, listen=args.listen,
+                  name=getattr(args, "name", None), shared=shared, ipv6=args.ipv6,
+                  history=args.history, history_size=args.history_size)
+
 #===================
 
 def main(args):
-  autoaway = AutoAway(args.devices, not args.noarp, args.pings, args.subnet, args.grace,
-                      args.notify, args.offpeakstart, args.offpeakend,
-                      args.occupied_sleep, args.check_every, args.vacant_sleep,
-                      verbose=args.verbose, reverse=not args.noreverse,
-                      randomise=not args.norandom)
+  metrics.set("autoaway_info", 1, version=VERSION)
+  if args.metrics:
+    try:
+      server = MetricsServer(args.metrics, metrics)
+      server.start()
+      printlog("Serving metrics at http://%s:%d/metrics" % server.address[:2])
+    except (OSError, socket.error) as e:
+      printlog("Unable to serve metrics on %s: %s" % (args.metrics, e))
+
+  if args.sites:
+    main_sites(args)
+    return
 
-  prev_occupied = autoaway.PropertyIsOccupied()
-  prev_seen= autoaway.DevicesSeen()
+  autoaway = CreateAutoAway(args)
+  StartControlServer(args, [autoaway])
 
-  printlog("Startup status: %s" % ("Occupied" if prev_occupied else "Vacant"))
+  state = StartupCheck(autoaway)
 
   while True:
+    restartIfUpdated([autoaway])
     autoaway.Wait()
+    state = OccupancyCheck(autoaway, state)
 
-    now_occupied = autoaway.PropertyIsOccupied()
-    now_seen = autoaway.DevicesSeen()
-
-    if prev_occupied and now_occupied:
-      if prev_seen and not now_seen:
-        printlog("No device(s) present, property vacated? %d minute grace period commencing..." % args.grace)
-      elif not prev_seen and now_seen:
-        printlog("Device(s) now present - property re-occupied during grace period")
-
-    if now_occupied != prev_occupied:
-      OccupancyChange(autoaway, now_occupied)
-
-    prev_occupied = now_occupied
-    prev_seen = now_seen
+def StartControlServer(args, sites, read_devices=None):
+  if not args.control: return
+  try:
+    ControlServer(args.control, sites, read_devices).start()
+    printlog("Control socket: %s" % args.control)
+  except (OSError, socket.error, AttributeError) as e:
+    printlog("Unable to open control socket %s: %s" % (args.control, e))
+
+# The devices of each site in the --sites file, by name, for reloading
+def read_site_devices(filename):
+  with open(filename, "r") as f:
+    config = json.load(f)
+  return dict([(x["name"], x["devices"]) for x in config["sites"] if x.get("name") and x.get("devices")])
+
+# Monitor every site in the --sites file, each with its own occupancy state
+# and schedule. Sites due within SITE_BATCH seconds of each other are checked
+# in the same cycle, sharing one copy of the ARP cache and ping results.
+SITE_BATCH = 1.0
+
+def main_sites(args):
+  shared = SharedProbes()
+  wakeup = threading.Event()
+  clock = Clock()
+  schedule = CheckScheduler(clock)
+
+  sites = []
+  for site_args in args.sites:
+    autoaway = CreateAutoAway(site_args, shared=shared)
+    autoaway.wakeup = wakeup
+    sites.append(autoaway)
+  StartControlServer(args, sites, lambda: read_site_devices(args.sites_file))
+
+  states = {}
+  for autoaway in sites:
+    states[autoaway] = StartupCheck(autoaway)
+    autoaway.check_schedule.schedule(autoaway.GetSleep())
 
-try:
-  stopped = threading.Event()
-  main(init())
-except (KeyboardInterrupt, SystemExit) as e:
-  if type(e) == SystemExit: sys.exit(int(str(e)))
+  while True:
+    restartIfUpdated(sites)
+    for autoaway in sites:
+      autoaway.update_watch()
+    with metrics.timer("autoaway_phase_seconds", phase="wait"):
+      reason = schedule.sleep_until(wakeup, min([x.check_schedule.deadline for x in sites]))
+    wakeup.clear()
+    if reason == "suspend":
+      printlog("Resumed after %d secs suspended, checking all sites now" % schedule.last_suspend)
+
+    now = clock.monotonic()
+    shared.new_cycle()
+    for autoaway in sites:
+      woken = (reason == "suspend" or autoaway.wakeup_reason is not None)
+      if not woken and autoaway.check_schedule.deadline > now + SITE_BATCH: continue
+      if autoaway.wakeup_reason:
+        autoaway.debug("Woken early: %s" % autoaway.wakeup_reason)
+        autoaway.wakeup_reason = None
+      autoaway.check_schedule.started(reason if woken else None)
+      states[autoaway] = OccupancyCheck(autoaway, states[autoaway])
+      autoaway.check_schedule.schedule(autoaway.GetSleep())
+
+    if args.verbose:
+      printlog("[debug] Shared probes: %s" % shared.summary())
+
+stopped = threading.Event()
+updated = threading.Event()
+metrics = Metrics()
+
+if __name__ == "__main__":
+  try:
+    main(init())
+  except (KeyboardInterrupt, SystemExit) as e:
+    if type(e) == SystemExit: sys.exit(int(str(e)))
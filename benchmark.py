@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+#  Copyright (C) 2013 Neil MacLeod (autoaway@nmacleod.com)
+#
+#  This Program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2, or (at your option)
+#  any later version.
+#
+#  This Program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#  https://github.com/MilhouseVH/autoaway.py
+#
+################################################################################
+
+#
+# Micro-benchmarks for autoaway.py - not needed to run autoaway.py itself.
+#
+#   ./benchmark.py registry
+#   ./benchmark.py neighbours
+#   ./benchmark.py startup
+#   ./benchmark.py packets [capture.pcap ...]
+#   ./benchmark.py checks [--output results.json] [--compare previous.json]
+#
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import json
+import random
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import tempfile
+
+import autoaway
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+#===================
+
+def make_arp(neighbours, offset=0):
+  return [{"mac": "02:00:%02x:%02x:%02x:%02x" % ((i >> 24) & 0xFF, (i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF),
+           "ip": "10.%d.%d.%d" % ((i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF),
+           "type": "REACHABLE"} for i in range(offset, offset + neighbours)]
+
+def timed(func, repeat):
+  start = time.time()
+  for i in range(repeat): func()
+  return (time.time() - start) / repeat
+
+# The list-of-tuples implementation of learn_mac_hosts()/arp_check() used
+# prior to DeviceRegistry, less the debug output.
+def legacy_check(static_list, dynamic_list, arp):
+  for index, host in enumerate(dynamic_list):
+    mac = host[0]
+    ip = host[1]
+    for nic in arp:
+      if mac == nic["mac"]:
+        if ip != nic["ip"]:
+          dynamic_list[index] = (mac, nic["ip"])
+        break
+      elif mac != nic["mac"] and ip == nic["ip"]:
+        dynamic_list[index] = (mac, "")
+        break
+
+  for host in [x for x in static_list + dynamic_list if x[1] != ""]:
+    for nic in arp:
+      if host[1] == nic["ip"]:
+        return True
+  return False
+
+def registry_check(registry, arp):
+  registry.learn_from_arp(arp)
+  return registry.find_in_arp(arp) is not None
+
+# Monitored devices are absent from the ARP cache (the worst case, as when
+# the property is vacant), half by MAC and half by IP address.
+def bench_registry(args):
+  print("%8s %10s %14s %14s %8s" % ("devices", "neighbours", "tuples (ms)", "registry (ms)", "speedup"))
+
+  for devices in args.devices:
+    for neighbours in args.neighbours:
+      absent = make_arp(devices, offset=neighbours)
+      names = [x["mac"] for x in absent[:devices // 2]] + [x["ip"] for x in absent[devices // 2:]]
+      arp = make_arp(neighbours)
+
+      static_list = [("", x) for x in names if not autoaway.isMAC(x)]
+      dynamic_list = [(x, "") for x in names if autoaway.isMAC(x)]
+      registry = autoaway.DeviceRegistry(names)
+
+      repeat = max(1, min(args.repeat, 2000000 // max(devices * neighbours, 1)))
+      t_tuples = timed(lambda: legacy_check(static_list, dynamic_list, arp), repeat)
+      t_registry = timed(lambda: registry_check(registry, arp), repeat)
+
+      print("%8d %10d %14.3f %14.3f %7.1fx" %
+        (devices, neighbours, t_tuples * 1000, t_registry * 1000, t_tuples / t_registry))
+
+# Successive copies of an ARP cache in which churn entries are replaced by
+# new neighbours between one copy and the next
+def make_tables(neighbours, churn, count):
+  base = make_arp(neighbours)
+  fresh = make_arp(churn * count, offset=neighbours * 2)
+  tables = []
+  for i in range(count):
+    for j in range(churn):
+      base[(i * churn + j) % neighbours] = fresh[i * churn + j]
+    tables.append(list(base))
+  return tables
+
+# An RTM_GETNEIGH dump of the ARP cache as the kernel returns it, with
+# NDA_PROBES and NDA_CACHEINFO counters that differ from one dump to the next
+def make_dump(arp, dump):
+  t = autoaway.NeighbourTable
+  messages = []
+  for (seq, nic) in enumerate(arp):
+    attrs = struct.pack("=HH4s", 8, t.NDA_DST, socket.inet_aton(nic["ip"])) + \
+            struct.pack("=HH6sxx", 10, t.NDA_LLADDR, bytes(bytearray([int(x, 16) for x in nic["mac"].split(":")]))) + \
+            struct.pack("=HHL", 8, 4, 0) + \
+            struct.pack("=HHLLLL", 20, 3, dump * 1000 + seq, dump * 1000, dump * 1000, 1)
+    body = t.NDMSG.pack(socket.AF_INET, 2, 0x02, 0, 1) + attrs
+    messages.append(t.NLMSGHDR.pack(t.NLMSGHDR.size + len(body), t.RTM_NEWNEIGH, 2, dump, 0) + body)
+  messages.append(t.NLMSGHDR.pack(t.NLMSGHDR.size + 4, t.NLMSG_DONE, 2, dump, 0) + b"\x00" * 4)
+  return b"".join(messages)
+
+def parse_dump(table, data, reuse):
+  table.parsing = {} if reuse else None
+  entries = table.parse(data)[1]
+  if reuse: table.parsed = table.parsing
+  table.parsing = None
+  return entries
+
+def snapshot_check(registry, table, arp):
+  (added, removed, changed) = table.update(arp)
+  if added or changed: registry.learn_from_arp(added + changed)
+  return registry.find_in_table(table) is not None
+
+# Each check parsing the whole netlink dump and reprocessing every entry
+# (learn_from_arp and find_in_arp), vs reusing the entries unchanged since the
+# previous dump and applying only the changes to a NeighbourSnapshot. "diff
+# (ip)" is the NeighbourSnapshot alone given new dicts for every entry, as
+# from the arp and ip readers. Monitored devices are absent, half by MAC and
+# half by IP address.
+def bench_neighbours(args):
+  print("%10s %6s %11s %11s %11s %11s %11s %8s" % ("neighbours", "churn", "parse (ms)", "reuse (ms)",
+        "rescan (ms)", "diff (ms)", "diff (ip)", "speedup"))
+
+  for neighbours in args.neighbours:
+    for churn in args.churn:
+      absent = make_arp(args.devices, offset=neighbours)
+      names = [x["mac"] for x in absent[:args.devices // 2]] + [x["ip"] for x in absent[args.devices // 2:]]
+      tables = make_tables(neighbours, churn, args.repeat + 1)
+      dumps = [make_dump(x, i) for (i, x) in enumerate(tables)]
+
+      def run(check, reuse):
+        registry = autoaway.DeviceRegistry(names)
+        table = autoaway.NeighbourTable()
+        snapshot = autoaway.NeighbourSnapshot()
+        check(registry, snapshot, parse_dump(table, dumps[0], reuse))
+        it = iter(dumps[1:])
+        parsed = []
+        t_parse = timed(lambda: parsed.append(parse_dump(table, next(it), reuse)), args.repeat)
+        it = iter(parsed)
+        t_check = timed(lambda: check(registry, snapshot, next(it)), args.repeat)
+        return (t_parse, t_check)
+
+      (t_parse, t_rescan) = run(lambda r, s, arp: registry_check(r, arp), False)
+      (t_reuse, t_diff) = run(snapshot_check, True)
+      (t_unused, t_fresh) = run(snapshot_check, False)
+
+      print("%10d %6d %11.3f %11.3f %11.3f %11.3f %11.3f %7.1fx" %
+        (neighbours, churn, t_parse * 1000, t_reuse * 1000, t_rescan * 1000, t_diff * 1000, t_fresh * 1000,
+         (t_parse + t_rescan) / (t_reuse + t_diff)))
+
+# Time from process start until the first presence check has completed
+# ("Startup status" is logged), with an empty version cache (so the update
+# check runs in the background), with a fresh version cache, and with
+# --nocheck. HOME is redirected so that the real version cache is untouched.
+def bench_startup(args):
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "autoaway.py")
+  home = tempfile.mkdtemp()
+
+  scenarios = [("no version cache", [], False),
+               ("fresh version cache", [], True),
+               ("--nocheck", ["--nocheck"], False)]
+
+  print("%-20s %12s %12s %12s" % ("scenario", "min (ms)", "median (ms)", "max (ms)"))
+
+  try:
+    for (name, extra, cached) in scenarios:
+      times = []
+      for i in range(args.repeat):
+        cachefile = os.path.join(home, ".autoaway.version")
+        if cached:
+          with open(cachefile, "w") as f:
+            f.write("%d 0.0.0 00000000000000000000000000000000\n" % int(time.time()))
+        elif os.path.exists(cachefile):
+          os.remove(cachefile)
+
+        env = dict(os.environ)
+        env["HOME"] = home
+        start = time.time()
+        proc = subprocess.Popen([sys.executable, script, "--devices"] + args.devices + extra,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        for line in iter(proc.stdout.readline, b""):
+          if b"Startup status" in line:
+            times.append(time.time() - start)
+            break
+        proc.kill()
+        proc.wait()
+
+      times.sort()
+      if times:
+        print("%-20s %12.1f %12.1f %12.1f" %
+          (name, times[0] * 1000, times[len(times) // 2] * 1000, times[-1] * 1000))
+      else:
+        print("%-20s %12s" % (name, "failed"))
+  finally:
+    shutil.rmtree(home)
+
+# Return the frames in a libpcap capture file (Ethernet link type only)
+def read_pcap(filename):
+  with open(filename, "rb") as f:
+    data = f.read()
+
+  magic = data[:4]
+  if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+    endian = "<"
+  elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+    endian = ">"
+  else:
+    raise ValueError("%s is not a pcap file (pcapng is not supported)" % filename)
+  linktype = struct.unpack(endian + "I", data[20:24])[0]
+  if linktype != 1:
+    raise ValueError("%s has link type %d, only Ethernet (1) is supported" % (filename, linktype))
+
+  record = struct.Struct(endian + "IIII")
+  frames = []
+  offset = 24
+  while offset + record.size <= len(data):
+    (sec, usec, caplen, origlen) = record.unpack_from(data, offset)
+    offset += record.size
+    frames.append(data[offset:offset + caplen])
+    offset += caplen
+  return frames
+
+# A mix of ARP requests, DHCP requests, and other traffic (TCP and UDP) that
+# the kernel filter would normally discard, from count random senders
+def make_frames(count, senders):
+  frames = []
+  rand = random.Random(0)
+  bootp = b"\x01\x01\x06\x00" + b"\x00" * 232 + b"\x63\x82\x53\x63"
+  for i in range(count):
+    sender = rand.randrange(senders)
+    mac = struct.pack("!HI", 0x0200, sender)
+    ip = struct.pack("!BBH", 10, 0, sender)
+    kind = rand.random()
+    if kind < 0.2:
+      payload = b"\x08\x06" + struct.pack("!HHBBH", 1, 0x0800, 6, 4, 1) + mac + ip + b"\x00" * 6 + b"\x0a\x00\x00\x01"
+    else:
+      (proto, port) = (17, 67) if kind < 0.3 else (6 if kind < 0.8 else 17, 443)
+      body = bootp[:12] + ip + bootp[16:28] + mac + bootp[34:] if port == 67 else b"\x00" * 40
+      l4 = struct.pack("!HHHH", 68, port, 8 + len(body), 0) + body
+      payload = b"\x08\x00" + struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(l4), 0, 0, 64, proto, 0, ip, b"\xff" * 4) + l4
+    frames.append(b"\xff" * 6 + mac + payload)
+  return frames
+
+# Decode every frame as PacketListener does: copied into one preallocated
+# buffer (as by recv_into) and checked against the watched addresses
+def bench_packets(args):
+  if args.pcap:
+    frames = []
+    for filename in args.pcap: frames.extend(read_pcap(filename))
+  else:
+    frames = make_frames(args.frames, args.senders)
+
+  decoder = autoaway.PacketDecoder()
+  snaplen = autoaway.PacketListener.SNAPLEN
+  buf = bytearray(snaplen)
+  frames = [bytes(x[:snaplen]) for x in frames]
+
+  if args.dump:
+    for frame in frames:
+      buf[:len(frame)] = frame
+      result = decoder.decode(buf, len(frame))
+      if result:
+        print("%-4s %s %s" % (result[0], ":".join(["%02x" % x for x in bytearray(result[1])]), socket.inet_ntoa(result[2])))
+
+  counts = {}
+  senders = set()
+  for frame in frames:
+    buf[:len(frame)] = frame
+    result = decoder.decode(buf, len(frame))
+    kind = result[0] if result else "other"
+    counts[kind] = counts.get(kind, 0) + 1
+    if result: senders.add(result[1])
+  watch_macs = set(list(senders)[:args.watch])
+  watch_ips = set()
+
+  def replay():
+    decode = decoder.decode
+    matched = 0
+    for frame in frames:
+      length = len(frame)
+      buf[:length] = frame
+      result = decode(buf, length)
+      if result is None: continue
+      if result[1] in watch_macs or result[2] in watch_ips: matched += 1
+    return matched
+
+  elapsed = timed(replay, args.repeat)
+  print("%d frames: %s, %d distinct senders, %d watched" %
+    (len(frames), ", ".join(["%d %s" % (counts[x], x) for x in sorted(counts)]), len(senders), len(watch_macs)))
+  print("%.3f ms per replay, %.2f us per frame, %.0f frames/sec" %
+    (elapsed * 1000, elapsed * 1000000 / max(len(frames), 1), len(frames) / elapsed if elapsed else 0))
+
+# Deterministic stand-ins for the kernel neighbour table, ICMP and DNS, for
+# use in place of the system backends. Latency is simulated by sleeping, and
+# loss decided by a seeded random number generator.
+class FakeNeighbours(object):
+  def __init__(self, arp, churn, keep, rand):
+    self.arp = arp
+    self.churn = churn
+    self.keep = keep
+    self.rand = rand
+    self.offset = len(arp) * 4
+
+  # As NeighbourTable.dump(), with churn entries (other than the first keep)
+  # replaced by new neighbours each time
+  def dump(self):
+    for i in range(self.churn):
+      if len(self.arp) <= self.keep: break
+      self.arp[self.rand.randrange(self.keep, len(self.arp))] = make_arp(1, offset=self.offset)[0]
+      self.offset += 1
+    return list(self.arp)
+
+class FakePinger(object):
+  type = "fake"
+
+  def __init__(self, alive, latency, loss, timeout, rand):
+    self.alive = alive
+    self.latency = latency
+    self.loss = loss
+    self.timeout = timeout
+    self.rand = rand
+
+  def ping_hosts(self, ipaddresses, count=1, timeout=1.0, first_reply=False, concurrency=None):
+    results = {}
+    winner = None
+    for ipaddress in ipaddresses:
+      received = len([i for i in range(count) if ipaddress in self.alive and self.rand.random() >= self.loss])
+      results[ipaddress] = (count, received, count - received, 0, 100 * (count - received) // count,
+                            [self.latency] * received)
+      if received and not winner:
+        winner = ipaddress
+        if first_reply: break
+    time.sleep(self.latency if winner else self.timeout)
+    return (results, winner)
+
+  def sweep(self, ipaddresses, rate=100, timeout=1.0, progress=None):
+    replies = len([x for x in ipaddresses if x in self.alive])
+    time.sleep(self.latency)
+    complete = progress(len(ipaddresses), replies) if progress else False
+    return (len(ipaddresses), replies, self.latency, complete)
+
+class FakeDNS(object):
+  def __init__(self, hosts, latency, loss, rand):
+    self.hosts = hosts
+    self.latency = latency
+    self.loss = loss
+    self.rand = rand
+
+  def lookup(self, name):
+    time.sleep(self.latency)
+    if name not in self.hosts or self.rand.random() < self.loss:
+      raise socket.gaierror("Name or service not known")
+    return self.hosts[name]
+
+  def reverse_lookup(self, ipaddress):
+    time.sleep(self.latency)
+    return "host-%s.bench" % ipaddress.replace(".", "-")
+
+# Counts every process started (subprocess.check_output also uses Popen)
+class CountingPopen(subprocess.Popen):
+  started = 0
+
+  def __init__(self, *args, **kwargs):
+    CountingPopen.started += 1
+    subprocess.Popen.__init__(self, *args, **kwargs)
+
+def percentiles(times):
+  times = sorted(times)
+  if not times: return None
+  pick = lambda p: times[min(len(times) - 1, int(round(p / 100.0 * (len(times) - 1))))] * 1000
+  return {"p50": pick(50), "p90": pick(90), "p99": pick(99), "max": times[-1] * 1000,
+          "mean": sum(times) * 1000 / len(times)}
+
+# Monitored devices are a third each by MAC, IP address and hostname. When
+# occupied, only the last device is present (in the ARP cache, and replying
+# to pings), so every other device is checked first.
+def run_scenario(args, devices, neighbours, occupied):
+  rand = random.Random(args.seed)
+  addresses = make_arp(devices, offset=neighbours)
+  names = []
+  hosts = {}
+  for (i, nic) in enumerate(addresses):
+    if i % 3 == 0:
+      names.append(nic["mac"])
+    elif i % 3 == 1:
+      names.append(nic["ip"])
+    else:
+      names.append("host-%d.bench" % i)
+      hosts[names[-1]] = nic["ip"]
+
+  arp = make_arp(neighbours)
+  alive = set()
+  if occupied:
+    arp = addresses[-1:] + arp[1:]
+    alive.add(addresses[-1]["ip"])
+
+  dns = FakeDNS(hosts, args.dns_latency, args.dns_loss, rand)
+  backends = {"neighbours": FakeNeighbours(arp, args.churn, 1 if occupied else 0, rand),
+              "pinger": FakePinger(alive, args.ping_latency, args.ping_loss, args.ping_timeout, rand),
+              "resolver": autoaway.ResolverCache(lookup=dns.lookup, reverse_lookup=dns.reverse_lookup)}
+
+  started = CountingPopen.started
+  start = time.time()
+  aa = autoaway.AutoAway(names, grace_period=0, confirm_window=0, confirm_probes=1, **backends)
+  startup = time.time() - start
+
+  checks = []
+  for i in range(args.checks):
+    start = time.time()
+    aa.PropertyIsOccupied()
+    checks.append(time.time() - start)
+
+  arp_checks = []
+  for i in range(args.checks):
+    start = time.time()
+    aa.arp_check(aa.update_arp_table())
+    arp_checks.append(time.time() - start)
+
+  memory = {}
+  if tracemalloc:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(args.memory_checks): aa.PropertyIsOccupied()
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    memory = {"memory_peak_kb": (peak - before) / 1024.0, "memory_retained_kb": (current - before) / 1024.0}
+
+  result = {"name": "devices=%d neighbours=%d %s" % (devices, neighbours, "occupied" if occupied else "vacant"),
+            "devices": devices, "neighbours": neighbours, "occupied": occupied,
+            "startup_ms": startup * 1000, "check_ms": percentiles(checks), "arp_check_ms": percentiles(arp_checks),
+            "subprocesses": CountingPopen.started - started, "memory_peak_kb": None, "memory_retained_kb": None}
+  result.update(memory)
+  return result
+
+# PropertyIsOccupied() (and the ARP cache check alone) against stand-in
+# backends, as JSON. With --compare, the ratio of each median and 99th
+# percentile to those of a previous run is also reported (on stderr).
+def bench_checks(args):
+  subprocess.Popen = CountingPopen
+  with open(autoaway.__file__.replace(".pyc", ".py")) as f:
+    version = re.search(r'VERSION = "([^"]*)"', f.read())
+
+  results = {"autoaway": version.group(1) if version else None,
+             "python": "%d.%d.%d" % sys.version_info[:3], "platform": sys.platform,
+             "parameters": dict([(x, y) for (x, y) in vars(args).items() if x not in ("func", "output", "compare")]),
+             "scenarios": []}
+  for devices in args.devices:
+    for neighbours in args.neighbours:
+      for occupied in (False, True):
+        scenario = run_scenario(args, devices, neighbours, occupied)
+        results["scenarios"].append(scenario)
+        sys.stderr.write("%-40s check p50 %8.3f ms, p99 %8.3f ms\n" %
+          (scenario["name"], scenario["check_ms"]["p50"], scenario["check_ms"]["p99"]))
+
+  output = json.dumps(results, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(output + "\n")
+  else:
+    print(output)
+
+  if args.compare:
+    with open(args.compare) as f:
+      previous = dict([(x["name"], x) for x in json.load(f)["scenarios"]])
+    sys.stderr.write("\n%-40s %10s %10s %10s\n" % ("compared with %s" % args.compare, "check p50", "check p99", "arp p50"))
+    for scenario in results["scenarios"]:
+      old = previous.get(scenario["name"])
+      if not old: continue
+      ratio = lambda key, p: scenario[key][p] / old[key][p] if old[key][p] else 0
+      sys.stderr.write("%-40s %9.2fx %9.2fx %9.2fx\n" %
+        (scenario["name"], ratio("check_ms", "p50"), ratio("check_ms", "p99"), ratio("arp_check_ms", "p50")))
+
+#===================
+
+def main():
+  parser = argparse.ArgumentParser(description="autoaway.py micro-benchmarks")
+  subparsers = parser.add_subparsers(dest="benchmark")
+
+  p = subparsers.add_parser("registry", help="ARP cache matching: list of tuples vs DeviceRegistry")
+  p.add_argument("--devices", type=int, nargs="+", default=[1, 10, 100, 1000])
+  p.add_argument("--neighbours", type=int, nargs="+", default=[100, 1000, 10000])
+  p.add_argument("--repeat", type=int, default=50)
+  p.set_defaults(func=bench_registry)
+
+  p = subparsers.add_parser("neighbours", help="Netlink ARP cache dumps: full reprocessing vs changes since the previous check")
+  p.add_argument("--devices", type=int, default=10)
+  p.add_argument("--neighbours", type=int, nargs="+", default=[1000, 10000])
+  p.add_argument("--churn", type=int, nargs="+", default=[0, 1, 10, 100], help="Entries replaced between checks")
+  p.add_argument("--repeat", type=int, default=50)
+  p.set_defaults(func=bench_neighbours)
+
+  p = subparsers.add_parser("startup", help="Time from process start to the first presence check")
+  p.add_argument("--devices", nargs="+", default=["127.0.0.1"])
+  p.add_argument("--repeat", type=int, default=5)
+  p.set_defaults(func=bench_startup)
+
+  p = subparsers.add_parser("packets", help="Replay captured (or generated) frames through the ARP/DHCP packet decoder")
+  p.add_argument("pcap", nargs="*", help="libpcap capture files, eg. from tcpdump -w (default: generated frames)")
+  p.add_argument("--frames", type=int, default=100000, help="Number of frames to generate")
+  p.add_argument("--senders", type=int, default=50, help="Number of senders in generated frames")
+  p.add_argument("--watch", type=int, default=5, help="Number of senders to treat as monitored")
+  p.add_argument("--repeat", type=int, default=5)
+  p.add_argument("--dump", action="store_true", help="Print each decoded ARP/DHCP sender")
+  p.set_defaults(func=bench_packets)
+
+  p = subparsers.add_parser("checks", help="Presence checks against stand-in neighbour table, ICMP and DNS backends (JSON)")
+  p.add_argument("--devices", type=int, nargs="+", default=[1, 10, 100, 1000])
+  p.add_argument("--neighbours", type=int, nargs="+", default=[100, 10000])
+  p.add_argument("--churn", type=int, default=10, help="Neighbour table entries replaced per read")
+  p.add_argument("--checks", type=int, default=50, help="Checks timed per scenario")
+  p.add_argument("--memory-checks", type=int, default=5, help="Checks traced for memory use per scenario (Python 3)")
+  p.add_argument("--ping-latency", type=float, default=0.001, help="Seconds until a present device replies")
+  p.add_argument("--ping-loss", type=float, default=0.0, help="Probability of each ping being lost")
+  p.add_argument("--ping-timeout", type=float, default=0.01, help="Seconds waited when no device replies")
+  p.add_argument("--dns-latency", type=float, default=0.001, help="Seconds per (uncached) DNS lookup")
+  p.add_argument("--dns-loss", type=float, default=0.0, help="Probability of each DNS lookup failing")
+  p.add_argument("--seed", type=int, default=0)
+  p.add_argument("--output", metavar="FILENAME", help="Write JSON results to FILENAME rather than stdout")
+  p.add_argument("--compare", metavar="FILENAME", help="Compare with the JSON results of a previous run")
+  p.set_defaults(func=bench_checks)
+
+  args = parser.parse_args()
+  if not getattr(args, "func", None):
+    parser.error("a benchmark must be specified")
+  args.func(args)
+
+if __name__ == "__main__":
+  main()
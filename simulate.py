@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+#  Copyright (C) 2013 Neil MacLeod (autoaway@nmacleod.com)
+#
+#  This Program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2, or (at your option)
+#  any later version.
+#
+#  This Program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#  https://github.com/MilhouseVH/autoaway.py
+#
+################################################################################
+
+#
+# Replay a presence trace through autoaway.py on a virtual clock, to tune
+# --grace, --vacant-sleep, --check-every and --pings in seconds rather than
+# days - not needed to run autoaway.py itself.
+#
+#   ./simulate.py [--days 7] [--devices 2] [--save-trace trace.json]
+#   ./simulate.py --trace trace.json
+#   ./simulate.py --history FILENAME [--from 30d] [--to 1d]
+#   ./simulate.py --grace 5 10 15 --vacant-sleep 15 60 --check-every 5 15 --pings 1 2 [--jobs 4]
+#
+
+from __future__ import print_function
+
+import sys
+import time
+import argparse
+import bisect
+import datetime
+import itertools
+import json
+import multiprocessing
+import random
+
+import autoaway
+
+#===================
+
+# Advances only when autoaway.py sleeps or waits, or a ping takes time to be
+# answered or to time out, so days pass as quickly as the checks themselves
+# can be made. Nothing else sets events, so each wait runs its full length.
+class VirtualClock(autoaway.Clock):
+  def __init__(self, start):
+    self.start = float(start)
+    self.now = float(start)
+
+  def time(self):
+    return self.now
+
+  def monotonic(self):
+    return self.now - self.start
+
+  def boottime(self):
+    return self.now - self.start
+
+  def sleep(self, secs):
+    self.now += max(secs, 0)
+
+  def wait(self, event, secs):
+    if event.is_set(): return True
+    self.now += max(secs, 0)
+    return False
+
+# When each device is at home, and while at home when it is dozing (in a
+# deep sleep, answering nothing), as sorted lists of [start, end] in seconds.
+# The property is occupied whenever any device is at home.
+class Trace(object):
+  def __init__(self, start, end, home, dozing=None):
+    self.start = float(start)
+    self.end = float(end)
+    self.home = dict([(x, sorted(y)) for (x, y) in home.items()])
+    self.dozing = dict([(x, sorted(y)) for (x, y) in (dozing or {}).items()])
+
+    # Start times of each list of intervals, for bisection
+    self.home_starts = dict([(x, [i[0] for i in y]) for (x, y) in self.home.items()])
+    self.dozing_starts = dict([(x, [i[0] for i in y]) for (x, y) in self.dozing.items()])
+
+  def devices(self):
+    return sorted(self.home)
+
+  def within(self, intervals, starts, when):
+    i = bisect.bisect_right(starts, when) - 1
+    return i >= 0 and when < intervals[i][1]
+
+  # True if device is at home and awake
+  def present(self, device, when):
+    return device in self.home and self.within(self.home[device], self.home_starts[device], when) and \
+           not self.within(self.dozing.get(device, []), self.dozing_starts.get(device, []), when)
+
+  def occupied(self, when):
+    return any([self.within(self.home[x], self.home_starts[x], when) for x in self.home])
+
+  # Changes of occupancy as [(time, occupied)], starting with the occupancy
+  # at the start of the trace
+  def transitions(self):
+    changes = [(self.start, self.occupied(self.start))]
+    for when in sorted(set([y for x in self.home.values() for i in x for y in i])):
+      if self.start < when < self.end and self.occupied(when) != changes[-1][1]:
+        changes.append((when, not changes[-1][1]))
+    return changes
+
+  def to_json(self):
+    return {"start": self.start, "end": self.end,
+            "devices": dict([(x, {"home": self.home[x], "dozing": self.dozing.get(x, [])}) for x in self.home])}
+
+  @classmethod
+  def from_json(cls, data):
+    devices = data["devices"]
+    return cls(data["start"], data["end"], dict([(x, devices[x]["home"]) for x in devices]),
+               dict([(x, devices[x].get("dozing", [])) for x in devices]))
+
+  # Presence of each device from a --history file, as the timeline report
+  @classmethod
+  def from_history(cls, filename, since, until, gap):
+    with autoaway.HistoryFile(filename) as history:
+      if not len(history): raise ValueError("%s has no records" % filename)
+      since = history.record(0)[0] if since is None else since
+      until = history.record(len(history) - 1)[0] if until is None else until
+      presence = autoaway.HistoryReport(history, since, until, gap).presence()
+    return cls(since, until, dict([(x, [y[:2] for y in presence[x]]) for x in presence]))
+
+  # A household of devices with the same routine: out from around 08:00
+  # until 17:30 on weekdays (unless working from home) and sometimes in the
+  # evening, and out for a few hours on most weekend days. While at home each
+  # device alternates between being awake and dozing, for exponentially
+  # distributed periods.
+  @classmethod
+  def synthetic(cls, start, days, devices, awake, doze, rand):
+    hour = 3600
+    home = {}
+    dozing = {}
+    for device in ["device%d" % (x + 1) for x in range(devices)]:
+      out = []
+      for day in range(days):
+        midnight = time.mktime((datetime.date.fromtimestamp(start) + datetime.timedelta(days=day)).timetuple())
+        if datetime.date.fromtimestamp(midnight).weekday() < 5:
+          if rand.random() >= 0.2:
+            out.append((midnight + rand.gauss(8, 0.5) * hour, midnight + rand.gauss(17.5, 1) * hour))
+          if rand.random() < 0.3:
+            leave = midnight + rand.uniform(19, 20.5) * hour
+            out.append((leave, leave + rand.uniform(1, 3) * hour))
+        elif rand.random() < 0.7:
+          leave = midnight + rand.uniform(10, 14) * hour
+          out.append((leave, leave + rand.uniform(1, 5) * hour))
+
+      (home[device], when) = ([], start)
+      for (leave, back) in sorted(out):
+        if leave > when: home[device].append([when, leave])
+        when = max(when, back)
+      end = start + days * 86400
+      if when < end: home[device].append([when, end])
+
+      dozing[device] = []
+      for (arrive, leave) in home[device]:
+        when = arrive + rand.expovariate(1.0 / awake)
+        while when < leave:
+          length = rand.expovariate(1.0 / doze)
+          dozing[device].append([when, min(when + length, leave)])
+          when += length + rand.expovariate(1.0 / awake)
+    return cls(start, start + days * 86400, home, dozing)
+
+# Answers pings from the trace on the virtual clock, as ICMPPinger would: up
+# to count rounds of pings INTERVAL apart to every host, a device that is
+# present replying to each with probability reply_rate after latency seconds,
+# and stopping at the first reply. Otherwise waits timeout after the last
+# round. Hosts without a reply when the first reply arrives are abandoned.
+class TracePinger(object):
+  type = "simulated"
+  INTERVAL = 0.2
+
+  def __init__(self, trace, addresses, clock, reply_rate, latency, rand):
+    self.trace = trace
+    self.addresses = addresses
+    self.clock = clock
+    self.reply_rate = reply_rate
+    self.latency = latency
+    self.rand = rand
+    self.sent = 0
+    self.replied = {}
+
+  def ping_hosts(self, ipaddresses, count=1, timeout=1.0, first_reply=False, concurrency=None):
+    now = self.clock.time()
+    present = dict([(x, self.trace.present(self.addresses.get(x), now)) for x in ipaddresses])
+    received = dict([(x, 0) for x in ipaddresses])
+    winner = None
+    for rounds in range(1, count + 1):
+      self.sent += len(ipaddresses)
+      for ipaddress in ipaddresses:
+        if present[ipaddress] and self.rand.random() < self.reply_rate:
+          received[ipaddress] += 1
+          winner = winner or ipaddress
+      if winner and first_reply: break
+
+    sent = rounds
+    results = {}
+    for ipaddress in ipaddresses:
+      if winner and first_reply and not received[ipaddress]: continue
+      if received[ipaddress]: self.replied[ipaddress] = now
+      results[ipaddress] = (sent, received[ipaddress], sent - received[ipaddress], 0,
+                            100 * (sent - received[ipaddress]) // sent, [self.latency] * received[ipaddress])
+    self.clock.sleep((rounds - 1) * self.INTERVAL + (self.latency if winner else timeout))
+    return (results, winner)
+
+# The neighbour table that results: a device is REACHABLE for REACHABLE_SECS
+# after it last replied to a ping
+class TraceNeighbours(object):
+  REACHABLE_SECS = 30
+
+  def __init__(self, pinger, clock):
+    self.pinger = pinger
+    self.clock = clock
+    self.entries = {}
+
+  def dump(self):
+    now = self.clock.time()
+    arp = []
+    for (ipaddress, replied) in self.pinger.replied.items():
+      if now - replied < self.REACHABLE_SECS:
+        if ipaddress not in self.entries:
+          self.entries[ipaddress] = {"mac": "02:00:%s" % ":".join(["%02x" % int(x) for x in ipaddress.split(".")]),
+                                     "ip": ipaddress, "type": "REACHABLE"}
+        arp.append(self.entries[ipaddress])
+    return arp
+
+# The unchanged AutoAway, recording changes of occupancy in place of running
+# the notify script, and only logging when verbose
+class SimulatedAutoAway(autoaway.AutoAway):
+  def ExecuteNotification(self, isOccupied):
+    self.changes.append((self.clock.time(), isOccupied))
+
+  def log(self, msg):
+    if self.verbose:
+      autoaway.AutoAway.log(self, msg)
+
+#===================
+
+def percentiles(values):
+  values = sorted(values)
+  if not values: return None
+  pick = lambda p: values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+  return {"p50": pick(50), "p95": pick(95), "max": values[-1]}
+
+# Compare the reported changes of occupancy with the trace. A change is
+# false when the property wasn't in the reported state at the time. Latency
+# is the time from a real change until it is reported, should it be reported
+# before the next real change (otherwise it is missed).
+def evaluate(trace, reported):
+  truth = trace.transitions()
+  false_away = len([x for x in reported[1:] if not x[1] and trace.occupied(x[0])])
+  false_here = len([x for x in reported[1:] if x[1] and not trace.occupied(x[0])])
+
+  latency = {True: [], False: []}
+  missed = {True: 0, False: 0}
+  for (i, (when, occupied)) in enumerate(truth[1:], 1):
+    until = truth[i + 1][0] if i + 1 < len(truth) else trace.end
+    state = [x for x in reported if x[0] <= when][-1][1]
+    if state == occupied:
+      latency[occupied].append(0)
+      continue
+    found = [x[0] for x in reported if when <= x[0] < until and x[1] == occupied]
+    if found:
+      latency[occupied].append(found[0] - when)
+    else:
+      missed[occupied] += 1
+
+  # Time during which the reported occupancy was wrong
+  wrong = 0
+  times = sorted(set([x[0] for x in truth] + [x[0] for x in reported] + [trace.end]))
+  for (start, end) in zip(times, times[1:]):
+    if start < trace.start: continue
+    expected = [x for x in truth if x[0] <= start][-1][1]
+    actual = [x for x in reported if x[0] <= start][-1][1]
+    if expected != actual: wrong += end - start
+
+  return {"changes": len(reported) - 1, "false_away": false_away, "false_here": false_here,
+          "here_latency": percentiles(latency[True]), "away_latency": percentiles(latency[False]),
+          "missed_arrivals": missed[True], "missed_departures": missed[False],
+          "wrong_pct": 100.0 * wrong / (trace.end - trace.start)}
+
+# Run the monitoring loop of autoaway.py over the whole trace with one
+# combination of parameters
+def simulate(job):
+  (trace, params, options) = job
+  started = time.time()
+  rand = random.Random(options["seed"])
+  clock = VirtualClock(trace.start)
+  addresses = dict([("10.0.%d.%d" % (i // 250, i % 250 + 1), x) for (i, x) in enumerate(trace.devices())])
+  pinger = TracePinger(trace, addresses, clock, options["reply_rate"], options["latency"], rand)
+
+  aa = SimulatedAutoAway(sorted(addresses), use_arp=not options["noarp"], pings=params["pings"],
+                         grace_period=params["grace"], occupied_sleep=params["occupied_sleep"],
+                         check_every=params["check_every"], vacant_sleep=params["vacant_sleep"],
+                         verbose=options["verbose"], reverse=False,
+                         confirm_window=options["confirm_window"], confirm_probes=options["confirm_probes"],
+                         adaptive=options["adaptive"], off_peak=options["offpeak"], clock=clock,
+                         neighbours=TraceNeighbours(pinger, clock), pinger=pinger)
+  aa.changes = []
+
+  state = autoaway.StartupCheck(aa)
+  aa.changes.insert(0, (trace.start, state[0]))
+  while clock.time() < trace.end:
+    aa.Wait()
+    state = autoaway.OccupancyCheck(aa, state)
+
+  days = (trace.end - trace.start) / 86400.0
+  result = dict(params)
+  result.update(evaluate(trace, [x for x in aa.changes if x[0] < trace.end]))
+  result.update({"pings_per_day": pinger.sent / days, "checks_per_day": aa.check_schedule.checks / days,
+                 "elapsed": time.time() - started})
+  return result
+
+def describe(trace):
+  truth = trace.transitions()
+  days = (trace.end - trace.start) / 86400.0
+  occupied = sum([(y[0] if y else trace.end) - x[0] for (x, y) in zip(truth, truth[1:] + [None]) if x[1]])
+  return "%.1f days from %s, %d device%s, %d changes of occupancy, occupied %.1f%% of the time" % \
+    (days, datetime.datetime.fromtimestamp(trace.start).strftime("%Y-%m-%d %H:%M"),
+     len(trace.home), "s"[len(trace.home)==1:], len(truth) - 1, 100.0 * occupied / (trace.end - trace.start))
+
+def format_latency(latency):
+  if not latency: return "%17s" % "-"
+  return "%5d/%5d/%5d" % (latency["p50"], latency["p95"], latency["max"])
+
+def report(results):
+  print("%5s %6s %5s %5s | %5s %5s | %17s | %17s | %6s %6s | %7s | %9s %9s" %
+    ("grace", "vsleep", "every", "pings", "false", "false", "here latency (s)", "away latency (s)",
+     "missed", "missed", "wrong", "pings", "checks"))
+  print("%5s %6s %5s %5s | %5s %5s | %17s | %17s | %6s %6s | %7s | %9s %9s" %
+    ("mins", "secs", "mins", "", "away", "here", "p50/p95/max", "p50/p95/max",
+     "here", "away", "%", "per day", "per day"))
+  for x in sorted(results, key=lambda x: (x["false_away"] + x["false_here"], x["wrong_pct"])):
+    print("%5d %6d %5s %5d | %5d %5d | %s | %s | %6d %6d | %7.3f | %9.0f %9.0f" %
+      (x["grace"], x["vacant_sleep"], x["check_every"] or "%ds" % x["occupied_sleep"], x["pings"],
+       x["false_away"], x["false_here"], format_latency(x["here_latency"]), format_latency(x["away_latency"]),
+       x["missed_arrivals"], x["missed_departures"], x["wrong_pct"], x["pings_per_day"], x["checks_per_day"]))
+
+def main():
+  parser = argparse.ArgumentParser(description="Simulate autoaway.py on a virtual clock against a presence trace, "
+                                               "for each combination of the given parameters")
+
+  group = parser.add_argument_group("Trace (default: synthetic)")
+  group.add_argument("--trace", metavar="FILENAME", help="JSON trace, as written by --save-trace")
+  group.add_argument("--history", metavar="FILENAME", help="Presence recorded by autoaway.py --history")
+  group.add_argument("--from", dest="since", metavar="WHEN", help="Start of the --history trace, as autoaway.py")
+  group.add_argument("--to", dest="until", metavar="WHEN", help="End of the --history trace, as autoaway.py")
+  group.add_argument("--gap", metavar="SECONDS", type=int, default=3600,
+                     help="Treat a device not seen for SECONDS as away, for a --history trace - default: 3600")
+  group.add_argument("--start", metavar="YYYY-MM-DD", default="2026-01-05", help="Start of a synthetic trace")
+  group.add_argument("--days", type=int, default=7, help="Length of a synthetic trace")
+  group.add_argument("--devices", type=int, default=2, help="Devices in a synthetic trace")
+  group.add_argument("--awake", metavar="SECONDS", type=float, default=1800,
+                     help="Mean time a device at home is awake between dozes, for a synthetic trace")
+  group.add_argument("--doze", metavar="SECONDS", type=float, default=600,
+                     help="Mean time a device at home dozes (answering nothing), for a synthetic trace")
+  group.add_argument("--save-trace", metavar="FILENAME", help="Write the trace as JSON")
+
+  group = parser.add_argument_group("Parameters (each combination is simulated)")
+  group.add_argument("-g", "--grace", metavar="MINUTES", type=int, nargs="+", default=[15],
+                     help="Grace period - only ends at a check, so is rounded up to a multiple of the occupied \
+                           check interval (grace values up to --check-every give the same results)")
+  group.add_argument("-vs", "--vacant-sleep", metavar="SECONDS", type=int, nargs="+", default=[15])
+  group.add_argument("-ce", "--check-every", metavar="MINUTES", type=int, nargs="+", default=[15])
+  group.add_argument("-os", "--occupied-sleep", metavar="SECONDS", type=int, nargs="+",
+                     help="Simulate --occupied-sleep in place of --check-every")
+  group.add_argument("-p", "--pings", type=int, nargs="+", default=[1])
+
+  group = parser.add_argument_group("Fixed settings")
+  group.add_argument("-op", "--offpeak", metavar="WINDOW", action="append", help="As autoaway.py")
+  group.add_argument("-cw", "--confirm-window", metavar="SECONDS", type=int, default=15)
+  group.add_argument("-cp", "--confirm-probes", metavar="PROBES", type=int, default=3)
+  group.add_argument("--adaptive", action="store_true")
+  group.add_argument("--noarp", action="store_true")
+  group.add_argument("--reply-rate", type=float, default=0.9,
+                     help="Probability of an awake device at home replying to each ping - default: 0.9")
+  group.add_argument("--latency", type=float, default=0.05, help="Seconds until a ping is answered")
+  group.add_argument("--seed", type=int, default=0)
+
+  parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+                      help="Simulations run in parallel - default: number of CPUs")
+  parser.add_argument("--output", metavar="FILENAME", help="Also write the results as JSON to FILENAME")
+  parser.add_argument("-v", "--verbose", action="store_true", help="Log each simulation, on the virtual clock")
+  args = parser.parse_args()
+
+  for window in args.offpeak or []:
+    try:
+      autoaway.OffPeakSchedule.parse(window)
+    except ValueError as e:
+      parser.error("--offpeak %s" % e)
+
+  try:
+    if args.trace:
+      with open(args.trace, "r") as f:
+        trace = Trace.from_json(json.load(f))
+    elif args.history:
+      now = time.time()
+      trace = Trace.from_history(args.history,
+                                 autoaway.parse_when(args.since, now) if args.since else None,
+                                 autoaway.parse_when(args.until, now) if args.until else None, args.gap)
+    else:
+      start = time.mktime(datetime.datetime.strptime(args.start, "%Y-%m-%d").timetuple())
+      trace = Trace.synthetic(start, args.days, args.devices, args.awake, args.doze, random.Random(args.seed))
+  except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+    parser.error("unable to load trace: %s" % e)
+
+  if args.save_trace:
+    with open(args.save_trace, "w") as f:
+      json.dump(trace.to_json(), f, sort_keys=True)
+
+  options = {"seed": args.seed, "reply_rate": args.reply_rate, "latency": args.latency, "noarp": args.noarp,
+             "confirm_window": args.confirm_window, "confirm_probes": args.confirm_probes,
+             "adaptive": args.adaptive, "offpeak": args.offpeak, "verbose": args.verbose}
+  if args.occupied_sleep:
+    schedules = [(None, x) for x in args.occupied_sleep]
+  else:
+    schedules = [(x, None) for x in args.check_every]
+  jobs = []
+  for (grace, vacant_sleep, (check_every, occupied_sleep), pings) in \
+      itertools.product(args.grace, args.vacant_sleep, schedules, args.pings):
+    params = {"grace": grace, "vacant_sleep": vacant_sleep, "check_every": check_every,
+              "occupied_sleep": occupied_sleep, "pings": pings}
+    jobs.append((trace, params, options))
+
+  # The grace period is only checked at the next occupied check, so swept
+  # values within one check interval are indistinguishable
+  for (grace, (check_every, occupied_sleep)) in itertools.product(args.grace if len(args.grace) > 1 else [], schedules):
+    interval = check_every if check_every else occupied_sleep / 60.0
+    if grace <= interval:
+      sys.stderr.write("Warning: grace %d mins is not longer than the %g min check interval, so ends at the next "
+                       "check - any grace up to %g mins gives the same result\n" % (grace, interval, interval))
+
+  sys.stderr.write("Trace: %s\n" % describe(trace))
+  sys.stderr.write("Simulating %d combination%s with %d job%s...\n" %
+    (len(jobs), "s"[len(jobs)==1:], min(args.jobs, len(jobs)), "s"[min(args.jobs, len(jobs))==1:]))
+  start = time.time()
+  if args.jobs > 1 and len(jobs) > 1:
+    pool = multiprocessing.Pool(min(args.jobs, len(jobs)))
+    try:
+      results = pool.map(simulate, jobs, chunksize=1)
+    finally:
+      pool.close()
+  else:
+    results = [simulate(x) for x in jobs]
+  sys.stderr.write("Simulated %.1f days in %.2f secs\n" %
+    (len(jobs) * (trace.end - trace.start) / 86400.0, time.time() - start))
+
+  report(results)
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump({"trace": describe(trace), "results": results}, f, indent=2, sort_keys=True)
+      f.write("\n")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Reading the ARP cache from the output of "arp -a" (net-tools) and
+# "ip neighbor list" (iproute2 6.1, which ends each line with a space), as
+# used when netlink is unavailable.
+#
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import autoaway
+
+ARP = b"""? (192.0.2.38) at <incomplete> on eth0
+? (192.0.2.1) at 02:fc:00:00:00:05 [ether] on eth0
+nas.lan (192.0.2.2) at 00:11:32:00:00:01 [ether] on eth0
+? (192.0.2.10) at a4:83:e7:12:34:56 [ether] on wlan0
+"""
+
+def lines(*lines):
+  return b"".join([x + b" \n" for x in lines])
+
+IP = lines(b"192.0.2.38 dev eth0 FAILED",
+           b"192.0.2.1 dev eth0 lladdr 02:fc:00:00:00:05 REACHABLE",
+           b"192.0.2.2 dev eth0 lladdr 00:11:32:00:00:01 STALE",
+           b"192.0.2.9 dev eth0  INCOMPLETE",
+           b"192.0.2.10 dev wlan0 lladdr a4:83:e7:12:34:56 REACHABLE")
+
+IP6 = lines(b"fe80::fc:ff:fe00:5 dev eth0 lladdr 02:fc:00:00:00:05 router REACHABLE",
+            b"2001:db8::10 dev wlan0 lladdr A4:83:E7:12:34:56 REACHABLE",
+            b"2001:db8::11 dev eth0 lladdr 3c:28:6d:ab:cd:ef STALE",
+            b"fe80::1 dev eth0 FAILED")
+
+@unittest.skipIf(sys.platform == "win32", "reads the Linux command output")
+class ReadArpCacheTest(unittest.TestCase):
+  OUTPUT = {("arp", "-a"): ARP, ("ip", "neighbor", "list"): IP, ("ip", "-6", "neighbor", "list"): IP6}
+
+  def setUp(self):
+    self.check_output = autoaway.subprocess.check_output
+    autoaway.subprocess.check_output = lambda args, **kwargs: self.OUTPUT[tuple(args)]
+
+  def tearDown(self):
+    autoaway.subprocess.check_output = self.check_output
+
+  def reader(self, arp_type, ipv6=None):
+    reader = autoaway.AutoAway.__new__(autoaway.AutoAway)
+    (reader.arp_type, reader.ipv6, reader.neighbours6, reader.verbose) = (arp_type, ipv6, None, False)
+    return reader
+
+  def test_arp(self):
+    self.assertEqual(self.reader("arp").read_arp_cache(),
+                     [{"mac": "02:fc:00:00:00:05", "ip": "192.0.2.1", "type": "eth0"},
+                      {"mac": "00:11:32:00:00:01", "ip": "192.0.2.2", "type": "eth0"},
+                      {"mac": "a4:83:e7:12:34:56", "ip": "192.0.2.10", "type": "wlan0"}])
+
+  def test_ip(self):
+    self.assertEqual(self.reader("ip").read_arp_cache(),
+                     [{"mac": "02:fc:00:00:00:05", "ip": "192.0.2.1", "type": "REACHABLE"},
+                      {"mac": "a4:83:e7:12:34:56", "ip": "192.0.2.10", "type": "REACHABLE"}])
+
+  def test_ip_without_trailing_space(self):
+    self.OUTPUT = dict(self.OUTPUT)
+    self.OUTPUT[("ip", "neighbor", "list")] = IP.replace(b" \n", b"\n")
+    self.assertEqual(len(self.reader("ip").read_arp_cache()), 2)
+
+  def test_ipv6(self):
+    self.assertEqual(self.reader("ip", ipv6="eth0").read_arp_cache()[2:],
+                     [{"mac": "02:fc:00:00:00:05", "ip": "fe80::fc:ff:fe00:5%eth0", "type": "REACHABLE"},
+                      {"mac": "a4:83:e7:12:34:56", "ip": "2001:db8::10", "type": "REACHABLE"}])
+
+    self.assertEqual([x["ip"] for x in self.reader("ip").get_ipv6_neighbours(("REACHABLE", "STALE"))],
+                     ["fe80::fc:ff:fe00:5%eth0", "2001:db8::10", "2001:db8::11"])
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# ControlServer requests, each connection served by the server's own request
+# handler over a socketpair, against stand-in sites.
+#
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+import json
+import shutil
+import socket
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import autoaway
+
+class FakeSite(object):
+  def __init__(self, name, occupied):
+    self.name = name
+    self.occupied = occupied
+    self.requests = []
+
+  def control_status(self):
+    return {"name": self.name, "occupied": self.occupied}
+
+  def request_check(self, reason, devices=None):
+    self.requests.append((reason, devices))
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "requires Unix domain sockets")
+class ControlServerTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.sites = [FakeSite("flat1", True), FakeSite("flat2", False)]
+    self.site_devices = {"flat1": ["phone"], "flat2": ["tablet", "laptop"]}
+    self.control = autoaway.ControlServer(os.path.join(self.dir, "control"), self.sites, self.read_devices)
+
+  def tearDown(self):
+    self.control.server.server_close()
+    shutil.rmtree(self.dir)
+
+  def read_devices(self):
+    if self.site_devices is None: raise IOError("sites file missing")
+    return self.site_devices
+
+  # Send lines over one connection, returning the responses. The requests
+  # and responses are small enough to be buffered by the socket, so the
+  # handler runs to completion before they are read.
+  def converse(self, *lines):
+    (client, server) = socket.socketpair()
+    client.sendall("".join([x + "\n" for x in lines]).encode("utf-8"))
+    client.shutdown(socket.SHUT_WR)
+    self.control.server.RequestHandlerClass(server, "", self.control.server)
+    server.close()
+
+    data = b""
+    for chunk in iter(lambda: client.recv(65536), b""):
+      data += chunk
+    client.close()
+    return [json.loads(x) for x in data.decode("utf-8").splitlines()]
+
+  def request(self, line):
+    return self.converse(line)[0]
+
+  # Blank lines are skipped, and each request answered in turn
+  def test_connection(self):
+    responses = self.converse('{"command": "status"}', "", "check", "bogus")
+    self.assertEqual([x["ok"] for x in responses], [True, True, False])
+
+  def test_status(self):
+    self.assertEqual(self.request("status"), {"ok": True, "occupied": True, "sites": [
+      {"name": "flat1", "occupied": True}, {"name": "flat2", "occupied": False}]})
+    self.assertEqual(self.request('{"command": "status", "site": "flat2"}'),
+                     {"ok": True, "occupied": False, "sites": [{"name": "flat2", "occupied": False}]})
+
+    # Unknown until every site is known, unless any site is occupied
+    self.sites[0].occupied = None
+    self.assertEqual(self.request("status")["occupied"], None)
+    self.sites[1].occupied = True
+    self.assertEqual(self.request("status")["occupied"], True)
+
+  def test_check(self):
+    self.assertEqual(self.request("check"), {"ok": True})
+    self.assertEqual(self.request('{"command": "check", "site": "flat1"}'), {"ok": True})
+    self.assertEqual(self.sites[0].requests, [("Check requested by control socket", None)] * 2)
+    self.assertEqual(self.sites[1].requests, [("Check requested by control socket", None)])
+
+  def test_reload(self):
+    self.assertEqual(self.request('{"command": "reload", "site": "flat2", "devices": ["tablet"]}'), {"ok": True})
+    self.assertEqual(self.sites[1].requests, [("Devices reloaded by control socket", ["tablet"])])
+
+    # Without devices, every site's devices are read again
+    self.assertEqual(self.request("reload"), {"ok": True})
+    self.assertEqual(self.sites[0].requests, [("Devices reloaded by control socket", ["phone"])])
+    self.assertEqual(self.sites[1].requests[1:], [("Devices reloaded by control socket", ["tablet", "laptop"])])
+
+  def test_reload_invalid(self):
+    for request in ['{"command": "reload", "devices": ["phone"]}',
+                    '{"command": "reload", "site": "flat1", "devices": []}',
+                    '{"command": "reload", "site": "flat1", "devices": "phone"}',
+                    '{"command": "reload", "site": "flat1", "devices": ["phone", 1]}']:
+      response = self.request(request)
+      self.assertEqual(response, {"ok": False, "error": "devices must be a non-empty list of names, for a single site"})
+
+    self.site_devices = None
+    self.assertEqual(self.request("reload"), {"ok": False, "error": "sites file missing"})
+    self.control.read_devices = None
+    self.assertEqual(self.request("reload"), {"ok": False, "error": "devices must be given"})
+    self.assertEqual(self.sites[0].requests + self.sites[1].requests, [])
+
+  def test_malformed(self):
+    for line in ['{"command": "status"', '{"command": "status"}}', '{"site": }']:
+      response = self.request(line)
+      self.assertEqual(response["ok"], False)
+      self.assertTrue(response["error"])
+    self.assertEqual(self.request('{"command": "status", "site": "flat3"}'),
+                     {"ok": False, "error": "unknown site flat3"})
+
+  def test_unknown_command(self):
+    self.assertEqual(self.request("shutdown"), {"ok": False, "error": "unknown command shutdown"})
+    self.assertEqual(self.request('{"site": "flat1"}'), {"ok": False, "error": "unknown command None"})
+
+if __name__ == "__main__":
+  unittest.main()
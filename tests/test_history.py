@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# HistoryWriter, HistoryFile and HistoryReport against a temporary history
+# file, with a clock that only moves when told to.
+#
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import autoaway
+
+T0 = 1800000000.0
+
+class FakeClock(autoaway.Clock):
+  def __init__(self, now):
+    self.now = float(now)
+
+  def time(self):
+    return self.now
+
+  def monotonic(self):
+    return self.now
+
+class HistoryTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dir, "history")
+    self.clock = FakeClock(T0)
+    self.logged = []
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def writer(self, max_size=1024*1024):
+    return autoaway.HistoryWriter(self.filename, max_size=max_size, clock=self.clock, log=self.logged.append)
+
+  # Record each (seconds after T0, event, name, source)
+  def record(self, writer, events):
+    for (when, event, name, source) in events:
+      self.clock.now = T0 + when
+      writer.record(event, name, source)
+
+  def report(self, history, since=T0, until=T0 + 3600, gap=900):
+    return autoaway.HistoryReport(history, since, until, gap, clock=self.clock)
+
+  # phone is seen twice then missed, while laptop is seen once and missed,
+  # after which the grace period ends with the property vacant
+  EVENTS = [(10, "seen", "phone", "ping"), (10, "occupied", None, ""), (70, "seen", "phone", "arp"),
+            (130, "missed", "phone", "ping"), (130, "seen", "laptop", "lease"), (200, "missed", "laptop", "ping"),
+            (200, "grace", None, ""), (300, "vacant", None, "")]
+
+  def test_round_trip(self):
+    writer = self.writer()
+    self.record(writer, self.EVENTS)
+    writer.flush()
+
+    history = autoaway.HistoryFile(self.filename)
+    self.assertEqual(history.names, ["phone", "laptop"])
+    with history:
+      self.assertEqual(len(history), 9)
+      self.assertEqual(history.record(0), (T0, history.NO_NAME, history.START, 0))
+      self.assertEqual(history.record(3), (T0 + 70, 0, history.SEEN, history.SOURCES.index("arp")))
+      self.assertEqual(history.find(T0 + 130), 4)
+      self.assertEqual([x[0] - T0 for x in history.between(T0 + 70, T0 + 200)], [70, 130, 130])
+
+      report = self.report(history)
+      self.assertEqual(report.presence(), {"phone": [[T0 + 10, T0 + 70, "missed", {"ping": 1, "arp": 1}]],
+                                           "laptop": [[T0 + 130, T0 + 130, "missed", {"lease": 1}]]})
+      self.assertEqual(report.periods(now=T0 + 1000),
+                       {None: ([[T0 + 10, T0 + 300, True], [T0 + 300, T0 + 1000, False]], 0)})
+      self.clock.now = T0 + 1000
+      self.assertEqual(report.occupancy()[-1], "property: occupied 0d 00:04:50 (29.3%), vacant 0d 00:11:40, "
+                       "in 2 periods; 0 grace periods ended by a return")
+
+  # Sightings are buffered until an occupancy change or FLUSH_SECS, and a
+  # device already missed isn't recorded as missed again
+  def test_buffered(self):
+    writer = self.writer()
+    self.record(writer, [(10, "seen", "phone", "ping"), (20, "missed", "phone", "ping"),
+                         (30, "missed", "phone", "ping")])
+    self.assertEqual(os.path.getsize(self.filename), autoaway.HistoryFile.HEADER.size + autoaway.HistoryFile.RECORD.size)
+    writer.check_flush()
+    self.assertEqual(len(writer.buffer), 2)
+
+    self.clock.now = T0 + 10 + writer.FLUSH_SECS
+    writer.check_flush()
+    with autoaway.HistoryFile(self.filename) as history:
+      self.assertEqual([x[2] for x in history.records()], [history.START, history.SEEN, history.MISSED])
+
+  # Reopening appends a start record, which ends the presence intervals and
+  # occupancy of the previous run at its last record
+  def test_reopen(self):
+    writer = self.writer()
+    self.record(writer, [(10, "seen", "phone", "ping"), (10, "occupied", None, "")])
+    writer.flush()
+
+    self.clock.now = T0 + 100
+    writer = self.writer()
+    self.record(writer, [(110, "seen", "phone", "arp")])
+    writer.flush()
+    with autoaway.HistoryFile(self.filename) as history:
+      self.assertEqual(len(history), 5)
+      report = self.report(history, until=T0 + 200)
+      self.assertEqual(report.presence()["phone"], [[T0 + 10, T0 + 10, "restart", {"ping": 1}],
+                                                    [T0 + 110, T0 + 110, None, {"arp": 1}]])
+      self.assertEqual(report.periods(now=T0 + 200)[None], ([[T0 + 10, T0 + 10, True]], 0))
+
+  # Compacting drops the repeated sightings and misses but leaves the
+  # presence and occupancy periods as they were
+  def test_compact(self):
+    writer = self.writer()
+    events = [(0, "occupied", None, "")]
+    events += [(x, "seen", "phone", "ping") for x in range(60, 1860, 60)]
+    events += [(1900, "missed", "phone", "ping"), (1900, "grace", None, ""), (2000, "seen", "phone", "arp"),
+               (2000, "returned", None, ""), (2060, "seen", "laptop", "lease")]
+    events += [(x, "seen", "phone", "ping") for x in range(2060, 3060, 60)]
+    self.record(writer, events)
+    writer.flush()
+
+    history = autoaway.HistoryFile(self.filename)
+    with history:
+      before = (len(history), self.report(history).presence(), self.report(history).periods(now=T0 + 3600))
+    (count, after) = history.compact(900)
+    self.assertEqual(count, before[0])
+    self.assertTrue(after < 20)
+    with history:
+      self.assertEqual(len(history), after)
+      self.assertEqual(self.report(history).periods(now=T0 + 3600), before[2])
+      presence = self.report(history).presence()
+    self.assertEqual([x[:3] for x in presence["phone"]], [x[:3] for x in before[1]["phone"]])
+    self.assertEqual(presence["laptop"], before[1]["laptop"])
+
+    # Records before since, and beyond the most recent max_records, are dropped
+    history.compact(900, since=T0 + 1900)
+    with history:
+      self.assertEqual(history.record(0)[0], T0 + 1900)
+      presence = self.report(history, since=T0 + 1900).presence()
+      self.assertEqual([x[:3] for x in presence["phone"]], [x[:3] for x in before[1]["phone"][-1:]])
+    history.compact(900, max_records=4)
+    with history:
+      self.assertEqual([x[0] - T0 for x in history.records()], [2000, 2060, 2900, 3020])
+
+  # Once over max_size, the file is compacted as it's written
+  def test_rotate(self):
+    size = autoaway.HistoryFile.HEADER.size + 50 * autoaway.HistoryFile.RECORD.size
+    writer = self.writer(max_size=size)
+    self.record(writer, [(x, "seen", "phone", "ping") for x in range(60, 6060, 60)])
+    writer.flush()
+    self.assertTrue(os.path.getsize(self.filename) <= size)
+    self.assertTrue(self.logged and self.logged[-1].startswith("Compacted history file"))
+
+  # A record cut short by an interrupted write is ignored when read and
+  # dropped before the next append, which keeps records in time order
+  def test_truncated(self):
+    writer = self.writer()
+    self.record(writer, [(10, "seen", "phone", "ping"), (20, "occupied", None, "")])
+    writer.flush()
+    with open(self.filename, "ab") as f:
+      f.write(autoaway.HistoryFile.RECORD.pack(T0 + 30, 0, autoaway.HistoryFile.SEEN, 1)[:7])
+
+    with autoaway.HistoryFile(self.filename) as history:
+      self.assertEqual(len(history), 3)
+      self.assertEqual(history.record(2)[0], T0 + 20)
+
+    self.clock.now = T0 + 5
+    writer = self.writer()
+    self.assertEqual(writer.last_time, T0 + 20)
+    writer.flush()
+    with autoaway.HistoryFile(self.filename) as history:
+      self.assertEqual([x[0] - T0 for x in history.records()], [0, 10, 20, 20])
+      self.assertEqual(history.record(3)[2], history.START)
+
+  def test_not_history(self):
+    with open(self.filename, "wb") as f:
+      f.write(b"not a history file")
+    self.assertRaises(ValueError, autoaway.HistoryFile(self.filename).prepare)
+    self.assertRaises(ValueError, autoaway.HistoryFile(self.filename).open)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# ICMPPinger against the loopback network, 127.0.0.0/8, which answers echo
+# requests on every address (Linux). Skipped when neither an unprivileged
+# ICMP datagram socket nor a raw socket can be opened. Also the expansion of
+# --subnet into the host addresses to sweep.
+#
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+import socket
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import autoaway
+
+def icmp_available():
+  try:
+    autoaway.ICMPPinger().close()
+    return True
+  except (OSError, socket.error):
+    return False
+
+# Never sends to the addresses in dropped, as though they don't answer, and
+# records the most hosts with a probe outstanding at once
+class DroppingPinger(autoaway.ICMPPinger):
+  def __init__(self, dropped):
+    autoaway.ICMPPinger.__init__(self)
+    self.dropped = dropped
+    self.sent = []
+    self.finished = 0
+    self.most_outstanding = 0
+
+  def send(self, ipaddress, seq):
+    self.sent.append(ipaddress)
+    self.most_outstanding = max(self.most_outstanding, len(self.sent) - self.finished)
+    if ipaddress not in self.dropped:
+      autoaway.ICMPPinger.send(self, ipaddress, seq)
+
+  def stats(self, probe, timeout):
+    self.finished += 1
+    return autoaway.ICMPPinger.stats(self, probe, timeout)
+
+@unittest.skipUnless(icmp_available(), "requires an ICMP datagram or raw socket")
+class ICMPPingerTest(unittest.TestCase):
+  def setUp(self):
+    self.pinger = autoaway.ICMPPinger()
+
+  def tearDown(self):
+    self.pinger.close()
+
+  def test_ping(self):
+    for (ipaddress, count) in [("127.0.0.1", 3), ("127.0.0.2", 2)]:
+      (sent, received, lost, errors, pctloss, rtts) = self.pinger.ping(ipaddress, count, timeout=1.0, interval=0.05)
+      self.assertEqual((sent, received, lost, errors, pctloss), (count, count, 0, 0, 0))
+      self.assertEqual(len(rtts), count)
+      for rtt in rtts:
+        self.assertTrue(0 <= rtt < 1.0)
+
+  def test_ping_hosts(self):
+    (results, winner) = self.pinger.ping_hosts(["127.0.0.1", "127.0.0.2"], count=2, interval=0.05)
+    self.assertEqual(sorted(results), ["127.0.0.1", "127.0.0.2"])
+    for stats in results.values():
+      self.assertEqual(stats[:5], (2, 2, 0, 0, 0))
+    self.assertTrue(winner in results)
+
+  # The outstanding probes are abandoned, and not counted as sent, once the
+  # first host replies, and hosts never started are absent from the results
+  def test_first_reply(self):
+    pinger = DroppingPinger(["127.0.0.11", "127.0.0.12"])
+    try:
+      (results, winner) = pinger.ping_hosts(["127.0.0.11", "127.0.0.1", "127.0.0.12", "127.0.0.13"],
+                                            timeout=1.0, first_reply=True, concurrency=3)
+    finally:
+      pinger.close()
+    self.assertEqual(winner, "127.0.0.1")
+    self.assertEqual(sorted(results), ["127.0.0.1", "127.0.0.11", "127.0.0.12"])
+    self.assertEqual(results["127.0.0.1"][:2], (1, 1))
+    self.assertEqual(results["127.0.0.11"][:2], (0, 0))
+    self.assertEqual(results["127.0.0.12"][:2], (0, 0))
+
+  def test_concurrency(self):
+    hosts = ["127.0.0.%d" % x for x in range(11, 16)]
+    pinger = DroppingPinger(hosts)
+    try:
+      (results, winner) = pinger.ping_hosts(hosts, timeout=0.1, concurrency=2)
+    finally:
+      pinger.close()
+    self.assertEqual(winner, None)
+    self.assertEqual(sorted(pinger.sent), hosts)
+    self.assertEqual(pinger.most_outstanding, 2)
+    for stats in results.values():
+      self.assertEqual(stats[:5], (1, 0, 1, 0, 100))
+
+  def test_sweep(self):
+    hosts = ["127.0.0.%d" % x for x in range(1, 6)]
+    (sent, replies, elapsed, stopped) = self.pinger.sweep(hosts, rate=1000, timeout=0.5)
+    self.assertEqual((sent, replies, stopped), (5, 5, False))
+
+  # Stops as soon as progress() returns True, here at the first reply
+  def test_sweep_stops_early(self):
+    hosts = ["127.0.0.%d" % x for x in range(1, 101)]
+    calls = []
+    def progress(sent, replies):
+      calls.append((sent, replies))
+      return replies > 0
+    (sent, replies, elapsed, stopped) = self.pinger.sweep(hosts, rate=100, timeout=0.5, progress=progress)
+    self.assertTrue(stopped)
+    self.assertEqual(replies, 1)
+    self.assertTrue(sent < len(hosts))
+    self.assertEqual(calls[-1], (sent, replies))
+
+class SubnetHostsTest(unittest.TestCase):
+  def hosts(self, subnet):
+    return autoaway.AutoAway.__new__(autoaway.AutoAway).get_subnet_hosts(subnet)
+
+  def test_default_24(self):
+    hosts = self.hosts("192.168.1")
+    self.assertEqual(len(hosts), 254)
+    self.assertEqual((hosts[0], hosts[-1]), ("192.168.1.1", "192.168.1.254"))
+
+  # The network and broadcast addresses are excluded, and any host bits in
+  # the network address ignored
+  def test_cidr(self):
+    hosts = self.hosts("192.168.0.77/22")
+    self.assertEqual(len(hosts), 1022)
+    self.assertEqual((hosts[0], hosts[-1]), ("192.168.0.1", "192.168.3.254"))
+    self.assertTrue("192.168.1.255" in hosts and "192.168.2.0" in hosts)
+    self.assertEqual(self.hosts("10.0.0.0/30"), ["10.0.0.1", "10.0.0.2"])
+
+  # Point-to-point (RFC 3021) and single host prefixes have no network or
+  # broadcast address
+  def test_31_and_32(self):
+    self.assertEqual(self.hosts("10.0.0.4/31"), ["10.0.0.4", "10.0.0.5"])
+    self.assertEqual(self.hosts("10.0.0.7/32"), ["10.0.0.7"])
+
+  def test_invalid(self):
+    for subnet in ["10.0.0.0/7", "10.0.0.0/33", "10.0.0.0/x"]:
+      self.assertRaises(ValueError, self.hosts, subnet)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# LeaseFile against dnsmasq and ISC dhcpd lease files, as written by
+# dnsmasq 2.80 and dhcpd 4.4 (addresses are from the documentation ranges).
+#
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+import calendar
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import autoaway
+
+NOW = calendar.timegm((2026, 10, 16, 12, 0, 0, 0, 0, 0))
+
+DNSMASQ = b"""1792166400 a4:83:e7:12:34:56 192.0.2.10 Neils-iPhone 01:a4:83:e7:12:34:56
+1792094400 3c:28:6d:ab:cd:ef 192.0.2.11 pixel-7 01:3c:28:6d:ab:cd:ef
+0 00:11:32:00:00:01 192.0.2.2 nas *
+1792166400 f0:18:98:00:00:02 192.0.2.12 Zo\xc3\xab\xe2\x80\x99s-iPad 01:f0:18:98:00:00:02
+duid 00:01:00:01:2a:b3:c4:d5:00:11:32:00:00:01
+1792166400 1234567 2001:db8::10 Neils-iPhone 00:01:00:01:2a:b3:c4:d5:a4:83:e7:12:34:56
+"""
+
+DHCPD = b"""# The format of this file is documented in the dhcpd.leases(5) manual page.
+# This lease file was written by isc-dhcp-4.4.3
+
+# authoring-byte-order entry is generated, DO NOT DELETE
+authoring-byte-order little-endian;
+
+server-duid "\\000\\001\\000\\001*\\263\\304\\325\\000\\0212\\000\\000\\001";
+
+lease 192.0.2.10 {
+  starts 5 2026/10/16 08:00:00;
+  ends 5 2026/10/16 20:00:00;
+  cltt 5 2026/10/16 08:00:00;
+  binding state active;
+  next binding state free;
+  rewind binding state free;
+  hardware ethernet a4:83:e7:12:34:56;
+  uid "\\001\\244\\203\\347\\0224V";
+  client-hostname "Neils-iPhone";
+}
+lease 192.0.2.11 {
+  starts 4 2026/10/15 08:00:00;
+  ends 4 2026/10/15 20:00:00;
+  tstp 4 2026/10/15 20:00:00;
+  cltt 4 2026/10/15 08:00:00;
+  binding state free;
+  hardware ethernet 3c:28:6d:ab:cd:ef;
+}
+lease 192.0.2.12 {
+  starts 5 2026/10/16 09:30:00;
+  ends 5 2026/10/16 21:30:00;
+  cltt 5 2026/10/16 09:30:00;
+  binding state active;
+  next binding state free;
+  hardware ethernet f0:18:98:00:00:02;
+  client-hostname "Zo\xc3\xab\xe2\x80\x99s-iPad";
+}
+lease 192.0.2.2 {
+  starts 1 2026/01/05 10:00:00;
+  ends never;
+  binding state active;
+  hardware ethernet 00:11:32:00:00:01;
+}
+"""
+
+# The iPhone renewing its lease, appended by dhcpd in two writes
+DHCPD_RENEWAL = (b"""lease 192.0.2.10 {
+  starts 5 2026/10/16 11:55:00;
+  ends 5 2026/10/16 23:55:00;
+  cltt 5 2026/10/16 11:55:00;
+  binding state active;
+  next binding state free;
+  hardware ethernet a4:83:e7:12:34:56;
+  client-hostname "Neil\xe2\x80\x99s""", b"""-iPhone";
+}
+""")
+
+class LeaseFileTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dir, "leases")
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def write(self, data, mode="wb"):
+    with open(self.filename, mode) as f:
+      f.write(data)
+
+  def leases(self, changes):
+    return sorted([(x["mac"], x["ip"], x["type"]) for x in changes])
+
+  def test_missing(self):
+    self.assertEqual(autoaway.LeaseFile(self.filename).read(NOW), [])
+
+  def test_dnsmasq(self):
+    self.write(DNSMASQ)
+    lease = autoaway.LeaseFile(self.filename)
+    self.assertEqual(self.leases(lease.read(NOW)),
+                     [("00:11:32:00:00:01", "192.0.2.2", "LEASED"),
+                      ("a4:83:e7:12:34:56", "192.0.2.10", "LEASED"),
+                      ("f0:18:98:00:00:02", "192.0.2.12", "LEASED")])
+    self.assertEqual(lease.format, "dnsmasq")
+    self.assertEqual(lease.read(NOW), [])
+
+    # dnsmasq rewrites the file in place on renewal
+    self.write(DNSMASQ.replace(b"1792166400 a4:83", b"1792170000 a4:83"))
+    self.assertEqual(self.leases(lease.read(NOW)), [("a4:83:e7:12:34:56", "192.0.2.10", "RENEWED")])
+
+  def test_dhcpd(self):
+    self.write(DHCPD)
+    lease = autoaway.LeaseFile(self.filename)
+    self.assertEqual(self.leases(lease.read(NOW)),
+                     [("00:11:32:00:00:01", "192.0.2.2", "LEASED"),
+                      ("a4:83:e7:12:34:56", "192.0.2.10", "LEASED"),
+                      ("f0:18:98:00:00:02", "192.0.2.12", "LEASED")])
+    self.assertEqual(lease.format, "dhcpd")
+    self.assertEqual(lease.offset, len(DHCPD))
+    self.assertEqual(lease.read(NOW), [])
+
+  # Only the declarations appended since the last read are parsed, resuming
+  # at the byte offset following non-ASCII hostnames
+  def test_dhcpd_append(self):
+    self.write(DHCPD)
+    lease = autoaway.LeaseFile(self.filename)
+    lease.read(NOW)
+
+    self.write(DHCPD_RENEWAL[0], "ab")
+    self.assertEqual(lease.read(NOW), [])
+    self.write(DHCPD_RENEWAL[1], "ab")
+    self.assertEqual(self.leases(lease.read(NOW)), [("a4:83:e7:12:34:56", "192.0.2.10", "RENEWED")])
+    self.assertEqual(lease.offset, len(DHCPD) + len(b"".join(DHCPD_RENEWAL)))
+
+  # dhcpd periodically replaces the file with one holding only current leases
+  def test_dhcpd_replaced(self):
+    self.write(DHCPD)
+    lease = autoaway.LeaseFile(self.filename)
+    lease.read(NOW)
+
+    os.remove(self.filename)
+    self.write(DHCPD + b"".join(DHCPD_RENEWAL))
+    self.assertEqual(self.leases(lease.read(NOW)), [("a4:83:e7:12:34:56", "192.0.2.10", "RENEWED")])
+
+  def test_expired(self):
+    self.write(DHCPD)
+    lease = autoaway.LeaseFile(self.filename)
+    later = calendar.timegm((2026, 10, 16, 21, 0, 0, 0, 0, 0))
+    self.assertEqual(self.leases(lease.read(later)),
+                     [("00:11:32:00:00:01", "192.0.2.2", "LEASED"),
+                      ("f0:18:98:00:00:02", "192.0.2.12", "LEASED")])
+
+  def test_invalid_encoding(self):
+    self.write(DNSMASQ.replace(b"pixel-7", b"pixel\xff\xfe"))
+    lease = autoaway.LeaseFile(self.filename)
+    self.assertEqual(len(lease.read(NOW)), 3)
+
+    self.write(DHCPD.replace(b"Neils-iPhone", b"Neil\xffs-iPhone"))
+    lease = autoaway.LeaseFile(self.filename)
+    self.assertEqual(len(lease.read(NOW)), 3)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# NeighbourTable.parse() against RTM_NEWNEIGH messages recorded from a Linux
+# RTM_GETNEIGH dump (AF_UNSPEC, so IPv4 and IPv6 neighbours together), and
+# NeighbourSnapshot.update() given the entries parsed from successive dumps.
+#
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+import binascii
+import socket
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import autoaway
+
+def unhex(text):
+  return binascii.unhexlify("".join(text.split()))
+
+# 192.0.2.38 FAILED: NDA_DST, NDA_PROBES and NDA_CACHEINFO but no NDA_LLADDR
+FAILED_V4 = unhex("""
+  400000001c00020001000000ec650000 02000000040000002000000108000100
+  c00002260800040006000000140003000b0205009bea040068e9040000000000
+""")
+
+# As FAILED_V4, with the NUD state changed to INCOMPLETE (0x01)
+INCOMPLETE_V4 = FAILED_V4[:24] + b"\x01" + FAILED_V4[25:]
+
+# 192.0.2.1 lladdr 02:fc:00:00:00:05 STALE
+STALE_V4 = unhex("""
+  4c0000001c00020001000000ec650000 02000000040000000400000108000100
+  c00002010a00020002fc000000050000 0800040001000000140003006b0f0000
+  6b0f00001e07000000000000
+""")
+
+# ff02::1 lladdr 33:33:00:00:00:01 NOARP
+MULTICAST_V6 = unhex("""
+  580000001c00020001000000ec650000 0a000000040000004000000514000100
+  ff020000000000000000000000000001 0a0002003333000000010000
+  080004000000000014000300eb1a03007b0303007b03030000000000
+""")
+
+# fe80::fc:ff:fe00:5 lladdr 02:fc:00:00:00:05 REACHABLE, on ifindex 4
+LINKLOCAL_V6 = unhex("""
+  580000001c00020001000000ec650000 0a000000040000000200000114000100
+  fe8000000000000000fc00fffe000005 0a00020002fc000000050000
+  08000400000000001400030017000000 5aa105005aa1050000000000
+""")
+
+DONE = unhex("140000000300020001000000ec65000000000000")
+
+class NeighbourTableParseTest(unittest.TestCase):
+  def setUp(self):
+    self.table = autoaway.NeighbourTable(family=socket.AF_UNSPEC)
+    self.table.interface_name = lambda ifindex: "eth%d" % ifindex
+
+  def test_ipv4(self):
+    (done, entries) = self.table.parse(STALE_V4)
+    self.assertFalse(done)
+    self.assertEqual(entries, [{"mac": "02:fc:00:00:00:05", "ip": "192.0.2.1", "type": "STALE", "ifindex": 4}])
+
+  def test_ipv6(self):
+    (done, entries) = self.table.parse(MULTICAST_V6 + LINKLOCAL_V6)
+    self.assertEqual(entries, [{"mac": "33:33:00:00:00:01", "ip": "ff02::1", "type": "NOARP", "ifindex": 4},
+                               {"mac": "02:fc:00:00:00:05", "ip": "fe80::fc:ff:fe00:5%eth4", "type": "REACHABLE", "ifindex": 4}])
+
+  def test_without_lladdr(self):
+    self.assertEqual(self.table.parse(FAILED_V4), (False, []))
+    self.assertEqual(self.table.parse(INCOMPLETE_V4), (False, []))
+
+  def test_multipart(self):
+    parts = [FAILED_V4 + STALE_V4 + INCOMPLETE_V4, MULTICAST_V6 + LINKLOCAL_V6 + DONE]
+
+    (done, entries) = self.table.parse(parts[0])
+    self.assertFalse(done)
+    self.assertEqual([x["ip"] for x in entries], ["192.0.2.1"])
+
+    (done, entries) = self.table.parse(parts[1])
+    self.assertTrue(done)
+    self.assertEqual([x["ip"] for x in entries], ["ff02::1", "fe80::fc:ff:fe00:5%eth4"])
+
+  def test_done_stops_parsing(self):
+    self.assertEqual(self.table.parse(DONE + STALE_V4), (True, []))
+
+  def test_error(self):
+    t = autoaway.NeighbourTable
+    error = t.NLMSGHDR.pack(t.NLMSGHDR.size + 4, t.NLMSG_ERROR, 0, 1, 0) + b"\xf3\xff\xff\xff"
+    self.assertRaises(OSError, self.table.parse, error)
+
+    ack = t.NLMSGHDR.pack(t.NLMSGHDR.size + 4, t.NLMSG_ERROR, 0, 1, 0) + b"\x00" * 4
+    self.assertEqual(self.table.parse(STALE_V4 + ack)[0], True)
+
+# An IPv4 RTM_NEWNEIGH message, with the NDA_CACHEINFO counters that change
+# from dump to dump set from dump
+def neighbour(ip, mac, state, dump):
+  t = autoaway.NeighbourTable
+  nud = dict([(v, k) for (k, v) in t.NUD_STATES.items()])[state]
+  body = t.NDMSG.pack(socket.AF_INET, 2, nud, 0, 1) + \
+         struct.pack("=HH4s", 8, t.NDA_DST, socket.inet_aton(ip)) + \
+         struct.pack("=HH6sxx", 10, t.NDA_LLADDR, binascii.unhexlify(mac.replace(":", ""))) + \
+         struct.pack("=HHL", 8, 4, dump) + \
+         struct.pack("=HHLLLL", 20, 3, dump * 1000, dump * 1000, dump * 1000, 1)
+  return t.NLMSGHDR.pack(t.NLMSGHDR.size + len(body), t.RTM_NEWNEIGH, 2, dump, 0) + body
+
+A = ("192.0.2.1", "02:00:00:00:00:01", "REACHABLE")
+B = ("192.0.2.2", "02:00:00:00:00:02", "STALE")
+B_MOVED = ("192.0.2.2", "02:00:00:00:00:12", "STALE")
+C = ("192.0.2.3", "02:00:00:00:00:03", "REACHABLE")
+C_STALE = ("192.0.2.3", "02:00:00:00:00:03", "STALE")
+D = ("192.0.2.4", "02:00:00:00:00:01", "DELAY")
+
+# The neighbours in each dump, and the (added, removed, changed) entries
+# expected from update()
+STEPS = [
+  ([A, B],       ([A, B], [], [])),
+  ([A, B],       ([], [], [])),             # unchanged
+  ([A, B_MOVED], ([], [], [B_MOVED])),      # new MAC address
+  ([A, B_MOVED, C], ([C], [], [])),         # added
+  ([B_MOVED, C], ([], [A], [])),            # removed
+  ([C_STALE, B_MOVED, A, D], ([A, D], [], [C_STALE])),
+  ([D],          ([], [A, B_MOVED, C_STALE], [])),
+  ([],           ([], [D], [])),
+]
+
+class NeighbourSnapshotTest(unittest.TestCase):
+  def setUp(self):
+    self.table = autoaway.NeighbourTable()
+    self.snapshot = autoaway.NeighbourSnapshot()
+
+  # Parse as dump() does, reusing the entries unchanged since the last dump
+  # when reuse is set (netlink), or as new dicts (the arp and ip readers)
+  def parse(self, neighbours, dump, reuse):
+    data = b"".join([neighbour(ip, mac, state, dump) for (ip, mac, state) in neighbours])
+    self.table.parsing = {} if reuse else None
+    entries = self.table.parse(data)[1]
+    if reuse: self.table.parsed = self.table.parsing
+    self.table.parsing = None
+    return entries
+
+  def entries(self, nics):
+    return sorted([(x["ip"], x["mac"], x["type"]) for x in nics])
+
+  def check(self, reuse):
+    for (dump, (neighbours, expected)) in enumerate(STEPS, 1):
+      arp = self.parse(neighbours, dump, reuse)
+      result = self.snapshot.update(arp)
+      self.assertEqual(tuple([self.entries(x) for x in result]), tuple([sorted(x) for x in expected]),
+                       "dump %d" % dump)
+
+      self.assertEqual(len(self.snapshot), len(neighbours))
+      self.assertEqual(self.snapshot.by_ip, dict([(ip, (mac, state)) for (ip, mac, state) in neighbours]))
+      by_mac = {}
+      for (ip, mac, state) in neighbours:
+        by_mac.setdefault(mac, set()).add(ip)
+      self.assertEqual(self.snapshot.by_mac, by_mac)
+
+      # The same parse result again is not compared at all
+      self.assertEqual(self.snapshot.update(arp), ([], [], []))
+
+  def test_reused_entries(self):
+    self.check(True)
+
+  def test_new_entries(self):
+    self.check(False)
+
+  # Unchanged neighbours are the same dicts as from the previous dump
+  def test_identity(self):
+    first = self.parse([A, B], 1, True)
+    second = self.parse([A, B_MOVED], 2, True)
+    self.assertTrue(first[0] is second[0])
+    self.assertFalse(first[1] is second[1])
+
+  def test_entry(self):
+    self.snapshot.update(self.parse([A, B], 1, True))
+    self.assertEqual(self.snapshot.entry("192.0.2.2"), {"mac": "02:00:00:00:00:02", "ip": "192.0.2.2", "type": "STALE"})
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# NotificationDispatcher running a temporary notify script, which appends its
+# arguments to a file.
+#
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+import shutil
+import stat
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import autoaway
+
+class Logger(object):
+  def __init__(self):
+    self.messages = []
+
+  def debug(self, msg):
+    self.messages.append(msg)
+
+  def log(self, msg):
+    self.messages.append(msg)
+
+@unittest.skipIf(sys.platform == "win32", "runs a shell script")
+class NotificationDispatcherTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.output = os.path.join(self.dir, "output")
+    self.logger = Logger()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  # A notify script running body after recording its arguments
+  def script(self, body=""):
+    notify = os.path.join(self.dir, "notify.sh")
+    with open(notify, "w") as f:
+      f.write("#!/bin/sh\necho \"$@\" >> %s\n%s\n" % (self.output, body))
+    os.chmod(notify, stat.S_IRWXU)
+    return notify
+
+  def runs(self):
+    if not os.path.exists(self.output): return []
+    with open(self.output, "r") as f:
+      return f.read().splitlines()
+
+  def wait_for(self, condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+      if time.time() > deadline: self.fail("timed out, log: %s" % self.logger.messages)
+      time.sleep(0.02)
+
+  def test_delivery(self):
+    dispatcher = autoaway.NotificationDispatcher(self.script(), logger=self.logger)
+    dispatcher.submit(["home", "3600", "1h00m"])
+    self.wait_for(lambda: dispatcher.delivered == "home")
+    self.assertEqual(self.runs(), ["home 3600 1h00m"])
+    self.assertTrue("Calling notify [%s] with arg1 [home], arg2 [3600], arg3 [1h00m]" % dispatcher.notify
+                    in self.logger.messages)
+
+  # While the script runs, away then home again are coalesced into home,
+  # which is then skipped as already delivered
+  def test_coalescing(self):
+    dispatcher = autoaway.NotificationDispatcher(self.script("sleep 0.5"), logger=self.logger)
+    dispatcher.submit(["home", "3600", "1h00m"])
+    self.wait_for(lambda: self.runs())
+    dispatcher.submit(["away", "60", "0h01m"])
+    dispatcher.submit(["home", "60", "0h01m"])
+    self.wait_for(lambda: "Skipping notify [home], already delivered" in self.logger.messages)
+    self.assertEqual(self.runs(), ["home 3600 1h00m"])
+    self.assertTrue("Coalescing notify [away] into [home]" in self.logger.messages)
+
+    dispatcher.submit(["away", "60", "0h01m"])
+    dispatcher.submit(["away", "120", "0h02m"])
+    self.wait_for(lambda: dispatcher.delivered == "away")
+    self.assertEqual(self.runs()[1:], ["away 120 0h02m"])
+
+  # The whole process group is killed, including a child still holding the
+  # script's output open
+  def test_timeout(self):
+    pidfile = os.path.join(self.dir, "pid")
+    notify = self.script("sleep 30 &\necho $! > %s\nwait" % pidfile)
+    dispatcher = autoaway.NotificationDispatcher(notify, timeout=1, retries=0, logger=self.logger)
+    started = time.time()
+    dispatcher.submit(["away", "60", "0h01m"])
+    self.wait_for(lambda: "Notify [%s] killed after 1 seconds" % notify in self.logger.messages)
+    self.assertTrue(time.time() - started < 10)
+    self.assertEqual(dispatcher.delivered, None)
+
+    with open(pidfile, "r") as f:
+      pid = int(f.read())
+    self.wait_for(lambda: not os.path.exists("/proc/%d" % pid) or " Z " in open("/proc/%d/stat" % pid).read()
+                  if sys.platform.startswith("linux") else True)
+
+  # The first run fails and the retry, 2 seconds later, succeeds
+  def test_retry(self):
+    notify = self.script("[ $(wc -l < %s) -gt 1 ] || exit 1" % self.output)
+    dispatcher = autoaway.NotificationDispatcher(notify, retries=3, logger=self.logger)
+    dispatcher.submit(["away", "60", "0h01m"])
+    self.wait_for(lambda: dispatcher.delivered == "away")
+    self.assertEqual(self.runs(), ["away 60 0h01m"] * 2)
+    self.assertTrue("Notify [%s] returned non-zero exit status 1" % notify in self.logger.messages)
+    self.assertTrue("Retrying notify [away] in 2 seconds (retry 1 of 3)" in self.logger.messages)
+
+  # In multi-site mode the site name is the fourth argument
+  def test_site_argument(self):
+    dispatcher = autoaway.NotificationDispatcher(self.script(), logger=self.logger)
+    dispatcher.submit(["home", "3600", "1h00m", "flat1"])
+    self.wait_for(lambda: dispatcher.delivered == "home")
+    self.assertEqual(self.runs(), ["home 3600 1h00m flat1"])
+    self.assertTrue(dispatcher.is_alive())
+
+if __name__ == "__main__":
+  unittest.main()
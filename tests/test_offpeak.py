@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# OffPeakSchedule in the Europe/London timezone, across the daylight saving
+# changes of 2026 (clocks forward 01:00 GMT 29 March, back 02:00 BST 25
+# October) and with date overrides. Expected times are given in UTC.
+#
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+import calendar
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import autoaway
+
+def utc(year, month, day, hour=0, minute=0):
+  return calendar.timegm((year, month, day, hour, minute, 0, 0, 0, 0))
+
+@unittest.skipUnless(hasattr(time, "tzset"), "requires time.tzset()")
+class OffPeakScheduleTest(unittest.TestCase):
+  def setUp(self):
+    self.tz = os.environ.get("TZ")
+    os.environ["TZ"] = "Europe/London"
+    time.tzset()
+
+  def tearDown(self):
+    if self.tz is None:
+      del os.environ["TZ"]
+    else:
+      os.environ["TZ"] = self.tz
+    time.tzset()
+
+  def test_overnight(self):
+    schedule = autoaway.OffPeakSchedule(["23:00-07:00"])
+    self.assertFalse(schedule.active(utc(2026, 1, 14, 22, 59)))
+    self.assertTrue(schedule.active(utc(2026, 1, 14, 23, 0)))
+    self.assertTrue(schedule.active(utc(2026, 1, 15, 6, 59)))
+    self.assertFalse(schedule.active(utc(2026, 1, 15, 7, 0)))
+    self.assertEqual(schedule.next_transition(utc(2026, 1, 15, 12)), utc(2026, 1, 15, 23))
+
+  def test_clocks_forward(self):
+    schedule = autoaway.OffPeakSchedule(["23:00-07:00"])
+
+    # 23:00 GMT until 07:00 BST is 7 hours
+    self.assertEqual(schedule.next_transition(utc(2026, 3, 28, 12)), utc(2026, 3, 28, 23))
+    self.assertEqual(schedule.next_transition(utc(2026, 3, 28, 23)), utc(2026, 3, 29, 6))
+    self.assertTrue(schedule.active(utc(2026, 3, 29, 5, 59)))
+    self.assertFalse(schedule.active(utc(2026, 3, 29, 6)))
+
+    # 23:00 BST
+    self.assertEqual(schedule.next_transition(utc(2026, 3, 29, 12)), utc(2026, 3, 29, 22))
+
+  def test_clocks_back(self):
+    schedule = autoaway.OffPeakSchedule(["23:00-07:00"])
+
+    # 23:00 BST until 07:00 GMT is 9 hours
+    self.assertEqual(schedule.next_transition(utc(2026, 10, 24, 12)), utc(2026, 10, 24, 22))
+    self.assertEqual(schedule.next_transition(utc(2026, 10, 24, 22)), utc(2026, 10, 25, 7))
+    self.assertTrue(schedule.active(utc(2026, 10, 25, 6, 59)))
+    self.assertFalse(schedule.active(utc(2026, 10, 25, 7)))
+
+    # 23:00 GMT
+    self.assertEqual(schedule.next_transition(utc(2026, 10, 25, 12)), utc(2026, 10, 25, 23))
+
+  def test_days(self):
+    schedule = autoaway.OffPeakSchedule(["mon-fri 23:00-07:00", "sat,sun 01:00-09:00"])
+
+    # Friday 2026-01-16 23:00 until Saturday 07:00, then Saturday 01:00 until
+    # 09:00 overlaps and extends it
+    self.assertEqual(schedule.next_transition(utc(2026, 1, 16, 12)), utc(2026, 1, 16, 23))
+    self.assertEqual(schedule.next_transition(utc(2026, 1, 16, 23)), utc(2026, 1, 17, 9))
+    self.assertFalse(schedule.active(utc(2026, 1, 17, 23, 30)))
+    self.assertTrue(schedule.active(utc(2026, 1, 18, 1, 30)))
+
+  def test_date_override(self):
+    schedule = autoaway.OffPeakSchedule(["mon-fri 23:00-07:00", "2026-12-25 00:00-24:00"])
+
+    # Thursday's window runs into Christmas Day, which replaces Friday's window
+    self.assertEqual(schedule.next_transition(utc(2026, 12, 24, 12)), utc(2026, 12, 24, 23))
+    self.assertEqual(schedule.next_transition(utc(2026, 12, 24, 23)), utc(2026, 12, 26))
+    self.assertTrue(schedule.active(utc(2026, 12, 25, 23, 30)))
+    self.assertFalse(schedule.active(utc(2026, 12, 26, 0, 30)))
+    self.assertEqual(schedule.next_transition(utc(2026, 12, 26)), utc(2026, 12, 28, 23))
+
+  def test_far_future(self):
+    schedule = autoaway.OffPeakSchedule(["2027-06-01 09:00-17:00"])
+    self.assertIsNone(schedule.next_transition(utc(2026, 10, 16)))
+    self.assertFalse(schedule.active(utc(2026, 10, 16)))
+
+    # The schedule is recompiled as the date comes within range
+    self.assertEqual(schedule.next_transition(utc(2027, 5, 30)), utc(2027, 6, 1, 8))
+    self.assertTrue(schedule.active(utc(2027, 6, 1, 12)))
+    self.assertIsNone(schedule.next_transition(utc(2027, 6, 1, 16)))
+
+  def test_invalid(self):
+    for spec in ["", "23:00", "mon-fri", "23:00-25:00", "24:30-01:00", "fri-mon 23:00", "xyz 23:00-07:00",
+                 "2026-02-30 00:00-01:00", "mon fri 23:00-07:00"]:
+      self.assertRaises(ValueError, autoaway.OffPeakSchedule.parse, spec)
+
+if __name__ == "__main__":
+  unittest.main()
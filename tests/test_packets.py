@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# PacketDecoder against Ethernet frames of ARP and DHCP client traffic, held
+# at the start of a receive buffer as PacketListener does.
+#
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+import binascii
+import socket
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import autoaway
+
+def unhex(text):
+  return binascii.unhexlify("".join(text.split()))
+
+# who-has 192.0.2.1 tell 192.0.2.10, from 02:00:00:00:00:01, as sent (42 bytes)
+ARP_REQUEST = unhex("""
+  ffffffffffff02000000000108060001 080006040001020000000001c000020a
+  000000000000c0000201
+""")
+
+# 192.0.2.1 is-at 02:00:00:00:00:02, as received (padded to 60 bytes)
+ARP_REPLY = unhex("""
+  02000000000102000000000208060001 080006040002020000000002c0000201
+  020000000001c000020a000000000000 000000000000000000000000
+""")
+
+# As ARP_REQUEST, tagged for VLAN 100
+ARP_VLAN = unhex("""
+  ffffffffffff02000000000181000064 08060001080006040001020000000001
+  c000020a000000000000c0000201
+""")
+
+# BOOTP sname and file fields, unused
+NO_SNAME_FILE = b"\0" * 192
+
+# DHCPREQUEST broadcast by 02:00:00:00:00:03 with no address yet: options
+# 53 (message type), 61 (client identifier), 50 (requested IP address
+# 192.0.2.23), 12 (host name) and 55 (parameter request list)
+DHCP_REQUEST = unhex("""
+  ffffffffffff02000000000308004500 012b123400004011678f00000000ffff
+  ffff0044004301170000010106003903 f3260000800000000000000000000000
+  00000000000002000000000300000000 000000000000
+""") + NO_SNAME_FILE + unhex("""
+  638253633501033d0701020000000003 3204c00002170c0570686f6e65370301
+  0306ff
+""")
+
+# DHCPREQUEST unicast by 02:00:00:00:00:03 renewing its lease on 192.0.2.23,
+# so with ciaddr set and no option 50
+DHCP_RENEW = unhex("""
+  02000000000202000000000308004500 0120123400004011e380c0000217c000
+  020100440043010c0000010106003903 f32600000000c0000217000000000000
+  00000000000002000000000300000000 000000000000
+""") + NO_SNAME_FILE + unhex("""
+  638253633501033d0701020000000003 0c0570686f6e65ff
+""")
+
+OPTION_50 = unhex("3204c0000217")
+
+def tagged(frame, vlan=100):
+  return frame[:12] + unhex("8100%04x" % vlan) + frame[12:]
+
+def mac(text):
+  return binascii.unhexlify(text.replace(":", ""))
+
+class PacketDecoderTest(unittest.TestCase):
+  def setUp(self):
+    self.decoder = autoaway.PacketDecoder()
+
+  # The receive buffer is reused, so may hold a longer frame beyond length
+  def decode(self, frame, length=None):
+    buf = bytearray(autoaway.PacketListener.SNAPLEN)
+    buf[:len(frame)] = frame
+    return self.decoder.decode(buf, len(frame) if length is None else length)
+
+  def assertDecoded(self, frame, kind, sender, ip, length=None):
+    self.assertEqual(self.decode(frame, length), (kind, mac(sender), socket.inet_aton(ip)))
+
+  def test_arp_request(self):
+    self.assertDecoded(ARP_REQUEST, "ARP", "02:00:00:00:00:01", "192.0.2.10")
+
+  def test_arp_reply(self):
+    self.assertDecoded(ARP_REPLY, "ARP", "02:00:00:00:00:02", "192.0.2.1")
+
+  def test_vlan(self):
+    self.assertEqual(ARP_VLAN, tagged(ARP_REQUEST))
+    self.assertDecoded(ARP_VLAN, "ARP", "02:00:00:00:00:01", "192.0.2.10")
+    self.assertDecoded(tagged(DHCP_REQUEST), "DHCP", "02:00:00:00:00:03", "192.0.2.23")
+
+  # The requested IP address is found after the client identifier
+  def test_dhcp_requested_ip(self):
+    self.assertDecoded(DHCP_REQUEST, "DHCP", "02:00:00:00:00:03", "192.0.2.23")
+
+  def test_dhcp_ciaddr(self):
+    self.assertDecoded(DHCP_RENEW, "DHCP", "02:00:00:00:00:03", "192.0.2.23")
+
+  # Without option 50, here replaced by pad options, there's no address
+  def test_dhcp_no_requested_ip(self):
+    frame = DHCP_REQUEST.replace(OPTION_50, b"\0" * len(OPTION_50))
+    self.assertDecoded(frame, "DHCP", "02:00:00:00:00:03", "0.0.0.0")
+    frame = DHCP_REQUEST.replace(unhex("63825363"), unhex("00000000"))
+    self.assertDecoded(frame, "DHCP", "02:00:00:00:00:03", "0.0.0.0")
+
+  # Only BOOTREQUESTs to the server port
+  def test_dhcp_reply(self):
+    self.assertEqual(self.decode(DHCP_REQUEST[:42] + b"\x02" + DHCP_REQUEST[43:]), None)
+    self.assertEqual(self.decode(DHCP_REQUEST[:36] + unhex("0044") + DHCP_REQUEST[38:]), None)
+
+  def test_other_protocols(self):
+    self.assertEqual(self.decode(DHCP_REQUEST[:23] + b"\x06" + DHCP_REQUEST[24:]), None)
+    self.assertEqual(self.decode(ARP_REQUEST[:12] + unhex("86dd") + ARP_REQUEST[14:]), None)
+
+  # The first fragment holds the UDP and BOOTP headers, later ones don't
+  def test_fragments(self):
+    for (flags, decoded) in [("2000", True), ("2010", False), ("00b9", False), ("0001", False)]:
+      frame = DHCP_REQUEST[:20] + unhex(flags) + DHCP_REQUEST[22:]
+      self.assertEqual(self.decode(frame) is not None, decoded, flags)
+
+  def test_truncated(self):
+    self.assertEqual(self.decode(ARP_REQUEST, 41), None)
+    self.assertEqual(self.decode(ARP_VLAN, 41), None)
+
+    # chaddr ends 76 bytes in
+    self.assertEqual(self.decode(DHCP_REQUEST, 75), None)
+    self.assertDecoded(DHCP_REQUEST, "DHCP", "02:00:00:00:00:03", "0.0.0.0", 76)
+
+    # Option 50 cut short
+    option = DHCP_REQUEST.index(OPTION_50)
+    self.assertDecoded(DHCP_REQUEST, "DHCP", "02:00:00:00:00:03", "0.0.0.0", option + 5)
+    self.assertDecoded(DHCP_REQUEST, "DHCP", "02:00:00:00:00:03", "192.0.2.23", option + 6)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# ResolverCache with stand-in lookup functions, so that no DNS queries are
+# made.
+#
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+import time
+import socket
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import autoaway
+
+class ResolverCacheTest(unittest.TestCase):
+  def wait_for(self, condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+      if time.time() > deadline: self.fail("timed out")
+      time.sleep(0.02)
+
+  # A lookup raising something other than a socket error is logged and
+  # cached as unresolved, and the worker goes on to the next name
+  def test_reverse_worker_survives(self):
+    def reverse_lookup(name):
+      if name == "192.0.2.1": raise RuntimeError("resolver broken")
+      if name == "192.0.2.2": raise socket.herror("unknown host")
+      return "host3.example.com"
+
+    resolver = autoaway.ResolverCache(reverse_lookup=reverse_lookup)
+    for name in ["192.0.2.1", "192.0.2.2", "192.0.2.3"]:
+      self.assertEqual(resolver.reverse(name), name)
+    self.wait_for(lambda: resolver.reverse("192.0.2.3") != "192.0.2.3")
+
+    self.assertEqual(resolver.reverse("192.0.2.3"), "host3.example.com")
+    self.assertEqual(resolver.reverse("192.0.2.1"), "192.0.2.1")
+    self.assertEqual(resolver.reverse_pending, set())
+    self.assertTrue(resolver.reverse_thread.is_alive())
+
+if __name__ == "__main__":
+  unittest.main()
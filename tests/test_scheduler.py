@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# ProbeScheduler ordering and backoff of per-device probes, and
+# CheckScheduler deadlines, overruns and suspend detection against a clock
+# that only advances when waited on.
+#
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import autoaway
+
+class ProbeSchedulerTest(unittest.TestCase):
+  def setUp(self):
+    self.devices = [autoaway.Device(name) for name in ["phone", "laptop", "tablet"]]
+    (self.phone, self.laptop, self.tablet) = self.devices
+    self.scheduler = autoaway.ProbeScheduler(self.devices, 60, max_backoff=8)
+
+  def names(self, devices):
+    return [x.name for x in devices]
+
+  # Most reliable first, then most recently seen
+  def test_due_order(self):
+    (self.phone.reliability, self.laptop.reliability, self.tablet.reliability) = (0.5, 1.0, 1.0)
+    (self.laptop.last_seen, self.tablet.last_seen) = (100, 200)
+    self.assertEqual(self.names(self.scheduler.due(0)), ["tablet", "laptop", "phone"])
+    self.assertEqual(self.scheduler.due(0), [])
+
+  # Only devices whose next probe has come are returned, and a device
+  # rescheduled more than once is returned at its latest time only
+  def test_heap_order(self):
+    self.scheduler.due(0)
+    self.scheduler.reschedule(self.phone, 300)
+    self.scheduler.reschedule(self.laptop, 100)
+    self.scheduler.reschedule(self.tablet, 200)
+    self.scheduler.reschedule(self.tablet, 400)
+    self.assertEqual(self.scheduler.due(99), [])
+    self.assertEqual(self.names(self.scheduler.due(200)), ["laptop"])
+    self.assertEqual(self.names(self.scheduler.due(300)), ["phone"])
+    self.assertEqual(self.names(self.scheduler.due(1000)), ["tablet"])
+    self.assertEqual(self.scheduler.heap, [])
+
+  # Stale entries are discarded once the heap grows well beyond the devices
+  def test_heap_rebuilt(self):
+    for when in range(100):
+      self.scheduler.reschedule(self.phone, when)
+    self.assertTrue(len(self.scheduler.heap) <= 4 * len(self.devices) + 16)
+    self.assertEqual(sorted(self.names(self.scheduler.due(98))), ["laptop", "tablet"])
+    self.assertEqual(self.names(self.scheduler.due(99)), ["phone"])
+
+  # Backoff doubles with each miss up to max_backoff intervals, less half an
+  # interval
+  def test_backoff(self):
+    self.assertEqual([self.scheduler.backoff(x) for x in range(1, 7)], [30, 90, 210, 450, 450, 450])
+    self.assertEqual(autoaway.ProbeScheduler([], 60, max_backoff=0).max_backoff, 1)
+
+  def test_missed(self):
+    now = 1000
+    for (misses, reliability) in [(1, 0.75), (2, 0.5625), (3, 0.421875)]:
+      self.assertTrue(self.phone in self.scheduler.due(now))
+      self.scheduler.record(self.phone, False, now, True)
+      self.assertEqual(self.phone.misses, misses)
+      self.assertAlmostEqual(self.phone.reliability, reliability)
+      self.assertEqual(self.phone.next_probe, now + self.scheduler.backoff(misses))
+      self.assertFalse(self.phone in self.scheduler.due(self.phone.next_probe - 1))
+      now = self.phone.next_probe
+
+  # A reply resets the misses and leaves the device due at every check
+  def test_reply_resets(self):
+    self.scheduler.due(0)
+    self.scheduler.record(self.phone, False, 0, True)
+    self.scheduler.record(self.phone, False, 30, True)
+    self.scheduler.record(self.phone, True, 120, True)
+    self.assertEqual((self.phone.misses, self.phone.last_seen, self.phone.next_probe), (0, 120, 120))
+    self.assertAlmostEqual(self.phone.reliability, 0.75 * 0.75 * 0.75 + 0.25)
+    self.assertEqual(self.names(self.scheduler.due(120)), ["phone"])
+
+  # Without backoff, as when the property is vacant, misses are counted but
+  # the device stays due
+  def test_no_backoff(self):
+    self.scheduler.due(0)
+    self.scheduler.record(self.phone, False, 60, False)
+    self.assertEqual((self.phone.misses, self.phone.next_probe), (1, 60))
+    self.assertEqual(self.names(self.scheduler.due(60)), ["phone"])
+
+  # A device seen passively is backed off for one interval, and its misses
+  # reset
+  def test_seen(self):
+    self.scheduler.due(0)
+    self.scheduler.record(self.phone, False, 0, True)
+    self.scheduler.record(self.phone, False, 30, True)
+    self.scheduler.seen(self.phone, 200)
+    self.assertEqual((self.phone.misses, self.phone.next_probe), (0, 230))
+    self.assertEqual(self.scheduler.due(229), [])
+    self.assertEqual(self.names(self.scheduler.due(230)), ["phone"])
+
+  def test_describe(self):
+    self.scheduler.due(0)
+    self.scheduler.record(self.phone, False, 0, True)
+    self.scheduler.record(self.laptop, True, 0, True)
+    self.scheduler.reschedule(self.tablet, 10)
+    self.assertEqual(self.scheduler.describe(5), [
+      "laptop: reliability 1.00, 0 misses, next probe due",
+      "tablet: reliability 1.00, 0 misses, next probe in 5s",
+      "phone: reliability 0.75, 1 miss, next probe in 25s"])
+
+# Waiting advances both clocks by the time waited, or until the event is due
+# to be set. A pending suspend advances only the boot time clock, during the
+# next wait.
+class FakeClock(autoaway.Clock):
+  def __init__(self, now):
+    self.mono = self.boot = float(now)
+    self.waits = []
+    self.event_in = None
+    self.suspend = 0
+
+  def monotonic(self):
+    return self.mono
+
+  def boottime(self):
+    return self.boot
+
+  def run(self, secs):
+    self.mono += secs
+    self.boot += secs
+
+  def wait(self, event, secs):
+    self.waits.append(secs)
+    if self.event_in is not None and self.event_in <= secs:
+      self.run(self.event_in)
+      self.event_in = None
+      return True
+    if self.event_in is not None: self.event_in -= secs
+    self.run(secs)
+    (self.boot, self.suspend) = (self.boot + self.suspend, 0)
+    return False
+
+class CheckSchedulerTest(unittest.TestCase):
+  def setUp(self):
+    self.clock = FakeClock(1000)
+    self.schedule = autoaway.CheckScheduler(self.clock)
+    self.event = threading.Event()
+
+  # Each wait is in slices of at most SLICE seconds
+  def test_wait(self):
+    self.assertEqual(self.schedule.wait(self.event, 75), None)
+    self.assertEqual(self.clock.waits, [30, 30, 15])
+    self.assertEqual((self.clock.mono, self.schedule.deadline), (1075, 1075))
+    self.assertEqual((self.schedule.checks, self.schedule.early), (1, 0))
+    self.assertEqual(list(self.schedule.jitter), [0])
+
+  # The next deadline is a period after the previous one, however long the
+  # check took, so checks don't drift. The first check's period starts when
+  # it's first timed.
+  def test_deadline(self):
+    self.schedule.elapsed()
+    for (took, remaining) in [(5, 55), (12.5, 47.5), (0, 60)]:
+      deadline = self.schedule.deadline
+      self.clock.run(took)
+      self.assertEqual(self.schedule.elapsed(), took)
+      self.assertEqual(self.schedule.after(60), remaining)
+      self.assertEqual(self.schedule.wait(self.event, remaining), None)
+      self.assertEqual(self.schedule.deadline, deadline + 60)
+    self.assertEqual((self.schedule.checks, self.schedule.overruns), (3, 0))
+
+  # A check taking longer than the period starts the next one immediately
+  def test_overrun(self):
+    self.schedule.elapsed()
+    self.clock.run(75)
+    self.assertEqual(self.schedule.after(60), 0)
+    self.assertEqual((self.schedule.overruns, self.schedule.last_overrun), (1, 15))
+    self.assertEqual(self.schedule.wait(self.event, 0), None)
+    self.assertEqual(self.clock.waits, [])
+    self.clock.run(70)
+    self.assertEqual(self.schedule.after(60), 0)
+    self.assertEqual((self.schedule.overruns, self.schedule.last_overrun), (2, 10))
+    self.assertEqual(self.schedule.summary(),
+                     "1 checks, 0 unscheduled, jitter median/p95/max 0.0/0.0/0.0 ms, 2 overruns, 0 suspends")
+
+  # An event starts the check early, and the next period from then
+  def test_event(self):
+    self.clock.event_in = 40
+    self.assertEqual(self.schedule.wait(self.event, 300), "event")
+    self.assertEqual((self.clock.mono, self.schedule.deadline), (1040, 1040))
+    self.assertEqual((self.schedule.checks, self.schedule.early), (1, 1))
+    self.assertEqual(list(self.schedule.jitter), [])
+
+  # Boot time advancing beyond the monotonic clock during a slice is a
+  # suspend, noticed at the end of that slice rather than the deadline
+  def test_suspend(self):
+    self.clock.suspend = 3600
+    self.assertEqual(self.schedule.wait(self.event, 300), "suspend")
+    self.assertEqual(self.clock.waits, [30])
+    self.assertEqual((self.schedule.suspends, self.schedule.last_suspend), (1, 3600))
+    self.assertEqual((self.schedule.early, self.schedule.deadline), (1, 1030))
+
+  # Less than SUSPEND_THRESHOLD of drift between the clocks is ignored
+  def test_no_suspend(self):
+    self.clock.suspend = 2
+    self.assertEqual(self.schedule.wait(self.event, 60), None)
+    self.assertEqual(self.schedule.suspends, 0)
+
+if __name__ == "__main__":
+  unittest.main()
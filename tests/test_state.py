@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Saving and restoring --statefile, with stand-in neighbour table and pinger
+# so that no packets are sent.
+#
+#   python -m unittest discover tests
+#
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import autoaway
+
+MAC = "02:00:00:00:00:01"
+
+class FakeClock(autoaway.Clock):
+  def __init__(self, now):
+    self.now = float(now)
+
+  def time(self):
+    return self.now
+
+  def monotonic(self):
+    return self.now
+
+  def boottime(self):
+    return self.now
+
+class FakeNeighbours(object):
+  def __init__(self, entries):
+    self.entries = entries
+
+  def dump(self):
+    return list(self.entries)
+
+class FakePinger(object):
+  type = "fake"
+
+  def ping_hosts(self, ipaddresses, count=1, timeout=1.0, first_reply=False, concurrency=None):
+    return ({}, None)
+
+class StateFileTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.statefile = os.path.join(self.dir, "state.json")
+    self.clock = FakeClock(1800000000)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def autoaway(self, arp=()):
+    return autoaway.AutoAway([MAC], grace_period=15, check_every=15, statefile=self.statefile, clock=self.clock,
+                             neighbours=FakeNeighbours(arp), pinger=FakePinger(), reverse=False)
+
+  def test_round_trip(self):
+    saved = self.autoaway([{"mac": MAC, "ip": "192.0.2.10", "type": "REACHABLE"}])
+    (saved.first_seen, saved.last_seen, saved.time_vacant) = (self.clock.now - 3600, self.clock.now, 7200)
+    saved.save_state()
+    self.assertEqual(os.listdir(self.dir), ["state.json"])
+    with open(self.statefile, "r") as f:
+      state = json.load(f)
+    self.assertEqual(state["devices"], {MAC: "192.0.2.10"})
+    self.assertEqual(state["saved"], self.clock.now)
+
+    # Restored after a restart within the check interval, before the ARP cache
+    # has the device
+    self.clock.now += 600
+    restored = self.autoaway()
+    self.assertEqual(restored.registry.macs[0].ip, "192.0.2.10")
+    self.assertEqual((restored.first_seen, restored.last_seen, restored.first_notseen, restored.time_vacant),
+                     (saved.first_seen, saved.last_seen, 0, 7200))
+    self.assertEqual(restored.seen_at, saved.first_seen)
+    self.assertTrue(restored.restored_occupied)
+
+  # Learned IP addresses are always restored, but not occupancy timers once
+  # older than the check interval or grace period
+  def test_too_old(self):
+    saved = self.autoaway([{"mac": MAC, "ip": "192.0.2.10", "type": "REACHABLE"}])
+    (saved.first_seen, saved.last_seen) = (self.clock.now - 3600, self.clock.now)
+    saved.save_state()
+
+    self.clock.now += 901
+    restored = self.autoaway()
+    self.assertEqual(restored.registry.macs[0].ip, "192.0.2.10")
+    self.assertEqual((restored.first_seen, restored.restored_occupied), (0, None))
+
+  def test_missing(self):
+    restored = self.autoaway()
+    self.assertFalse(restored.registry.macs[0].ip)
+    self.assertEqual(restored.restored_occupied, None)
+
+  def test_corrupt(self):
+    for data in ['{"saved": 1800000000, "devices": {"02:00', "[1, 2, 3]", ""]:
+      with open(self.statefile, "w") as f:
+        f.write(data)
+      restored = self.autoaway()
+      self.assertFalse(restored.registry.macs[0].ip)
+      self.assertEqual(restored.restored_occupied, None)
+
+  # A failed save leaves the previous state file in place
+  def test_atomic(self):
+    saved = self.autoaway([{"mac": MAC, "ip": "192.0.2.10", "type": "REACHABLE"}])
+    saved.save_state()
+    with open(self.statefile, "r") as f:
+      before = f.read()
+
+    os.mkdir("%s.tmp" % self.statefile)
+    saved.log = lambda msg: None
+    saved.registry.learn(saved.registry.macs[0], "192.0.2.11")
+    saved.save_state()
+    with open(self.statefile, "r") as f:
+      self.assertEqual(f.read(), before)
+
+if __name__ == "__main__":
+  unittest.main()